@@ -374,12 +374,13 @@ class Command(object):
                 if self.session.displayed:
                     b = self.session.displayed['stats']['start'] - 1
                     c = self.session.displayed['stats']['count']
+                    self.session.finish_sorting(b + c)
                     msg_ids |= set(self.session.results[b:b + c])
                 else:
                     self.session.ui.warning(_('No results to choose from!'))
             elif what.lower() in ('all', '!all', '=!all'):
                 if self.session.results:
-                    msg_ids |= set(self.session.results)
+                    msg_ids |= set(self.session.finish_sorting())
                 else:
                     self.session.ui.warning(_('No results to choose from!'))
             elif what.startswith('='):
@@ -399,12 +400,14 @@ class Command(object):
             elif '-' in what:
                 try:
                     b, e = what.split('-')
+                    self.session.finish_sorting(int(e))
                     msg_ids |= set(self.session.results[int(b) - 1:int(e)])
                 except (ValueError, KeyError, IndexError, TypeError):
                     self.session.ui.warning(_('What message is %s?'
                                               ) % (what, ))
             else:
                 try:
+                    self.session.finish_sorting(int(what))
                     msg_ids.add(self.session.results[int(what) - 1])
                 except (ValueError, KeyError, IndexError, TypeError):
                     self.session.ui.warning(_('What message is %s?'
@@ -40,6 +40,15 @@ CONFIG_RULES = {
         'http_path':     p(_('HTTP path of web UI'), 'webroot',            ''),
         'http_no_auth':  X(_('Disable HTTP authentication'),      bool, False),
         'postinglist_kb': (_('Posting list target size in KB'), int,       64),
+        'postinglist_cache_mb': (_('Posting list cache size in MB'), int,  32),
+        'postinglist_journal_kb': (_('Keyword journal checkpoint size in KB'),
+                                   int, 4096),
+        'index_log_kb':   (_('Metadata index log checkpoint size in KB'),
+                           int, 4096),
+        'index_fsync':    (_('When to sync the metadata index to disk'),
+                           ["always", "checkpoint", "never"], "checkpoint"),
+        'msg_cache_entries': (_('Messages kept in the metadata cache'),
+                              int, 2500),
         'sort_max':       (_('Max results we sort "well"'), int,         2500),
         'snippet_max':    (_('Max length of metadata snippets'), int,     250),
         'debug':         p(_('Debugging flags'), str,                      ''),
@@ -801,8 +801,7 @@ class DecryptingStreamer(InputCoprocess):
             if self.decryptor is not None:
                 eof = not data
                 if self.decoder_data_bytes and data:
-                    self.buffered += ''.join([c for c in data if c not in
-                                              (' ', '\t', '\r', '\n')])
+                    self.buffered += data.translate(None, ' \t\r\n')
                 else:
                     self.buffered += (data or '')
                 data = ''
@@ -1,13 +1,15 @@
 import copy
 import json
-import random
 import rfc822
+import threading
 import time
 
 from mailpile.i18n import gettext as _
 from mailpile.i18n import ngettext as _n
+from mailpile.index.cache import MessageCache
 from mailpile.index.msginfo import MessageInfoConstants
 from mailpile.index.search import SearchResultSet
+from mailpile.index.trigrams import TrigramIndex
 from mailpile.mailutils import AddressHeaderParser, MBX_ID_LEN
 from mailpile.mailutils.safe import *
 from mailpile.util import *
@@ -28,9 +30,11 @@ class BaseIndex(MessageInfoConstants):
 
     def __init__(self, config):
         self.config = config
-        self.CACHE = {}
+        self.CACHE = MessageCache(self.MAX_CACHE_ENTRIES)
         self.EMAILS = []
         self.EMAIL_IDS = {}
+        self.EMAIL_GRAMS = None
+        self._email_grams_lock = threading.Lock()
 
     ### Known e-mail addresses #############################################
 
@@ -42,9 +46,22 @@ class BaseIndex(MessageInfoConstants):
             self.EMAILS.append('')
         self.EMAILS[eid] = '%s (%s)' % (email, name or email)
         self.EMAIL_IDS[email.lower()] = eid
+        with self._email_grams_lock:
+            if self.EMAIL_GRAMS is not None:
+                self.EMAIL_GRAMS.add(eid)
         # FIXME: This needs to get written out...
         return eid
 
+    def search_emails(self, terms):
+        """Return the IDs of all known e-mail addresses matching terms."""
+        # The trigram index is built on first use and kept up to date by
+        # add_email from then on. Whoever replaces EMAILS resets it.
+        with self._email_grams_lock:
+            if self.EMAIL_GRAMS is None:
+                self.EMAIL_GRAMS = TrigramIndex(self.EMAILS)
+            grams = self.EMAIL_GRAMS
+        return grams.search(terms)
+
     def update_email(self, email, name=None, change_name=True):
         eid = self.EMAIL_IDS.get(email.lower())
         if (eid is not None) and not change_name:
@@ -93,6 +110,10 @@ class BaseIndex(MessageInfoConstants):
     def sort_results(self, session, results, sort_order):
         pass
 
+    def sort_top_results(self, session, results, sort_order, limit):
+        self.sort_results(session, results, sort_order)
+        return False
+
     def get_conversation(self, msg_idx=None):
         return []
 
@@ -168,20 +189,10 @@ class BaseIndex(MessageInfoConstants):
 
     def get_msg_at_idx_pos(self, msg_idx):
         try:
-            crv = self.CACHE.get(msg_idx, {})
-            if 'msg_info' in crv:
-                return crv['msg_info']
-
-            if len(self.CACHE) > self.MAX_CACHE_ENTRIES:
-                try:
-                    for k in random.sample(
-                            self.CACHE.keys(), self.MAX_CACHE_ENTRIES/20):
-                        del self.CACHE[k]
-                except KeyError:
-                    pass
-            rv = self.get_msg_at_idx_pos_uncached(msg_idx)
-            crv['msg_info'] = rv
-            self.CACHE[msg_idx] = crv
+            rv = self.CACHE.info.get(msg_idx)
+            if rv is None:
+                rv = self.get_msg_at_idx_pos_uncached(msg_idx)
+                self.CACHE.info[msg_idx] = rv
             return rv
 
         except (IndexError, ValueError):
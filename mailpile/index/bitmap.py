@@ -0,0 +1,244 @@
+from array import array
+from binascii import hexlify, unhexlify
+from bisect import bisect_left
+
+from mailpile.i18n import gettext as _
+from mailpile.i18n import ngettext as _n
+
+
+# For each possible byte value, the positions of the bits which are set.
+BYTE_BITS = tuple(tuple(b for b in range(0, 8) if v & (1 << b))
+                  for v in range(0, 256))
+BIT_MASKS = tuple(1 << b for b in range(0, 8))
+
+
+class Bitmap(object):
+    """
+    A compressed set of non-negative integers, such as message index
+    positions.
+
+    Values are grouped into fixed size chunks and each chunk is stored as
+    a Python long, so unions, intersections and differences happen a chunk
+    at a time in C instead of one element at a time. Empty chunks are not
+    stored at all, which keeps sparse sets small, and dense ranges like
+    `all:mail` are cheap to create.
+
+    The class mimics enough of the set API that it can be used wherever
+    search results used to be plain sets:
+
+    >>> b = Bitmap([1, 5, 9000])
+    >>> list(b), len(b), 5 in b, 6 in b
+    ([1, 5, 9000], 3, True, False)
+    >>> list(b & Bitmap.Range(0, 10)), list(b - set([5])), len(b | [2, 3])
+    ([1, 5], [1, 9000], 5)
+    >>> (Bitmap.Range(0, 10000) - b).count(), sorted(set([7, 9000]) & b)
+    (9997, [9000])
+    """
+    CHUNK_SHIFT = 12
+    CHUNK_BITS = 1 << CHUNK_SHIFT
+    CHUNK_MASK = CHUNK_BITS - 1
+    CHUNK_BYTES = CHUNK_BITS // 8
+    FULL_CHUNK = (1 << CHUNK_BITS) - 1
+
+    __slots__ = ('chunks', )
+
+    def __init__(self, values=None):
+        self.chunks = {}
+        if values is not None:
+            self.update(values)
+
+    @classmethod
+    def Range(cls, start, end):
+        """Create a bitmap containing all the integers in [start, end)."""
+        bm = cls()
+        start = max(0, start)
+        while start < end:
+            chunk = start >> cls.CHUNK_SHIFT
+            lo = start & cls.CHUNK_MASK
+            hi = min(cls.CHUNK_BITS, lo + end - start)
+            if lo == 0 and hi == cls.CHUNK_BITS:
+                bm.chunks[chunk] = cls.FULL_CHUNK
+            else:
+                bm.chunks[chunk] = ((1 << hi) - 1) ^ ((1 << lo) - 1)
+            start += hi - lo
+        return bm
+
+    @classmethod
+    def Wrap(cls, values):
+        """Return values as a bitmap, copying only if necessary."""
+        if isinstance(values, cls):
+            return values
+        return cls(values)
+
+    def copy(self):
+        bm = Bitmap()
+        bm.chunks = dict(self.chunks)
+        return bm
+
+    ### Modification ######################################################
+
+    def add(self, value):
+        if value < 0:
+            raise ValueError('Bitmap values must be non-negative')
+        chunk = value >> self.CHUNK_SHIFT
+        self.chunks[chunk] = (self.chunks.get(chunk, 0)
+                              | (1 << (value & self.CHUNK_MASK)))
+
+    def discard(self, value):
+        chunk = value >> self.CHUNK_SHIFT
+        bits = self.chunks.get(chunk, 0) & ~(1 << (value & self.CHUNK_MASK))
+        if bits:
+            self.chunks[chunk] = bits
+        elif chunk in self.chunks:
+            del self.chunks[chunk]
+
+    def update(self, values):
+        """Add all the values from another bitmap or an iterable of ints."""
+        chunks = self.chunks
+        if isinstance(values, Bitmap):
+            for chunk, bits in values.chunks.iteritems():
+                chunks[chunk] = chunks.get(chunk, 0) | bits
+            return self
+
+        values = sorted(values)
+        if not values:
+            return self
+        if values[0] < 0:
+            raise ValueError('Bitmap values must be non-negative')
+
+        # Setting bits one at a time in a long would copy the long each
+        # time, so for all but the smallest chunks we collect the bits in
+        # a bytearray and convert it in one go.
+        shift, mask = self.CHUNK_SHIFT, self.CHUNK_MASK
+        start, count = 0, len(values)
+        while start < count:
+            chunk = values[start] >> shift
+            end = bisect_left(values, (chunk + 1) << shift, start)
+            if end - start < 8:
+                bits = 0
+                for value in values[start:end]:
+                    bits |= 1 << (value & mask)
+            else:
+                ba = bytearray(self.CHUNK_BYTES)
+                for value in values[start:end]:
+                    value &= mask
+                    ba[value >> 3] |= BIT_MASKS[value & 7]
+                ba.reverse()
+                bits = long(hexlify(ba), 16)
+            chunks[chunk] = chunks.get(chunk, 0) | bits
+            start = end
+        return self
+
+    def intersection_update(self, other):
+        other = Bitmap.Wrap(other).chunks
+        chunks = self.chunks
+        for chunk in chunks.keys():
+            bits = chunks[chunk] & other.get(chunk, 0)
+            if bits:
+                chunks[chunk] = bits
+            else:
+                del chunks[chunk]
+        return self
+
+    def difference_update(self, other):
+        other = Bitmap.Wrap(other).chunks
+        chunks = self.chunks
+        for chunk, obits in other.iteritems():
+            if chunk in chunks:
+                bits = chunks[chunk] & ~obits
+                if bits:
+                    chunks[chunk] = bits
+                else:
+                    del chunks[chunk]
+        return self
+
+    ### Set algebra #######################################################
+
+    def union(self, other):
+        return self.copy().update(other)
+
+    def intersection(self, other):
+        # Iterate over whichever bitmap has fewer chunks
+        other = Bitmap.Wrap(other)
+        small, large = self.chunks, other.chunks
+        if len(small) > len(large):
+            small, large = large, small
+        bm = Bitmap()
+        for chunk, bits in small.iteritems():
+            bits &= large.get(chunk, 0)
+            if bits:
+                bm.chunks[chunk] = bits
+        return bm
+
+    def andnot(self, other):
+        return self.copy().difference_update(other)
+
+    difference = andnot
+
+    def count(self):
+        return sum(bin(bits).count('1') for bits in self.chunks.itervalues())
+
+    __or__ = __ror__ = union
+    __and__ = __rand__ = intersection
+    __sub__ = andnot
+    __ior__ = update
+    __iand__ = intersection_update
+    __isub__ = difference_update
+    __len__ = count
+
+    def __rsub__(self, other):
+        return Bitmap(other).difference_update(self)
+
+    ### Inspection ########################################################
+
+    def __contains__(self, value):
+        if value < 0:
+            return False
+        return bool((self.chunks.get(value >> self.CHUNK_SHIFT, 0)
+                     >> (value & self.CHUNK_MASK)) & 1)
+
+    def __nonzero__(self):
+        return bool(self.chunks)
+
+    def __iter__(self):
+        """Iterate over the values in ascending order."""
+        return iter(self.tolist())
+
+    def tolist(self):
+        values = []
+        for chunk in sorted(self.chunks.keys()):
+            base = chunk << self.CHUNK_SHIFT
+            hexbits = '%x' % self.chunks[chunk]
+            ba = bytearray(unhexlify('0' * (len(hexbits) % 2) + hexbits))
+            ba.reverse()
+            values.extend([base + (pos << 3) + bit
+                           for pos, byte in enumerate(ba) if byte
+                           for bit in BYTE_BITS[byte]])
+        return values
+
+    def __eq__(self, other):
+        if isinstance(other, Bitmap):
+            return self.chunks == other.chunks
+        try:
+            return set(self) == set(other)
+        except TypeError:
+            return False
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '<Bitmap(%d values in %d chunks)>' % (len(self),
+                                                      len(self.chunks))
+
+
+if __name__ == '__main__':
+    import doctest
+    import sys
+    results = doctest.testmod(optionflags=doctest.ELLIPSIS,
+                              extraglobs={})
+    print '%s' % (results, )
+    if results.failed:
+        sys.exit(1)
@@ -0,0 +1,84 @@
+import base64
+import hashlib
+import struct
+
+from mailpile.i18n import gettext as _
+from mailpile.i18n import ngettext as _n
+
+
+class BloomFilter(object):
+    """
+    A Bloom filter: a compact set which can tell us that a key is
+    definitely absent, or that it is probably present.
+
+    >>> bf = BloomFilter.Build(['hello', 'world'])
+    >>> 'hello' in bf, 'world' in bf, 'mailpile' in bf
+    (True, True, False)
+    >>> bf.add('mailpile')
+    >>> 'mailpile' in bf
+    True
+
+    Filters can be serialized to and from a short ASCII string:
+
+    >>> bf2 = BloomFilter.Parse(bf.dumps())
+    >>> 'mailpile' in bf2, 'bogus' in bf2, bf2.bits == bf.bits
+    (True, False, True)
+    """
+    BITS_PER_KEY = 10
+    HASHES = 5
+    MIN_BITS = 64
+
+    __slots__ = ('bits', 'hashes', 'data')
+
+    def __init__(self, capacity=0, hashes=None, data=None):
+        if data is not None:
+            self.data = bytearray(data)
+        else:
+            nbytes = max(self.MIN_BITS, capacity * self.BITS_PER_KEY) // 8
+            self.data = bytearray(nbytes)
+        self.bits = len(self.data) * 8
+        self.hashes = hashes or self.HASHES
+
+    @classmethod
+    def Build(cls, keys):
+        keys = list(keys)
+        bf = cls(capacity=len(keys))
+        for key in keys:
+            bf.add(key)
+        return bf
+
+    @classmethod
+    def Parse(cls, text):
+        hashes, data = text.split(':', 1)
+        return cls(hashes=int(hashes), data=base64.b64decode(data))
+
+    def dumps(self):
+        return '%d:%s' % (self.hashes, base64.b64encode(str(self.data)))
+
+    def _positions(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        h1, h2 = struct.unpack('>QQ', hashlib.md5(key).digest())
+        return [(h1 + i * h2) % self.bits for i in range(0, self.hashes)]
+
+    def add(self, key):
+        data = self.data
+        for pos in self._positions(key):
+            data[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        data = self.data
+        for pos in self._positions(key):
+            if not data[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+
+if __name__ == '__main__':
+    import doctest
+    import sys
+    results = doctest.testmod(optionflags=doctest.ELLIPSIS,
+                              extraglobs={})
+    print '%s' % (results, )
+    if results.failed:
+        sys.exit(1)
@@ -0,0 +1,113 @@
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    A dictionary of limited size, which evicts the least recently used
+    entries first. Lookups, insertions and evictions are all O(1).
+
+    >>> c = LRUCache(2)
+    >>> c[1] = 'a'; c[2] = 'b'
+    >>> c.get(1)
+    'a'
+    >>> c[3] = 'c'
+    >>> sorted(c.keys()), c.get(2)
+    ([1, 3], None)
+    >>> c.discard(1); c.discard(1)
+    >>> len(c), c.hits, c.misses, c.evictions
+    (1, 1, 1, 1)
+    """
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.hits = self.misses = self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def keys(self):
+        return self._data.keys()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                # Re-inserting moves the entry to the end of the LRU order
+                value = self._data[key] = self._data.pop(key)
+                self.hits += 1
+                return value
+            except KeyError:
+                self.misses += 1
+                return default
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > max(1, self.max_entries):
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def discard(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {
+            'entries': len(self._data),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions}
+
+
+class MessageCache(object):
+    """
+    Caches for data derived from the metadata index, keyed by message
+    index position: parsed msg_info lists, and the metadata rendered from
+    them for search results. The metadata is more expensive to produce
+    and needed less often, so the two are kept (and evicted) separately.
+
+    >>> mc = MessageCache(10)
+    >>> mc.info[5] = ['msg_info']; mc.metadata[5] = {'mid': '5'}
+    >>> mc.discard(5)
+    >>> 5 in mc.info, 5 in mc.metadata
+    (False, False)
+    """
+    def __init__(self, max_entries):
+        self.info = LRUCache(max_entries)
+        self.metadata = LRUCache(max_entries)
+
+    def resize(self, max_entries):
+        self.info.max_entries = self.metadata.max_entries = max_entries
+
+    def discard(self, msg_idx):
+        self.info.discard(msg_idx)
+        self.metadata.discard(msg_idx)
+
+    def clear(self):
+        self.info.clear()
+        self.metadata.clear()
+
+    def stats(self):
+        return {
+            'info': self.info.stats(),
+            'metadata': self.metadata.stats()}
+
+
+if __name__ == '__main__':
+    import doctest
+    import sys
+    results = doctest.testmod(optionflags=doctest.ELLIPSIS,
+                              extraglobs={})
+    print '%s' % (results, )
+    if results.failed:
+        sys.exit(1)
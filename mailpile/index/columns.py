@@ -0,0 +1,438 @@
+from array import array
+
+from mailpile.i18n import gettext as _
+from mailpile.i18n import ngettext as _n
+from mailpile.index.msginfo import MessageInfoConstants
+from mailpile.util import b36
+
+
+class HeapColumn(object):
+    """
+    A column of strings backed by a buffer (a string or an mmap): the
+    strings are stored back to back in a heap, and an array of offsets
+    says where each one starts. Strings are only sliced out of the buffer
+    when they are used. Changes and additions are kept in memory.
+
+    >>> hc = HeapColumn.Build(['abc', '', 'de'])
+    >>> len(hc), hc[0], hc[1], hc[2]
+    (3, 'abc', '', 'de')
+    >>> hc[1] = 'x'
+    >>> hc.append('fgh')
+    >>> list(hc)
+    ['abc', 'x', 'de', 'fgh']
+    """
+    __slots__ = ('data', 'offsets', 'base', 'count', 'changed', 'appended')
+
+    def __init__(self, data, offsets, base=0):
+        self.data = data
+        self.offsets = offsets
+        self.base = base
+        self.count = max(0, len(offsets) - 1)
+        self.changed = {}
+        self.appended = []
+
+    @classmethod
+    def Build(cls, strings):
+        offsets, heap, pos = array('l', [0]), [], 0
+        for string in strings:
+            heap.append(string)
+            pos += len(string)
+            offsets.append(pos)
+        return cls(''.join(heap), offsets)
+
+    def __len__(self):
+        return self.count + len(self.appended)
+
+    def __getitem__(self, pos):
+        if pos < 0:
+            pos += len(self)
+        if pos >= self.count:
+            return self.appended[pos - self.count]
+        string = self.changed.get(pos)
+        if string is None:
+            base, offsets = self.base, self.offsets
+            string = self.data[base + offsets[pos]:base + offsets[pos + 1]]
+        return string
+
+    def __setitem__(self, pos, string):
+        if pos < 0:
+            pos += len(self)
+        if pos >= self.count:
+            self.appended[pos - self.count] = string
+        else:
+            self.changed[pos] = string
+
+    def __iter__(self):
+        for pos in xrange(0, len(self)):
+            yield self[pos]
+
+    def append(self, string):
+        self.appended.append(string)
+
+    def decode_all(self):
+        """
+        Return a list of all the strings, decoded from UTF-8. If the heap
+        is pure ASCII, it is decoded in one go and then sliced.
+
+        >>> HeapColumn.Build(['abc', 'de']).decode_all()
+        [u'abc', u'de']
+        """
+        data, base, offsets = self.data, self.base, self.offsets
+        raw = data[base + offsets[0]:base + offsets[self.count]]
+        text = raw.decode('utf-8')
+        if len(text) == len(raw):
+            start = offsets[0]
+            strings = [text[offsets[i] - start:offsets[i + 1] - start]
+                       for i in xrange(0, self.count)]
+            for pos, string in self.changed.iteritems():
+                strings[pos] = string.decode('utf-8')
+            strings.extend(s.decode('utf-8') for s in self.appended)
+            return strings
+        return [s.decode('utf-8') for s in self]
+
+
+class StringTable(object):
+    """
+    A table of interned strings: each distinct string is stored once and
+    referred to by its position in the table. The strings may be a list
+    or a HeapColumn; the reverse mapping is only built once something
+    new gets interned.
+
+    >>> st = StringTable()
+    >>> st.intern('hello'), st.intern('world'), st.intern('hello')
+    (0, 1, 0)
+    >>> st[1], len(st)
+    ('world', 2)
+    """
+    __slots__ = ('strings', 'ids')
+
+    def __init__(self, strings=None):
+        self.strings = [] if (strings is None) else strings
+        self.ids = {} if (strings is None) else None
+
+    def intern(self, string):
+        if self.ids is None:
+            self.ids = dict((s, i) for i, s in enumerate(self.strings))
+        sid = self.ids.get(string)
+        if sid is None:
+            sid = self.ids[string] = len(self.strings)
+            self.strings.append(string)
+        return sid
+
+    def __getitem__(self, sid):
+        return self.strings[sid]
+
+    def __len__(self):
+        return len(self.strings)
+
+
+class MessageColumns(MessageInfoConstants):
+    """
+    The metadata index, stored one column per field instead of one line of
+    text per message.
+
+    Numeric fields (date, size, thread and parent) live in arrays of
+    machine integers. Fields which repeat a lot (senders, subjects, the
+    compacted To and Cc lists and tag sets) are interned, so each message
+    only costs an array slot for them. The remaining strings are kept in
+    plain lists or HeapColumns, UTF-8 encoded. Code which needs a msg_info
+    list gets a new one built from the columns; sorting, threading and
+    tagging can use the columns directly.
+
+    Conversations are linked lists of their messages, so a message joins
+    or leaves one in O(1) and listing one takes O(its size). The replies
+    field of a conversation's first message is generated from that list;
+    replies given to set() are ignored, and line() leaves them out.
+
+    >>> mc = MessageColumns()
+    >>> mc.set(2, [u'2', u'ptr', u'msgid', u'ABC', u'Bjarni <b@a.is>',
+    ...            u'1,2', u'', u'3', u'Hello\\tworld', u'Body', u'1,3',
+    ...            u'', u'1/-'])
+    >>> len(mc), mc.dates[2], mc.threads[2], mc.tag_list(2), mc.exists(1)
+    (3, 13368, 1, [u'1', u'3'], False)
+    >>> mc.get(2)[3:9]
+    [u'ABC', u'Bjarni <b@a.is>', u'1,2', u'', u'3', u'Hello world']
+    >>> mc.get(1)
+    Traceback (most recent call last):
+      ...
+    ValueError: No message at 1
+    >>> mc.line(2).split('\\t')[8:], mc.line(1)
+    (['Hello world', 'Body', '1,3', '', '1/-'], '')
+
+    >>> for pos, thread in ((1, u'1'), (3, u'1/2')):
+    ...     mc.set(pos, [b36(pos), u'', u'id', u'1', u'', u'', u'', u'0',
+    ...                  u'', u'', u'', u'9,', thread])
+    >>> mc.thread_members(1), mc.get(1)[11], mc.get(3)[11]
+    ([1, 2, 3], u'2,3,', u'')
+    >>> mc.line(1).split('\\t')[10:]
+    ['', '', '1']
+    >>> mc.set(2, mc.get(2)[:12] + [u'2'])
+    >>> mc.thread_members(1), mc.thread_members(2), mc.get(1)[11]
+    ([1, 3], [2], u'3,')
+
+    Values which would not survive a round trip through the numeric
+    columns are kept as they were:
+
+    >>> mc.set(0, [u'0', u'', u'x', u'-5', u'', u'', u'', u'0', u'', u'',
+    ...            u'', u'', u'0/2'])
+    >>> mc.get(0)[3], mc.dates[0], mc.get(0)[12]
+    (u'-5', 0, u'0/2')
+    """
+
+    # A translation table for message parts stored in the index, consists of
+    # a mapping from unicode ordinals to either another unicode ordinal or
+    # None, to remove a character. By default it removes the ASCII control
+    # characters and replaces tabs and newlines with spaces.
+    NORM_TABLE = dict([(i, None) for i in range(0, 0x20)], **{
+        ord(u'\t'): ord(u' '),
+        ord(u'\r'): ord(u' '),
+        ord(u'\n'): ord(u' '),
+        0x7F: None
+    })
+
+    NO_PARENT = -1
+    UNTHREADED = -2
+
+    def __init__(self):
+        self.msg_ids = []
+        self.ptrs = []
+        self.bodies = []
+        self.dates = array('l')
+        self.kbs = array('l')
+        self.threads = array('l')
+        self.parents = array('l')
+        self.froms = array('l')
+        self.tos = array('l')
+        self.ccs = array('l')
+        self.subjects = array('l')
+        self.tags = array('l')
+        # The messages of a conversation, by thread ID and then position
+        self.thread_first = array('l')
+        self.thread_next = array('l')
+        self.thread_prev = array('l')
+        self.senders = StringTable()
+        self.subject_table = StringTable()
+        self.address_table = StringTable()
+        self.tag_table = StringTable()
+        self._tag_lists = {}
+        # msg_idx -> {field: value}, for values which are not canonical
+        self.extra = {}
+
+    def __len__(self):
+        return len(self.msg_ids)
+
+    def exists(self, pos):
+        return (0 <= pos < len(self.msg_ids) and
+                self.msg_ids[pos] is not None)
+
+    def _grow(self, pos):
+        while len(self.msg_ids) <= pos:
+            self.msg_ids.append(None)
+            for col in (self.ptrs, self.bodies):
+                col.append('')
+            for col in (self.dates, self.kbs, self.parents,
+                        self.froms, self.tos, self.ccs, self.subjects,
+                        self.tags):
+                col.append(0)
+            for col in (self.threads, self.thread_next, self.thread_prev):
+                col.append(-1)
+
+    def _link(self, pos):
+        thread = self.threads[pos]
+        if thread < 0:
+            return
+        while len(self.thread_first) <= thread:
+            self.thread_first.append(-1)
+        first = self.thread_first[thread]
+        self.thread_next[pos] = first
+        self.thread_prev[pos] = -1
+        if first >= 0:
+            self.thread_prev[first] = pos
+        self.thread_first[thread] = pos
+
+    def _unlink(self, pos):
+        thread = self.threads[pos]
+        if thread < 0:
+            return
+        prev, next = self.thread_prev[pos], self.thread_next[pos]
+        if prev >= 0:
+            self.thread_next[prev] = next
+        else:
+            self.thread_first[thread] = next
+        if next >= 0:
+            self.thread_prev[next] = prev
+        self.thread_next[pos] = self.thread_prev[pos] = -1
+
+    def relink_threads(self):
+        """Rebuild the conversation lists from the threads column."""
+        count = len(self.msg_ids)
+        self.thread_first = array('l')
+        self.thread_next = array('l', [-1]) * count
+        self.thread_prev = array('l', [-1]) * count
+        for pos in reversed(xrange(0, count)):
+            if self.msg_ids[pos] is not None:
+                self._link(pos)
+
+    def thread_members(self, thread):
+        """Return the positions of all messages in a conversation."""
+        members = []
+        if 0 <= thread < len(self.thread_first):
+            pos = self.thread_first[thread]
+            while pos >= 0:
+                members.append(pos)
+                pos = self.thread_next[pos]
+        members.sort()
+        return members
+
+    def reply_list(self, pos):
+        """The other messages of the conversation pos is the first of."""
+        if self.msg_ids[pos] is None or self.threads[pos] != pos:
+            return []
+        return [m for m in self.thread_members(pos) if m != pos]
+
+    def _set_number(self, extra, field, column, pos, value):
+        try:
+            number = int(value, 36)
+            if b36(number) == value:
+                column[pos] = number
+                return
+        except (ValueError, OverflowError):
+            pass
+        column[pos] = 0
+        extra[field] = value
+
+    def _thread_mid(self, pos):
+        thread_mid = unicode(b36(self.threads[pos]))
+        parent = self.parents[pos]
+        if parent == self.NO_PARENT:
+            return thread_mid
+        elif parent == self.UNTHREADED:
+            return thread_mid + u'/-'
+        return u'%s/%s' % (thread_mid, b36(parent))
+
+    def set(self, pos, msg_info, normalized=False):
+        """
+        Store a msg_info list at a given position, normalizing the strings
+        the same way they would be when written to disk.
+        """
+        if len(msg_info) != self.MSG_FIELDS_V2:
+            raise ValueError('Bad metadata')
+        if not normalized:
+            msg_info = [unicode(p).translate(self.NORM_TABLE)
+                        for p in msg_info]
+
+        # Parse the thread first, it is the only thing which may fail
+        thread_parts = msg_info[self.MSG_THREAD_MID].split(u'/')
+        thread = int(thread_parts[0], 36)
+        parent = self.NO_PARENT
+        if len(thread_parts) == 2:
+            if thread_parts[1] == u'-':
+                parent = self.UNTHREADED
+            else:
+                try:
+                    parent = int(thread_parts[1], 36)
+                except ValueError:
+                    pass
+
+        self._grow(pos)
+        linked = (self.msg_ids[pos] is not None)
+        extra = {}
+        if msg_info[self.MSG_MID] != b36(pos):
+            extra[self.MSG_MID] = msg_info[self.MSG_MID]
+        self.msg_ids[pos] = msg_info[self.MSG_ID]
+        self.ptrs[pos] = msg_info[self.MSG_PTRS].encode('utf-8')
+        self.bodies[pos] = msg_info[self.MSG_BODY].encode('utf-8')
+        self._set_number(extra, self.MSG_DATE, self.dates, pos,
+                         msg_info[self.MSG_DATE])
+        self._set_number(extra, self.MSG_KB, self.kbs, pos,
+                         msg_info[self.MSG_KB])
+        self.froms[pos] = self.senders.intern(
+            msg_info[self.MSG_FROM].encode('utf-8'))
+        self.tos[pos] = self.address_table.intern(
+            msg_info[self.MSG_TO].encode('utf-8'))
+        self.ccs[pos] = self.address_table.intern(
+            msg_info[self.MSG_CC].encode('utf-8'))
+        self.subjects[pos] = self.subject_table.intern(
+            msg_info[self.MSG_SUBJECT].encode('utf-8'))
+        self.tags[pos] = self.tag_table.intern(
+            msg_info[self.MSG_TAGS].encode('utf-8'))
+        if not linked or self.threads[pos] != thread:
+            if linked:
+                self._unlink(pos)
+            self.threads[pos] = thread
+            self._link(pos)
+        self.parents[pos] = parent
+        if self._thread_mid(pos) != msg_info[self.MSG_THREAD_MID]:
+            extra[self.MSG_THREAD_MID] = msg_info[self.MSG_THREAD_MID]
+
+        if extra:
+            self.extra[pos] = extra
+        elif pos in self.extra:
+            del self.extra[pos]
+
+    def set_tags(self, pos, tags):
+        """Update just the tags of a message, given a list of tag IDs."""
+        if self.msg_ids[pos] is None:
+            raise ValueError('No message at %d' % pos)
+        self.tags[pos] = self.tag_table.intern(
+            u','.join(tags).translate(self.NORM_TABLE).encode('utf-8'))
+
+    def ptr_list(self):
+        """Return the message pointers of every message, decoded."""
+        if isinstance(self.ptrs, HeapColumn):
+            return self.ptrs.decode_all()
+        return [p.decode('utf-8') for p in self.ptrs]
+
+    def tag_list(self, pos):
+        """Return the tag IDs of a message, without building a msg_info."""
+        if self.msg_ids[pos] is None:
+            return []
+        tid = self.tags[pos]
+        tag_list = self._tag_lists.get(tid)
+        if tag_list is None:
+            tag_list = self._tag_lists[tid] = [
+                t for t in self.tag_table[tid].decode('utf-8').split(u',')
+                if t]
+        return tag_list[:]
+
+    def get(self, pos, replies=True):
+        """Build a msg_info list for the message at a given position."""
+        msg_id = self.msg_ids[pos]
+        if msg_id is None:
+            raise ValueError('No message at %d' % pos)
+        msg_info = [
+            unicode(b36(pos)),
+            self.ptrs[pos].decode('utf-8'),
+            msg_id,
+            unicode(b36(self.dates[pos])),
+            self.senders[self.froms[pos]].decode('utf-8'),
+            self.address_table[self.tos[pos]].decode('utf-8'),
+            self.address_table[self.ccs[pos]].decode('utf-8'),
+            unicode(b36(self.kbs[pos])),
+            self.subject_table[self.subjects[pos]].decode('utf-8'),
+            self.bodies[pos].decode('utf-8'),
+            self.tag_table[self.tags[pos]].decode('utf-8'),
+            u''.join(u'%s,' % b36(r) for r in self.reply_list(pos))
+            if replies else u'',
+            self._thread_mid(pos)]
+        extra = self.extra.get(pos)
+        if extra:
+            for field, value in extra.iteritems():
+                msg_info[field] = value
+        return msg_info
+
+    def line(self, pos):
+        """Return the message at a given position as a line of text."""
+        if self.msg_ids[pos] is None:
+            return ''
+        return (u'\t'.join(self.get(pos, replies=False))).encode('utf-8')
+
+
+if __name__ == '__main__':
+    import doctest
+    import sys
+    results = doctest.testmod(optionflags=doctest.ELLIPSIS,
+                              extraglobs={})
+    print '%s' % (results, )
+    if results.failed:
+        sys.exit(1)
@@ -0,0 +1,180 @@
+from hashlib import md5 as _md5
+import struct
+import threading
+from array import array
+
+
+class DigestMap(object):
+    """
+    A compact hash table mapping strings to non-negative integers, such
+    as message IDs or mailbox pointers to message index positions.
+
+    Keys are not stored, only a fixed-width digest of each. The digests
+    live back to back in a bytearray and the values in an array, and
+    collisions are resolved by linear probing. This takes a small
+    fraction of the memory of a dict with its key strings, and the
+    table can be saved and loaded as two flat strings. The price is
+    that the keys cannot be listed.
+
+    >>> dm = DigestMap()
+    >>> dm['<a@b>'] = 1; dm[u'<b@b>'] = 2
+    >>> dm['<a@b>'], dm.get('<c@b>'), '<b@b>' in dm, len(dm)
+    (1, None, True, 2)
+    >>> del dm['<a@b>']
+    >>> dm.get('<a@b>', -1), len(dm)
+    (-1, 1)
+    >>> for i in range(0, 1000):
+    ...     dm['%d' % i] = i
+    >>> dm['999'], len(dm), dm.slots
+    (999, 1001, 2048)
+    >>> dm2 = DigestMap(*dm.dump())
+    >>> dm2['999'], dm2['<b@b>'], len(dm2)
+    (999, 2, 1001)
+    """
+    WIDTH = 12
+    EMPTY = -1
+    DELETED = -2
+    MIN_SLOTS = 16
+
+    _HASH = struct.Struct('<Q')
+
+    def __init__(self, digests=None, values=None):
+        self._lock = threading.Lock()
+        if values is None:
+            self._table = self._empty(self.MIN_SLOTS)
+            self.count = self.used = 0
+        else:
+            if len(digests) != len(values) * self.WIDTH:
+                raise ValueError('Digests and values do not match')
+            self._table = (bytearray(digests), values)
+            self.used = len(values) - values.count(self.EMPTY)
+            self.count = self.used - values.count(self.DELETED)
+
+    @classmethod
+    def _empty(cls, slots):
+        return (bytearray(slots * cls.WIDTH),
+                array('l', [cls.EMPTY]) * slots)
+
+    @classmethod
+    def digest(cls, key):
+        # MD5 is fine here: message IDs are hashed with SHA1 before they
+        # get this far, and we generate the mailbox pointers ourselves.
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return _md5(key).digest()[:cls.WIDTH]
+
+    @classmethod
+    def _find(cls, table, digest):
+        """
+        Return the slot holding the digest (or -1) and the first slot it
+        could be inserted at.
+        """
+        digests, values = table
+        width, mask = cls.WIDTH, len(values) - 1
+        slot = cls._HASH.unpack_from(digest)[0] & mask
+        free = -1
+        while True:
+            value = values[slot]
+            if value >= 0:
+                pos = slot * width
+                if digests[pos:pos + width] == digest:
+                    return slot, free
+            elif value == -1:  # EMPTY
+                return -1, (slot if (free < 0) else free)
+            elif free < 0:  # DELETED
+                free = slot
+            slot = (slot + 1) & mask
+
+    @classmethod
+    def _set(cls, table, slot, digest, value):
+        # The digest goes first, so lookups which do not lock never see
+        # a value next to the wrong digest.
+        table[0][slot * cls.WIDTH:(slot + 1) * cls.WIDTH] = digest
+        table[1][slot] = value
+
+    def _resize(self, slots):
+        (digests, values), width = self._table, self.WIDTH
+        table = self._empty(slots)
+        new_digests, new_values = table
+        unpack_from, mask = self._HASH.unpack_from, slots - 1
+        for slot in xrange(0, len(values)):
+            value = values[slot]
+            if value >= 0:
+                # Every digest is unique, so we just need a free slot.
+                digest = digests[slot * width:(slot + 1) * width]
+                new = unpack_from(digest)[0] & mask
+                while new_values[new] != self.EMPTY:
+                    new = (new + 1) & mask
+                new_digests[new * width:(new + 1) * width] = digest
+                new_values[new] = value
+        # Lookups see either the old table or the new one, never a mix.
+        self._table = table
+        self.used = self.count
+
+    @property
+    def slots(self):
+        return len(self._table[1])
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, key):
+        return (self._find(self._table, self.digest(key))[0] >= 0)
+
+    def get(self, key, default=None):
+        table = self._table
+        slot = self._find(table, self.digest(key))[0]
+        return default if (slot < 0) else table[1][slot]
+
+    def __getitem__(self, key):
+        table = self._table
+        slot = self._find(table, self.digest(key))[0]
+        if slot < 0:
+            raise KeyError(key)
+        return table[1][slot]
+
+    def __setitem__(self, key, value):
+        if value < 0:
+            raise ValueError('Values must be non-negative')
+        digest = self.digest(key)
+        with self._lock:
+            table = self._table
+            slot, free = self._find(table, digest)
+            if slot >= 0:
+                table[1][slot] = value
+                return
+            if table[1][free] == self.EMPTY:
+                self.used += 1
+            self._set(table, free, digest, value)
+            self.count += 1
+            if 3 * self.used > 2 * len(table[1]):
+                # Grow, unless we are mostly full of deleted entries.
+                slots = len(table[1])
+                while 2 * self.count > slots:
+                    slots *= 2
+                self._resize(slots)
+
+    def __delitem__(self, key):
+        digest = self.digest(key)
+        with self._lock:
+            table = self._table
+            slot = self._find(table, digest)[0]
+            if slot < 0:
+                raise KeyError(key)
+            table[1][slot] = self.DELETED
+            self.count -= 1
+
+    def dump(self):
+        """Return the table as (digests, values), for saving."""
+        digests, values = self._table
+        return str(digests), array('l', values)
+
+
+if __name__ == '__main__':
+    import doctest
+    import sys
+    results = doctest.testmod(optionflags=doctest.ELLIPSIS,
+                              extraglobs={})
+    print '%s' % (results, )
+    if results.failed:
+        sys.exit(1)
@@ -0,0 +1,308 @@
+import cStringIO
+import email.message
+import multiprocessing
+import signal
+import sys
+import time
+import traceback
+from itertools import islice
+
+import mailpile.util
+from mailpile.i18n import gettext as _
+from mailpile.i18n import ngettext as _n
+from mailpile.mailutils import ParseMessage, NoSuchMailboxError, MBX_ID_LEN
+from mailpile.mailutils.safe import *
+from mailpile.postinglist import GlobalPostingList, PostingListSegment
+from mailpile.util import *
+from mailpile.vcard import AddressInfo
+
+
+# The session and index used by the workers. These are set before the
+# pool is created, so forked workers inherit them instead of having them
+# pickled and sent over a pipe.
+WORKER_STATE = {}
+
+THREADING_HEADERS = ('in-reply-to', 'references')
+
+
+def _WorkerInit():
+    # The parent process handles CTRL-C and terminates the pool.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _ParseAndExtract(job):
+    """
+    Parse a message and extract its metadata and search keywords. This
+    runs in the worker processes, so it returns plain picklable data.
+
+    Messages without a usable date are dated after the message before
+    them, which only the writer knows. Unless the job has a default date,
+    those are handed back as (msg_ptr, msg_id, None, job).
+    """
+    session, idx = WORKER_STATE['session'], WORKER_STATE['index']
+    (mailbox_idx, msg_ptr, msg_data, msg_metadata_kws, default_date,
+     process_new, apply_tags) = job
+    try:
+        msg = ParseMessage(cStringIO.StringIO(msg_data),
+            pgpmime=(session.config.prefs.index_encrypted and 'all'),
+            config=session.config)
+        msg_id = idx.get_msg_id(msg, msg_ptr)
+        if default_date is None and not safe_message_ts(msg):
+            return (msg_ptr, msg_id, None, job)
+
+        # Messages have no MID yet; the writer assigns those.
+        (msg_ts, msg_to, msg_cc, msg_subj, msg_body, tags, keywords
+         ) = idx._extract_info_and_keywords(session, mailbox_idx,
+                                            '0', msg_id,
+                                            len(msg_data), msg,
+                                            msg_metadata_kws, default_date,
+                                            index=False, incoming=True,
+                                            process_new=process_new,
+                                            apply_tags=apply_tags)
+        return (msg_ptr, msg_id, msg_ts,
+                safe_decode_hdr(msg, 'from'),
+                [(ai.address, ai.fn) for ai in msg_to],
+                [(ai.address, ai.fn) for ai in msg_cc],
+                len(msg_data), msg_subj, msg_body, tags,
+                idx.searchable_keywords(keywords),
+                [(h, msg[h]) for h in THREADING_HEADERS if msg[h]])
+    except (IOError, OSError, ValueError, IndexError, KeyError):
+        if session.config.sys.debug:
+            traceback.print_exc()
+        return (msg_ptr, None)
+
+
+class IndexRebuilder(object):
+    """
+    Rebuild the metadata index and the search index from scratch.
+
+    Parsing messages and extracting keywords is CPU bound, so that work
+    is spread over a pool of worker processes, a batch at a time so parsed
+    messages do not pile up faster than they are written. A single writer
+    (this object, in the main process) reads the mailboxes, assigns message
+    IDs in mailbox order and accumulates the posting lists in memory. The
+    posting lists are written out in sig order as staged search segments
+    whenever they grow past SPILL_POSTINGS, bypassing the keyword journal
+    entirely.
+
+    Nothing is replaced until install() is called, at which point the new
+    index is saved in place of the old one. Tags are carried over from the
+    old index for messages it knows about; other messages are tagged and
+    filtered as a rescan of their mailbox would.
+    """
+    SPILL_POSTINGS = 4 * 1024 * 1024
+    CHUNK_SIZE = 16
+    BATCH_SIZE = 1024
+
+    def __init__(self, session, old_idx, processes=None):
+        from mailpile.search import MailIndex
+        self.session = session
+        self.config = session.config
+        self.old_idx = old_idx
+        self.idx = MailIndex(self.config)
+        self.processes = max(1, processes or multiprocessing.cpu_count())
+        self.postings = {}
+        self.posting_count = 0
+        self.staged = []
+        self.errors = 0
+        self.start_date = long(time.time())
+        self.last_dates = {}
+
+    def _scan_args(self, mailbox_idx, src):
+        """The process_new and apply_tags a rescan of the mailbox uses."""
+        if not src or src.mailbox[mailbox_idx] is None:
+            return None, None
+        mbx_cfg = src.mailbox[mailbox_idx]
+        apply_tags = mbx_cfg.apply_tags[:]
+        for tag in (src.discovery.parent_tag, mbx_cfg.primary_tag):
+            tid = tag and self.config.get_tag_id(tag)
+            if tid:
+                apply_tags.append(tid)
+        return (None if mbx_cfg.process_new else False), apply_tags
+
+    def _read_messages(self, mailboxes):
+        session, config = self.session, self.config
+        for mailbox_idx, mailbox_fn, src in mailboxes:
+            process_new, apply_tags = self._scan_args(mailbox_idx, src)
+            try:
+                mbox = config.open_mailbox(session, mailbox_idx)
+                mbox.update_toc()
+            except (IOError, OSError, ValueError, NoSuchMailboxError), e:
+                session.ui.warning(_('%s: Error opening: %s (%s)'
+                                     ) % (mailbox_idx, mailbox_fn, e))
+                self.errors += 1
+                continue
+            for key in sorted(mbox.keys()):
+                if mailpile.util.QUITTING:
+                    return
+                try:
+                    msg_ptr = mbox.get_msg_ptr(mailbox_idx, key)
+                    msg_fd = mbox.get_file(key)
+                    msg_data = msg_fd.read()
+                    msg_fd.close()
+                    msg_metadata_kws = mbox.get_metadata_keywords(key)
+                except (IOError, OSError, ValueError, IndexError, KeyError):
+                    session.ui.warning(('Reading message %s/%s FAILED, '
+                                        'skipping') % (mailbox_idx, key))
+                    self.errors += 1
+                    continue
+                yield (mailbox_idx, msg_ptr, msg_data, msg_metadata_kws,
+                       None, process_new, apply_tags)
+
+    def _parse_in_batches(self, pool, jobs):
+        """
+        Parse the jobs in the pool. The next batch is parsed while the
+        results of the last one are written, and no more than that.
+        """
+        pending = None
+        while True:
+            batch = list(islice(jobs, self.BATCH_SIZE))
+            following = batch and pool.map_async(_ParseAndExtract, batch,
+                                                 self.CHUNK_SIZE)
+            if pending:
+                for result in pending.get():
+                    yield result
+            if not following:
+                return
+            pending = following
+
+    def _parse_undated(self, job):
+        # As in a rescan, a message without a usable date is assumed to
+        # follow the one before it in the mailbox.
+        mailbox_idx = job[0]
+        default_date = self.last_dates.get(mailbox_idx, self.start_date) + 1
+        return _ParseAndExtract(job[:4] + (default_date,) + job[5:])
+
+    def _add_message(self, result):
+        (msg_ptr, msg_id, msg_ts, msg_from, msg_to, msg_cc, msg_size,
+         msg_subj, msg_body, tags, keywords, threading) = result
+        idx = self.idx
+
+        old_idx_pos = self.old_idx.MSGIDS.get(msg_id)
+        if old_idx_pos is not None:
+            old_info = self.old_idx.get_msg_at_idx_pos(old_idx_pos)
+            tags = [t for t in old_info[idx.MSG_TAGS].split(',') if t]
+        msg_to = [AddressInfo(a, fn) for a, fn in msg_to]
+        msg_cc = [AddressInfo(a, fn) for a, fn in msg_cc]
+
+        msg_idx_pos = idx.MSGIDS.get(msg_id)
+        if msg_idx_pos is None:
+            msg_idx_pos, msg_info = idx.add_new_msg(
+                msg_ptr, msg_id, msg_ts, msg_from, msg_to, msg_cc,
+                msg_size, msg_subj, msg_body, tags)
+        else:
+            msg_info = idx.get_msg_at_idx_pos(msg_idx_pos)
+            if msg_info[idx.MSG_BODY] != idx.MSG_BODY_GHOST:
+                # Another copy of a message we already have
+                idx._update_location(self.session, msg_idx_pos, msg_ptr)
+                return False
+
+            # We created a ghost for this one while threading a reply
+            idx.edit_msg_info(msg_info,
+                              msg_ts=msg_ts,
+                              msg_from=msg_from,
+                              msg_to=msg_to,
+                              msg_cc=msg_cc,
+                              msg_subject=msg_subj,
+                              msg_body=msg_body,
+                              msg_size=msg_size,
+                              msg_tags=tags)
+            msg_info[idx.MSG_PTRS] = msg_ptr
+            idx._record_sender(msg_from, tags)
+            idx.set_msg_at_idx_pos(msg_idx_pos, msg_info)
+
+        self.last_dates[msg_ptr[:MBX_ID_LEN]] = msg_ts
+
+        msg = email.message.Message()
+        for hdr, value in threading:
+            msg[hdr] = value
+        idx.set_conversation_ids(msg_info[idx.MSG_MID], msg)
+
+        postings = self.postings
+        for word in keywords:
+            try:
+                sig = GlobalPostingList.WordSig(word, self.config)
+            except UnicodeDecodeError:
+                continue
+            if sig in postings:
+                postings[sig].append(msg_idx_pos)
+            else:
+                postings[sig] = [msg_idx_pos]
+        self.posting_count += len(keywords)
+        if self.posting_count > self.SPILL_POSTINGS:
+            self._spill()
+        return True
+
+    def _spill(self):
+        """Write the accumulated posting lists out as a staged segment."""
+        postings, self.postings, self.posting_count = self.postings, {}, 0
+        if postings:
+            self.session.ui.mark(_('Writing %d keywords to a new search '
+                                   'segment') % len(postings))
+            segment = PostingListSegment.Write(
+                self.session, PostingListSegment.MAX_TIER,
+                ((sig, sorted(set(postings[sig])))
+                 for sig in sorted(postings.keys())),
+                staged=True)
+            if segment is not None:
+                self.staged.append(segment)
+
+    def _discard(self):
+        for segment in self.staged:
+            safe_remove(segment.filename)
+        self.staged = []
+
+    def rebuild(self, mailboxes):
+        """
+        Rebuild from the given mailboxes, returning the new index. Nothing
+        is changed on disk until install() is called.
+        """
+        session = self.session
+        jobs = self._read_messages(mailboxes)
+
+        WORKER_STATE.update({'session': session, 'index': self.idx})
+        pool = None
+        if self.processes > 1 and sys.platform != 'win32':
+            pool = multiprocessing.Pool(self.processes, _WorkerInit)
+            results = self._parse_in_batches(pool, jobs)
+        else:
+            results = (_ParseAndExtract(job) for job in jobs)
+
+        count = 0
+        try:
+            for result in results:
+                if mailpile.util.QUITTING:
+                    raise KeyboardInterrupt()
+                if result[1] is not None and result[2] is None:
+                    result = self._parse_undated(result[3])
+                if result[1] is None:
+                    session.ui.warning(('Reading message %s FAILED, skipping'
+                                        ) % result[0])
+                    self.errors += 1
+                elif self._add_message(result):
+                    count += 1
+                    if (count % 97) == 0:
+                        session.ui.mark(_('Rebuilding index: %d messages')
+                                        % count)
+            if pool is not None:
+                pool.close()
+            self._spill()
+        except:
+            self._discard()
+            raise
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            WORKER_STATE.clear()
+
+        return self.idx
+
+    def install(self):
+        """Save the new index and replace the old one on disk."""
+        session = self.session
+        with self.old_idx._save_lock:
+            self.idx.save(session)
+            session.ui.mark(_('Installing the new search index'))
+            PostingListSegment.Install(session, self.staged)
+        self.staged = []
@@ -2,6 +2,7 @@ import time
 
 from mailpile.i18n import gettext as _
 from mailpile.i18n import ngettext as _n
+from mailpile.index.bitmap import Bitmap
 
 
 class SearchResultSet:
@@ -14,9 +15,10 @@ class SearchResultSet:
         self.set_results(results, exclude)
 
     def set_results(self, results, exclude):
+        results = Bitmap.Wrap(results)
         self._results = {
-            'raw': set(results),
-            'excluded': set(exclude) & set(results)
+            'raw': results,
+            'excluded': results & exclude
         }
         return self
 
@@ -29,6 +31,14 @@ class SearchResultSet:
     def excluded(self):
         return self._results['excluded']
 
+    def sorted(self, order):
+        """Return a copy of the results as sorted in a given order, or None."""
+        results = self._results.get('sorted:%s' % order)
+        return None if (results is None) else results[:]
+
+    def set_sorted(self, order, results):
+        self._results['sorted:%s' % order] = results[:]
+
 
 SEARCH_RESULT_CACHE = {}
 
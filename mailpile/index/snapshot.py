@@ -0,0 +1,327 @@
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+from mailpile.crypto.streamer import EncryptingStreamer
+from mailpile.i18n import gettext as _
+from mailpile.i18n import ngettext as _n
+from mailpile.index.columns import HeapColumn, StringTable, MessageColumns
+from mailpile.index.digestmap import DigestMap
+from mailpile.util import decrypt_blocks, split_encrypted_blocks
+
+
+class MetadataSnapshot(object):
+    """
+    A binary snapshot of the metadata index.
+
+    File layout: MAGIC, a fixed-size header (generation, message count,
+    integer size and byte order), a table of (offset, length) pairs, one
+    per section, and finally the sections themselves. Each numeric column
+    is a section holding the raw machine integers of its array. Each
+    string column is a pair of sections: an array of offsets and a heap
+    of UTF-8 strings stored back to back. The MSGIDS and PTRS maps are
+    stored as the raw tables of their DigestMaps, and conversations as the
+    arrays linking their messages, so none of those need rebuilding on
+    load.
+
+    Unencrypted snapshots are mmapped. Encrypted snapshots are written as
+    a series of independently encrypted blocks, which are decrypted into
+    memory in parallel. Either way, loading copies the numeric columns
+    and leaves the strings in the buffer until they are used.
+
+    >>> import tempfile
+    >>> cfg = type('Config', (object, ), {'master_key': None})()
+    >>> mc = MessageColumns()
+    >>> mc.set(1, [u'1', u'0001:1', u'<a@b>', u'ABC', u'Bjarni <b@a.is>',
+    ...            u'1,2', u'', u'3', u'Hello', u'Body', u'1,3', u'', u'1'])
+    >>> fn = tempfile.mktemp()
+    >>> MetadataSnapshot.Write(cfg, fn, 'gen1', mc,
+    ...                        [u'b@a.is (Bjarni)'], [1])
+    >>> snap = MetadataSnapshot(cfg, fn)
+    >>> snap.generation, snap.count, snap.emails(), snap.deleted()
+    ('gen1', 2, [u'b@a.is (Bjarni)'], [1])
+    >>> mc2 = snap.columns()
+    >>> mc2.exists(0), mc2.get(1) == mc.get(1), mc2.line(1) == mc.line(1)
+    (False, True, True)
+    >>> mc2.thread_members(1)
+    [1]
+    >>> snap.digest_map('msgids') is None
+    True
+    >>> msgids = DigestMap(); msgids[u'ABC'] = 1
+    >>> MetadataSnapshot.Write(cfg, fn, 'gen2', mc, [], [],
+    ...                        digest_maps={'msgids': msgids})
+    >>> MetadataSnapshot(cfg, fn).digest_map('msgids').get('ABC')
+    1
+    >>> os.remove(fn)
+    """
+    MAGIC = 'MPIDX03\n'
+    MAGIC_V2 = 'MPIDX02\n'
+    MAGIC_V1 = 'MPIDX01\n'
+    ENCRYPTED_BLOCK_SIZE = 4 * 1024 * 1024
+    HEADER = struct.Struct('<32sIBB')
+    SECTION = struct.Struct('<QQ')
+
+    NUMERIC_COLUMNS = ('dates', 'kbs', 'threads', 'parents',
+                       'froms', 'tos', 'ccs', 'subjects', 'tags')
+    THREAD_COLUMNS = ('thread_first', 'thread_next', 'thread_prev')
+    STRING_COLUMNS = ('msg_ids', 'ptrs', 'bodies')
+    STRING_TABLES = ('senders', 'subject_table', 'address_table',
+                     'tag_table')
+    DIGEST_MAPS = ('msgids', 'ptrs')
+    DIGEST_SECTIONS = tuple('%s%s' % (n, p) for n in DIGEST_MAPS
+                            for p in ('.digests', '.values'))
+    SECTIONS = (NUMERIC_COLUMNS + THREAD_COLUMNS +
+                tuple('%s%s' % (n, p) for n in (STRING_COLUMNS +
+                                                STRING_TABLES +
+                                                ('emails',))
+                      for p in ('.offsets', '')) +
+                ('deleted', 'extra') + DIGEST_SECTIONS)
+
+    # Older snapshots kept replies as strings, and no conversation lists
+    SECTIONS_V1 = (NUMERIC_COLUMNS +
+                   tuple('%s%s' % (n, p) for n in (STRING_COLUMNS +
+                                                   ('replies',) +
+                                                   STRING_TABLES +
+                                                   ('emails',))
+                         for p in ('.offsets', '')) +
+                   ('deleted', 'extra'))
+    SECTIONS_V2 = SECTIONS_V1 + DIGEST_SECTIONS
+
+    # Message IDs are never empty, this marks gaps in the index
+    NO_MSG_ID = '\0'
+
+    @classmethod
+    def _Heap(cls, strings):
+        heap = HeapColumn.Build(strings)
+        return [heap.offsets.tostring(), heap.data]
+
+    @classmethod
+    def Write(cls, config, filename, generation, columns, emails, deleted,
+              digest_maps=None, fsync=False):
+        """Write a snapshot of the given columns, e-mails and deletions."""
+        cls.WriteCollected(config, filename, generation,
+                           cls.Collect(columns, emails, deleted,
+                                       digest_maps=digest_maps),
+                           fsync=fsync)
+
+    @classmethod
+    def WriteCollected(cls, config, filename, generation, collected,
+                       fsync=False):
+        """
+        Write a snapshot of data gathered by Collect(). This does not
+        touch the index itself, so it can be done without holding any
+        locks.
+        """
+        count, sections = collected
+        offset = (len(cls.MAGIC) + cls.HEADER.size +
+                  len(cls.SECTIONS) * cls.SECTION.size)
+        table = []
+        for name in cls.SECTIONS:
+            table.append(cls.SECTION.pack(offset, len(sections[name])))
+            offset += len(sections[name])
+
+        chunks = ([cls.MAGIC,
+                   cls.HEADER.pack(generation, count,
+                                   array('l').itemsize,
+                                   sys.byteorder == 'big'),
+                   ''.join(table)] +
+                  [sections[name] for name in cls.SECTIONS])
+        encryption_key = config.master_key
+        with open(filename, 'wb') as fd:
+            if encryption_key:
+                for block in cls._Blocks(chunks):
+                    with EncryptingStreamer(encryption_key,
+                                            delimited=True) as es:
+                        es.write(block)
+                        es.finish()
+                        fd.write(es.save(None))
+            else:
+                for chunk in chunks:
+                    fd.write(chunk)
+            if fsync:
+                fd.flush()
+                os.fsync(fd.fileno())
+
+    @classmethod
+    def _Blocks(cls, chunks):
+        """Regroup a list of strings into blocks of ENCRYPTED_BLOCK_SIZE."""
+        block, size = [], 0
+        for chunk in chunks:
+            pos = 0
+            while pos < len(chunk):
+                part = chunk[pos:pos + cls.ENCRYPTED_BLOCK_SIZE - size]
+                block.append(part)
+                size += len(part)
+                pos += len(part)
+                if size >= cls.ENCRYPTED_BLOCK_SIZE:
+                    yield ''.join(block)
+                    block, size = [], 0
+        if block:
+            yield ''.join(block)
+
+    @classmethod
+    def Collect(cls, columns, emails, deleted, digest_maps=None):
+        """
+        Gather everything a snapshot contains, as (count, sections). The
+        caller should hold the index lock while doing this.
+        """
+        sections = {}
+        for name in cls.DIGEST_MAPS:
+            if digest_maps and name in digest_maps:
+                digests, values = digest_maps[name].dump()
+                sections['%s.digests' % name] = digests
+                sections['%s.values' % name] = values.tostring()
+            else:
+                sections['%s.digests' % name] = ''
+                sections['%s.values' % name] = ''
+        for name in cls.NUMERIC_COLUMNS + cls.THREAD_COLUMNS:
+            sections[name] = getattr(columns, name).tostring()
+        sections['msg_ids.offsets'], sections['msg_ids'] = cls._Heap(
+            (cls.NO_MSG_ID if (m is None) else m.encode('utf-8'))
+            for m in columns.msg_ids)
+        for name in cls.STRING_COLUMNS[1:]:
+            sections['%s.offsets' % name], sections[name] = cls._Heap(
+                getattr(columns, name))
+        for name in cls.STRING_TABLES:
+            sections['%s.offsets' % name], sections[name] = cls._Heap(
+                getattr(columns, name).strings)
+        sections['emails.offsets'], sections['emails'] = cls._Heap(
+            e.encode('utf-8') for e in emails)
+        sections['deleted'] = array('l', deleted).tostring()
+        sections['extra'] = '\n'.join('%d\t%s' % (pos, columns.line(pos))
+                                      for pos in sorted(columns.extra))
+        return len(columns), sections
+
+    def __init__(self, config, filename):
+        self.config = config
+        self.filename = filename
+        self.data = None
+        self._load()
+
+    def _load(self):
+        with open(self.filename, 'rb') as fd:
+            if fd.read(len(self.MAGIC)) in (self.MAGIC, self.MAGIC_V2,
+                                            self.MAGIC_V1):
+                try:
+                    self.data = mmap.mmap(fd.fileno(), 0,
+                                          access=mmap.ACCESS_READ)
+                except (ValueError, EnvironmentError):
+                    fd.seek(0)
+                    self.data = fd.read()
+            else:
+                fd.seek(0)
+                self.data = ''.join(plaintext for offset, plaintext
+                                    in decrypt_blocks(
+                                        split_encrypted_blocks(fd),
+                                        self.config, _raise=IOError))
+
+        data, pos = self.data, len(self.MAGIC)
+        if data[:pos] == self.MAGIC:
+            section_names = self.SECTIONS
+        elif data[:pos] == self.MAGIC_V2:
+            section_names = self.SECTIONS_V2
+        elif data[:pos] == self.MAGIC_V1:
+            section_names = self.SECTIONS_V1
+        else:
+            raise ValueError('Invalid snapshot: %s' % self.filename)
+        table_end = (pos + self.HEADER.size +
+                     len(section_names) * self.SECTION.size)
+        if len(data) < table_end:
+            raise ValueError('Invalid snapshot: %s' % self.filename)
+        (generation, self.count, self.itemsize, self.big_endian
+         ) = self.HEADER.unpack(data[pos:pos + self.HEADER.size])
+        self.generation = generation.rstrip('\0')
+
+        pos += self.HEADER.size
+        self.sections = {}
+        for name in section_names:
+            offset, length = self.SECTION.unpack(
+                data[pos:pos + self.SECTION.size])
+            if offset + length > len(data):
+                raise ValueError('Corrupt snapshot: %s' % self.filename)
+            self.sections[name] = (offset, length)
+            pos += self.SECTION.size
+
+    def _array(self, name):
+        offset, length = self.sections[name]
+        data = self.data[offset:offset + length]
+        arr = array('l')
+        if arr.itemsize == self.itemsize:
+            arr.fromstring(data)
+            if self.big_endian != (sys.byteorder == 'big'):
+                arr.byteswap()
+        else:
+            fmt = '%s%d%s' % ('>' if self.big_endian else '<',
+                              length // self.itemsize,
+                              'q' if (self.itemsize == 8) else 'i')
+            arr.extend(struct.unpack(fmt, data))
+        return arr
+
+    def _heap(self, name):
+        offsets = self._array('%s.offsets' % name)
+        base, length = self.sections[name]
+        if len(offsets) < 1 or offsets[-1] != length:
+            raise ValueError('Corrupt snapshot: %s' % self.filename)
+        return HeapColumn(self.data, offsets, base)
+
+    def columns(self):
+        """Return the metadata as MessageColumns, strings not decoded."""
+        mc = MessageColumns()
+        for name in self.NUMERIC_COLUMNS:
+            column = self._array(name)
+            if len(column) != self.count:
+                raise ValueError('Corrupt snapshot: %s' % self.filename)
+            setattr(mc, name, column)
+        if 'thread_first' in self.sections:
+            for name in self.THREAD_COLUMNS:
+                setattr(mc, name, self._array(name))
+            if not (len(mc.thread_next) == len(mc.thread_prev) ==
+                    self.count):
+                raise ValueError('Corrupt snapshot: %s' % self.filename)
+        for name in self.STRING_COLUMNS[1:]:
+            setattr(mc, name, self._heap(name))
+        for name in self.STRING_TABLES:
+            setattr(mc, name, StringTable(self._heap(name)))
+
+        # Message IDs are decoded right away, as the MSGIDS map needs
+        # them all anyway.
+        mc.msg_ids = [(None if (m == self.NO_MSG_ID) else m)
+                      for m in self._heap('msg_ids').decode_all()]
+        if len(mc.msg_ids) != self.count:
+            raise ValueError('Corrupt snapshot: %s' % self.filename)
+        if 'thread_first' not in self.sections:
+            mc.relink_threads()
+
+        offset, length = self.sections['extra']
+        if length:
+            for line in self.data[offset:offset + length].split('\n'):
+                pos, line = line.split('\t', 1)
+                mc.set(int(pos), line.decode('utf-8').split(u'\t'),
+                       normalized=True)
+        return mc
+
+    def emails(self):
+        return [e.decode('utf-8') for e in self._heap('emails')]
+
+    def deleted(self):
+        return self._array('deleted').tolist()
+
+    def digest_map(self, name):
+        """Return the named DigestMap, or None if it was not saved."""
+        if not self.sections.get('%s.values' % name, (0, 0))[1]:
+            return None
+        offset, length = self.sections['%s.digests' % name]
+        return DigestMap(self.data[offset:offset + length],
+                         self._array('%s.values' % name))
+
+
+if __name__ == '__main__':
+    import doctest
+    import sys
+    results = doctest.testmod(optionflags=doctest.ELLIPSIS,
+                              extraglobs={})
+    print '%s' % (results, )
+    if results.failed:
+        sys.exit(1)
@@ -0,0 +1,202 @@
+import threading
+from array import array
+
+
+class ThreadSummaries(object):
+    """
+    Aggregates for each conversation: its newest message, its newest
+    unread message and how many of its messages are unread. They are
+    indexed by thread ID (the index position of the conversation's first
+    message) and kept up to date one message at a time, as messages are
+    added, tagged or moved to another thread.
+
+    Updates are O(1). The exception is when a conversation loses its
+    newest (or newest unread) message, which then has to be found again
+    among the conversation's members, the next time it is asked for.
+    The members function lists the messages of a conversation; if it
+    misses any, the summary of that conversation is reported as unknown.
+
+    >>> members = {0: [0, 1, 2], 3: [3]}
+    >>> ts = ThreadSummaries(lambda t: members.get(t, []))
+    >>> ts.update(0, 0, 10, False); ts.update(1, 0, 30, True)
+    >>> ts.update(2, 0, 20, True); ts.update(3, 3, 40, False)
+    >>> ts.newest(0), ts.newest_unread(0), ts.unread_count(0)
+    (1, 1, 2)
+    >>> ts.update(1, 0, 30, False)
+    >>> ts.newest(0), ts.newest_unread(0), ts.unread_count(0)
+    (1, 2, 1)
+    >>> members[0].remove(1); members[3].append(1); ts.update(1, 3, 30, False)
+    >>> ts.newest(0), ts.newest(3), ts.is_unread(2), ts.members(3)
+    (2, 3, True, [3, 1])
+    >>> members[0].remove(2); ts.update(2, 0, 5, True)
+    >>> ts.newest(0), ts.members(0), ts.newest_messages([3, 0])
+    (-2, None, [3, -2])
+    >>> ts.rebuild([0, 0, 0, 3], [10, 30, 20, 40], [False, True, True, 0])
+    >>> ts.newest(0), ts.newest_unread(0), ts.unread_count(0), ts.newest(3)
+    (1, 1, 2, 3)
+    >>> ts.unread_counts([0, 3]), ts.unread_flags([0, 1])
+    ([2, 0], [0, 1])
+    """
+    NONE = -1
+    UNKNOWN = -2
+
+    def __init__(self, members):
+        self._members = members
+        self._lock = threading.Lock()
+        # Indexed by thread ID
+        self._newest = array('l')
+        self._newest_unread = array('l')
+        self._unread = array('l')
+        self._count = array('l')
+        # Indexed by message: where and how it was counted
+        self._thread = array('l')
+        self._date = array('l')
+        self._is_unread = bytearray()
+
+    def _grow(self, pos):
+        while len(self._thread) <= pos:
+            for col in (self._newest, self._newest_unread, self._thread):
+                col.append(self.NONE)
+            for col in (self._unread, self._count, self._date):
+                col.append(0)
+            self._is_unread.append(0)
+
+    def _newer(self, a, b):
+        return (self._date[a], a) > (self._date[b], b)
+
+    def update(self, msg_idx, thread, date, unread):
+        """Count a message in a thread, or in none if thread is -1."""
+        with self._lock:
+            self._grow(max(msg_idx, thread))
+            old_thread = self._thread[msg_idx]
+            same = (old_thread == thread and self._date[msg_idx] == date)
+            if old_thread >= 0:
+                self._count[old_thread] -= 1
+                self._unread[old_thread] -= self._is_unread[msg_idx]
+                if self._newest[old_thread] == msg_idx and not same:
+                    self._newest[old_thread] = self.UNKNOWN
+                if (self._newest_unread[old_thread] == msg_idx and
+                        not (same and unread)):
+                    self._newest_unread[old_thread] = self.UNKNOWN
+
+            self._thread[msg_idx] = thread
+            self._date[msg_idx] = date
+            self._is_unread[msg_idx] = 1 if unread else 0
+            if thread >= 0:
+                self._count[thread] += 1
+                self._unread[thread] += self._is_unread[msg_idx]
+                latests = [self._newest]
+                if unread:
+                    latests.append(self._newest_unread)
+                for latest in latests:
+                    current = latest[thread]
+                    if current == self.NONE or (
+                            current >= 0 and self._newer(msg_idx, current)):
+                        latest[thread] = msg_idx
+
+    def rebuild(self, threads, dates, unread):
+        """
+        Recount everything, given the thread (or -1), date and unread flag
+        of every message. This is much faster than updating one by one.
+        """
+        with self._lock:
+            self._thread = array('l', threads)
+            self._date = array('l', dates)
+            self._is_unread = bytearray(1 if u else 0 for u in unread)
+            size = max([len(self._thread), max(self._thread or [-1]) + 1])
+            padding = size - len(self._thread)
+            self._thread.extend([self.NONE] * padding)
+            self._date.extend([0] * padding)
+            self._is_unread.extend([0] * padding)
+            self._newest = newest = array('l', [self.NONE]) * size
+            self._newest_unread = newest_unread = array('l', newest)
+            self._unread = unread_count = array('l', [0]) * size
+            self._count = count = array('l', unread_count)
+            dates, is_unread = self._date, self._is_unread
+            for msg_idx, thread in enumerate(self._thread):
+                if thread < 0:
+                    continue
+                count[thread] += 1
+                latest = newest[thread]
+                if latest < 0 or dates[msg_idx] >= dates[latest]:
+                    newest[thread] = msg_idx
+                if is_unread[msg_idx]:
+                    unread_count[thread] += 1
+                    latest = newest_unread[thread]
+                    if latest < 0 or dates[msg_idx] >= dates[latest]:
+                        newest_unread[thread] = msg_idx
+
+    def members(self, thread):
+        """
+        Return the messages counted in a thread, or None if the members
+        function does not list them all.
+        """
+        if not (0 <= thread < len(self._count)):
+            return []
+        found = [m for m in self._members(thread)
+                 if 0 <= m < len(self._thread) and self._thread[m] == thread]
+        if len(found) != self._count[thread]:
+            return None
+        return found
+
+    def _latest(self, latest, thread, unread_only):
+        if not (0 <= thread < len(latest)):
+            return self.NONE
+        msg_idx = latest[thread]
+        if msg_idx == self.UNKNOWN:
+            members = self.members(thread)
+            if members is None:
+                return self.UNKNOWN
+            msg_idx = self.NONE
+            for m in members:
+                if unread_only and not self._is_unread[m]:
+                    continue
+                if msg_idx == self.NONE or self._newer(m, msg_idx):
+                    msg_idx = m
+            with self._lock:
+                if latest[thread] == self.UNKNOWN:
+                    latest[thread] = msg_idx
+        return msg_idx
+
+    def newest_messages(self, threads):
+        """The newest message of each of a list of threads, as newest()."""
+        found = map(self._newest.__getitem__, threads)
+        if found and min(found) == self.UNKNOWN:
+            found = [self.newest(t) if (f == self.UNKNOWN) else f
+                     for t, f in zip(threads, found)]
+        return found
+
+    def newest(self, thread):
+        """The newest message in a thread, -1 if none, -2 if unknown."""
+        return self._latest(self._newest, thread, False)
+
+    def newest_unread(self, thread):
+        """The newest unread message in a thread, -1 or -2 as above."""
+        return self._latest(self._newest_unread, thread, True)
+
+    def unread_count(self, thread):
+        if not (0 <= thread < len(self._unread)):
+            return 0
+        return self._unread[thread]
+
+    def is_unread(self, msg_idx):
+        return (0 <= msg_idx < len(self._is_unread) and
+                self._is_unread[msg_idx] == 1)
+
+    def unread_counts(self, threads):
+        """The unread_count() of each of a list of threads."""
+        return map(self._unread.__getitem__, threads)
+
+    def unread_flags(self, msg_idxs):
+        """The is_unread() of each of a list of messages."""
+        return map(self._is_unread.__getitem__, msg_idxs)
+
+
+if __name__ == '__main__':
+    import doctest
+    import sys
+    results = doctest.testmod(optionflags=doctest.ELLIPSIS,
+                              extraglobs={})
+    print '%s' % (results, )
+    if results.failed:
+        sys.exit(1)
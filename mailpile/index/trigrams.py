@@ -0,0 +1,107 @@
+import re
+import threading
+from array import array
+
+
+class TrigramIndex(object):
+    """
+    An index for substring searches over a list of short strings, such
+    as the known e-mail addresses and names.
+
+    Each string is indexed by the trigrams it contains and by the first
+    one and two letters of each word. Terms of three letters or more are
+    looked up by their rarest trigram and match anywhere, shorter terms
+    only match the start of a word. The candidates are then checked
+    against the strings themselves, so results are exact, and the work
+    done depends on how many strings could match rather than on how many
+    there are.
+
+    The index refers to the list, it does not copy it.
+
+    >>> emails = [u'bre@example.com (Brennan Novak)',
+    ...           u'bjarni@example.com (Bjarni R. Einarsson)']
+    >>> ti = TrigramIndex(emails)
+    >>> ti.search([u'nova']), ti.search([u'example', u'bj'])
+    ([0], [1])
+    >>> ti.search([u'b']), ti.search([u'zzz']), ti.search([u'no', u'ex'])
+    ([0, 1], [], [0])
+    >>> ti.search([u'ov']), ti.search([u'ex', u'on'])
+    ([], [])
+    >>> emails.append(u'smari@example.com (Smari McCarthy)')
+    >>> ti.add(2)
+    >>> ti.search([u'mccar']), ti.search([u'example'])
+    ([2], [0, 1, 2])
+    """
+    WORDS = re.compile(r'\w+', re.UNICODE)
+    PREFIX = u'\0'
+
+    def __init__(self, strings):
+        self.strings = strings
+        self.grams = {}
+        self._lock = threading.Lock()
+        for pos in xrange(0, len(strings)):
+            self.add(pos)
+
+    @classmethod
+    def keys(cls, text):
+        text = text.lower()
+        keys = set(text[i:i+3] for i in xrange(0, len(text) - 2))
+        for word in cls.WORDS.findall(text):
+            keys.add(cls.PREFIX + word[:1])
+            keys.add(cls.PREFIX + word[:2])
+        return keys
+
+    def add(self, pos):
+        """(Re)index the string at a given position in the list."""
+        # Keys the string used to have are left behind; the check
+        # against the string itself filters them out of the results.
+        with self._lock:
+            for key in self.keys(self.strings[pos]):
+                postings = self.grams.get(key)
+                if postings is None:
+                    self.grams[key] = array('l', [pos])
+                elif postings[-1] != pos:
+                    postings.append(pos)
+
+    def _postings(self, term):
+        if len(term) < 3:
+            return self.grams.get(self.PREFIX + term, ())
+        best = None
+        for i in xrange(0, len(term) - 2):
+            postings = self.grams.get(term[i:i+3], ())
+            if best is None or len(postings) < len(best):
+                best = postings
+                if not best:
+                    break
+        return best
+
+    def search(self, terms):
+        """Return the positions of all strings containing all the terms."""
+        terms = [t.lower() for t in terms if t]
+        if not terms:
+            return []
+        longer = [t for t in terms if len(t) >= 3]
+        shorter = [t for t in terms if len(t) < 3]
+        candidates = min((self._postings(t) for t in terms), key=len)
+        strings, matches = self.strings, set()
+        for pos in candidates:
+            text = strings[pos].lower()
+            if not all((t in text) for t in longer):
+                continue
+            if shorter:
+                words = self.WORDS.findall(text)
+                if not all(any(w.startswith(t) for w in words)
+                           for t in shorter):
+                    continue
+            matches.add(pos)
+        return sorted(matches)
+
+
+if __name__ == '__main__':
+    import doctest
+    import sys
+    results = doctest.testmod(optionflags=doctest.ELLIPSIS,
+                              extraglobs={})
+    print '%s' % (results, )
+    if results.failed:
+        sys.exit(1)
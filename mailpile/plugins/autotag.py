@@ -220,7 +220,8 @@ class Retrain(AutoTagCommand):
                 # Get the current message sets: tagged and untagged messages
                 # excluding trash.
                 for tset, mset, srch, which in yn:
-                    mset |= idx.search(session, [srch] + no_trash).as_set()
+                    mset.update(idx.search(session, [srch] + no_trash
+                                           ).as_set())
 
                 # If we have any exclude_tags, they are particularly
                 # interesting, so we'll look at them first.
@@ -18,6 +18,7 @@ from mailpile.plugins.core import Quit
 from mailpile.i18n import ActivateTranslation
 from mailpile.i18n import gettext as _
 from mailpile.i18n import ngettext as _n
+from mailpile.index.bitmap import Bitmap
 from mailpile.ui import SuppressHtmlOutput
 from mailpile.util import *
 from mailpile.vfs import FilePath, vfs
@@ -71,16 +72,16 @@ class MakeBackup(Command):
             elif tag.type == 'trash':
                 suppress[tid] = tag
 
-        msg_idx_set = set()
+        msg_idx_set = Bitmap()
         for tid in keep:
             msg_idx_set |= config.index.TAGS[tid]
         for tid in suppress:
-            msg_idx_set -= config.index.TAGS.get(tid, set([]))
+            msg_idx_set -= config.index.TAGS.get(tid, Bitmap())
 
-        msg_id_list = [''] * len(config.index.INDEX)
-        for msgid, msg_idx in config.index.MSGIDS.iteritems():
-            if msg_idx in msg_idx_set:
-                msg_id_list[msg_idx] = msgid
+        msg_ids = config.index.INDEX.msg_ids
+        msg_id_list = [''] * len(msg_ids)
+        for msg_idx in msg_idx_set:
+            msg_id_list[msg_idx] = msg_ids[msg_idx] or ''
 
         return {
             'tags': dict((tid, list(config.index.TAGS[tid]))
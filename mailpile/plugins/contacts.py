@@ -671,7 +671,7 @@ class AddressSearch(VCardCommand):
         'q': 'search terms',
         'count': 'number of results',
         'offset': 'offset results',
-        'ms': 'deadline in ms'
+        'ms': 'ignored, results are always complete'
     }
 
     def _boost_rank(self, boost, term, *matches):
@@ -685,7 +685,7 @@ class AddressSearch(VCardCommand):
                     boost += boost * (float(len(term)) / len(match))
         return int(boost)
 
-    def _vcard_addresses(self, cfg, terms, ignored_count, deadline):
+    def _vcard_addresses(self, cfg, terms, ignored_count):
         addresses = {}
         for vcard in cfg.vcards.find_vcards(terms,
                                             kinds=VCardStore.KINDS_PEOPLE):
@@ -699,58 +699,25 @@ class AddressSearch(VCardCommand):
                 for term in terms:
                     info['rank'] += self._boost_rank(5, term, fn.value,
                                                      email_vcl.value)
-            if len(addresses) and time.time() > deadline:
-                break
 
         return addresses.values()
 
-    def _index_addresses(self, cfg, terms, vcard_addresses, count, deadline):
+    def _index_addresses(self, cfg, terms, vcard_addresses, count):
         existing = dict([(k['address'].lower(), k) for k in vcard_addresses])
         index = self._idx()
-
-        # Figure out which tags are invisible so we can skip messages marked
-        # with those tags.
-        invisible = set([t._key for t in cfg.get_tags(flag_hides=True)])
         matches = {}
         addresses = []
 
-        # 1st, search the social graph for matches, give low priority.
-        for frm in index.EMAILS:
-            frm_lower = frm.lower()
-            match = True
-            for term in terms:
-                if term not in frm_lower:
-                    match = False
-                    break
-            if match:
+        # Search the social graph for matches, give low priority. The
+        # trigram index finds every match, however many addresses we know.
+        if terms:
+            eids = index.search_emails(terms)
+        else:
+            eids = xrange(0, min(len(index.EMAILS), count * 10))
+        for eid in eids:
+            frm = index.EMAILS[eid]
+            if frm:
                 matches[frm] = matches.get(frm, 0) + 3
-                if len(matches) > (count * 10):
-                    break
-            elif len(matches) and time.time() > deadline:
-                break
-
-        # 2nd, go through at most the last 5000 messages in the index and
-        # search for matching senders or recipients, give medium priority.
-        # Note: This is more CPU intensive, so we do this last.
-        if len(matches) < (count * 5):
-            for msg_idx in xrange(max(0, len(index.INDEX)-5000),
-                                  len(index.INDEX)):
-                msg_info = index.get_msg_at_idx_pos(msg_idx)
-                tags = set(msg_info[index.MSG_TAGS].split(','))
-                match = not (tags & invisible)
-                if match:
-                    frm = msg_info[index.MSG_FROM]
-                    search = (frm + ' ' + msg_info[index.MSG_SUBJECT]).lower()
-                    for term in terms:
-                        if term not in search:
-                            match = False
-                            break
-                    if match:
-                        matches[frm] = matches.get(frm, 0) + 1
-                        if len(matches) > (count * 5):
-                            break
-                    if len(matches) and time.time() > deadline:
-                        break
 
         # Assign info & scores!
         for frm in matches:
@@ -778,7 +745,6 @@ class AddressSearch(VCardCommand):
 
         count = int(self.data.get('count', 10))
         offset = int(self.data.get('offset', 0))
-        deadline = time.time() + float(self.data.get('ms', 150)) / 1000.0
         terms = []
         for q in self.data.get('q', []):
             terms.extend(q.lower().split())
@@ -786,11 +752,11 @@ class AddressSearch(VCardCommand):
             terms.extend(a.lower().split())
 
         self.session.ui.mark('Searching VCards')
-        vcard_addrs = self._vcard_addresses(config, terms, count, deadline)
+        vcard_addrs = self._vcard_addresses(config, terms, count)
 
         self.session.ui.mark('Searching Metadata')
         index_addrs = self._index_addresses(config, terms, vcard_addrs,
-                                            count, deadline)
+                                            count)
 
         self.session.ui.mark('Sorting')
         addresses = vcard_addrs + index_addrs
@@ -26,6 +26,8 @@ from mailpile.crypto.gpgi import GnuPG
 from mailpile.eventlog import Event
 from mailpile.i18n import gettext as _
 from mailpile.i18n import ngettext as _n
+from mailpile.index.rebuild import IndexRebuilder
+from mailpile.index.search import CachedSearchResultSet
 from mailpile.mailboxes import IsMailbox
 from mailpile.mailutils import ClearParseCache, Email
 from mailpile.postinglist import GlobalPostingList
@@ -342,6 +344,80 @@ class Optimize(Command):
             return self._error(_('Aborted'))
 
 
+class RebuildIndex(Command):
+    """Rebuild the metadata and search indexes from scratch"""
+    SYNOPSIS = (None, 'index/rebuild', None, '[<processes>]')
+    ORDER = ('Internals', 4)
+    LOG_PROGRESS = True
+
+    def command(self):
+        session, config, idx = self.session, self.session.config, self._idx()
+        try:
+            processes = int(self.args[0]) if self.args else None
+        except ValueError:
+            return self._error(_('Invalid number of processes: %s'
+                                 ) % self.args[0])
+
+        full_path = config.need_more_disk_space(ratio=2.0)
+        if full_path:
+            return self._error(_('Insufficient free space in %s'
+                                 ) % full_path)
+
+        # This also keeps rescans from adding to the old index meanwhile.
+        if 'rescan' in config._running:
+            return self._error(_('Rescan in progress, try again later'))
+        config._running['rescan'] = True
+        try:
+            mailpile.util.LAST_USER_ACTIVITY = 0
+            config.flush_mbox_cache(session, wait=True)
+            ClearParseCache(full=True)
+
+            rebuilder = IndexRebuilder(session, idx, processes=processes)
+            new_idx = rebuilder.rebuild(config.get_mailboxes())
+            with config.interruptable_wait_for_lock():
+                rebuilder.install()
+                config.index = new_idx
+                session.results = []
+                session.searched = []
+                session.displayed = None
+            CachedSearchResultSet.DropCaches()
+        except KeyboardInterrupt:
+            return self._error(_('Aborted'))
+        finally:
+            del config._running['rescan']
+
+        result = {
+            'messages': len(new_idx.INDEX),
+            'errors': rebuilder.errors,
+            'processes': rebuilder.processes
+        }
+        self.event.data.update(result)
+        return self._success(_('Rebuilt index: %d messages'
+                               ) % len(new_idx.INDEX), result=result)
+
+
+class CheckIndex(Command):
+    """Check the metadata index for consistency"""
+    SYNOPSIS = (None, 'index/check', None, '[repair]')
+    ORDER = ('Internals', 4)
+
+    def command(self):
+        repair = ('repair' in self.args)
+        problems = self._idx().check_ptrs_and_msgids(self.session,
+                                                      repair=repair)
+        if not problems:
+            return self._success(_('Metadata index is consistent'),
+                                 result=problems)
+        elif repair:
+            return self._success(_('Repaired %d problems in metadata index'
+                                   ) % sum(problems.values()),
+                                 result=problems)
+        else:
+            return self._error(_('Found %d problems in metadata index'
+                                 ) % sum(problems.values()),
+                               result=problems)
+
+
 class DeleteMessages(Command):
     """Delete one or more messages."""
     SYNOPSIS = (None, 'delete', 'message/delete', '[--keep] <messages>')
@@ -592,10 +668,14 @@ class ProgramStatus(Command):
                     'Events in progress:\n%s\n\n'
                     'Live sessions:\n%s\n\n'
                     'Postinglist timers:\n%s\n\n'
+                    'Postinglist cache:\n%s\n\n'
+                    'Message cache:\n%s\n\n'
                     'Threads: (bg delay %.3fs, live=%s, httpd=%s)\n%s\n\n'
                     'Locks:\n%s'
                     ) % (cevents, ievents, sessions,
                          self.result['pl_timers'],
+                         self.result['pl_cache'],
+                         self.result['msg_cache'],
                          self.result['delay'],
                          self.result['live'],
                          self.result['httpd'],
@@ -658,6 +738,8 @@ class ProgramStatus(Command):
                           'userinfo': v.auth} for k, v in
                          mailpile.auth.SESSION_CACHE.iteritems()],
             'pl_timers': mailpile.postinglist.TIMERS,
+            'pl_cache': mailpile.postinglist.PLC_CACHE_STATS,
+            'msg_cache': config.index.CACHE.stats() if config.index else {},
             'delay': play_nice_with_threads(sleep=False),
             'live': mailpile.util.LIVE_USER_ACTIVITIES,
             'httpd': mailpile.httpd.LIVE_HTTP_REQUESTS,
@@ -2007,7 +2089,7 @@ class HelpSplash(Help):
 
 
 _plugins.register_commands(
-    Load, Optimize, Rescan, DeleteMessages,
+    Load, Optimize, Rescan, RebuildIndex, CheckIndex, DeleteMessages,
     BrowseOrLaunch, RunWWW, ProgramStatus, CronStatus, HealthCheck,
     GpgCommand, ListDir, ChangeDir, CatFile, WritePID, Cleanup,
     ConfigPrint, ConfigSet, ConfigAdd, ConfigUnset, ConfigureMailboxes,
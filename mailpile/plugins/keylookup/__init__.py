@@ -299,7 +299,7 @@ class KeyTofu(Command):
         recent = idx.search(self.session, ['from:' + email])
         recent = set(sorted(list(recent.as_set()))[-25:])
         crypto = crypto.as_set() & recent
-        return (crypto >= self.TOFU_MIN_EMAILS)
+        return (len(crypto) >= self.TOFU_MIN_EMAILS)
 
     def _seen_enough_signatures(self, idx, email, keyinfo):
         fp = keyinfo['fingerprint'][-16:].lower()
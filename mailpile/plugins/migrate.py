@@ -5,6 +5,7 @@ from mailpile.i18n import gettext as _
 from mailpile.i18n import ngettext as _n
 from mailpile.mail_source.local import LocalMailSource
 from mailpile.plugins import PluginManager
+from mailpile.postinglist import PostingListContainer
 from mailpile.util import *
 from mailpile.vcard import *
 
@@ -189,12 +190,21 @@ def migrate_cleanup(session):
     return True
 
 
+def migrate_postinglists(session):
+    # Legacy text posting lists are still readable, but rewriting them
+    # all up front saves memory and speeds up searches right away.
+    count = PostingListContainer.Migrate(session)
+    session.ui.mark(_('Migrated %d posting lists') % count)
+    return True
+
+
 MIGRATIONS_BEFORE_SETUP = [migrate_routes]
 MIGRATIONS_AFTER_SETUP = [migrate_cleanup]
 MIGRATIONS = {
     'routes': migrate_routes,
     'sources': migrate_mailboxes,
-    'cleanup': migrate_cleanup
+    'cleanup': migrate_cleanup,
+    'postinglists': migrate_postinglists
 }
 
 
@@ -90,9 +90,9 @@ class SearchResults(dict):
             msg_idx = None
         else:
             msg_idx = int(msg_mid, 36)
-            cache = self.idx.CACHE.get(msg_idx, {})
-            if 'metadata' in cache:
-                return cache['metadata']
+            cached = self.idx.CACHE.metadata.get(msg_idx)
+            if cached is not None:
+                return cached
 
         nz = lambda l: [v for v in l if v]
         msg_ts = long(msg_info[MailIndex.MSG_DATE], 36)
@@ -171,8 +171,7 @@ class SearchResults(dict):
                 del expl['flags']['draft']
 
         if msg_idx is not None:
-            cache['metadata'] = expl
-            self.idx.CACHE[msg_idx] = cache
+            self.idx.CACHE.metadata[msg_idx] = expl
         return expl
 
     def _msg_addresses(self, msg_info=None, addresses=[],
@@ -421,6 +420,8 @@ class SearchResults(dict):
             start = len(results)
         if start < 0:
             start = 0
+        if results is session.results:
+            session.finish_sorting(start + num)
 
         try:
             threads = [b36(r) for r in results[start:start + num]]
@@ -831,10 +832,10 @@ class Search(Command):
         session, config, idx = self.session, self.session.config, self._idx()
         msg_idxs = [e.msg_idx_pos for e in emails]
         if 'tags' in config and config.prefs.auto_mark_as_read:
-            for tag in config.get_tags(type='unread'):
-                idx.remove_tag(session, tag._key, msg_idxs=msg_idxs)
-            for tag in config.get_tags(type='read'):
-                idx.add_tag(session, tag._key, msg_idxs=msg_idxs)
+            idx.edit_tags(session, [(
+                msg_idxs,
+                [tag._key for tag in config.get_tags(type='read')],
+                [tag._key for tag in config.get_tags(type='unread')])])
 
         idx.apply_filters(session, '@read',
                           msg_idxs=[e.msg_idx_pos for e in emails])
@@ -851,6 +852,31 @@ class Search(Command):
         # Note: this falls back to default index if we set to None
         return self._idx()
 
+    def _sort_results(self, idx, srs):
+        session, order = self.session, self.session.order
+        start = getattr(self, '_start', None)
+        if self._email_view_pairs or start is None:
+            # We need the position of the requested messages, or have
+            # no idea which results will be used.
+            idx.sort_results(session, session.results, order)
+        elif start == 0:
+            # Most searches only ever show the first page, so we only sort
+            # that, which is much faster for large result sets.
+            raw = session.results[:]
+            if idx.sort_top_results(session, session.results, order,
+                                    self._num):
+                session.partial_sort = (session.results, raw, self._num)
+        else:
+            # Paging deeper needs a full sort, which we keep with the
+            # cached search results in case the user keeps going.
+            cached = None if self.context else srs.sorted(order)
+            if cached is None:
+                idx.sort_results(session, session.results, order)
+                if not self.context:
+                    srs.set_sorted(order, session.results)
+            else:
+                session.results = cached
+
     def _do_search(self, search=None, process_args=False):
         session = self.session
 
@@ -881,8 +907,8 @@ class Search(Command):
 
             idx = self.switch_indexes(want_index)
             context = session.results if self.context else None
-            session.results = list(idx.search(session, session.searched,
-                                              context=context).as_set())
+            srs = idx.search(session, session.searched, context=context)
+            session.results = list(srs.as_set())
 
             if '*' in self._email_view_pairs.values():
                 # If we are auto-choosing which message from a thread to
@@ -905,7 +931,7 @@ class Search(Command):
                         session.results.append(emid_idx)
 
             if session.order:
-                idx.sort_results(session, session.results, session.order)
+                self._sort_results(idx, srs)
         else:
             idx = self._idx()
 
@@ -1068,7 +1094,11 @@ class Order(Search):
     def command(self):
         session, idx = self.session, self._idx()
         session.order = self.args and self.args[0] or None
-        idx.sort_results(session, session.results, session.order)
+        if session.results_partially_sorted():
+            # This sorts the original results in the new order
+            session.finish_sorting()
+        else:
+            idx.sort_results(session, session.results, session.order)
         session.displayed = SearchResults(session, idx)
         return self._success(_('Changed sort order to %s') % session.order,
                              result=session.displayed)
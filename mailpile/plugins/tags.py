@@ -3,6 +3,7 @@ import mailpile.security as security
 from mailpile.commands import Command
 from mailpile.i18n import gettext as _
 from mailpile.i18n import ngettext as _n
+from mailpile.index.bitmap import Bitmap
 from mailpile.plugins import PluginManager
 from mailpile.plugins.core import DeleteMessages
 from mailpile.urlmap import UrlMap
@@ -229,19 +230,23 @@ def GetTagInfo(cfg, tn, stats=False, unread=None, exclude=None, subtags=None):
         info[k] = tag[k]
     if subtags:
         info['subtag_ids'] = [t._key for t in subtags]
-    exclude = exclude or set()
     if stats and (unread is not None):
-        messages = (cfg.index.TAGS.get(tid, set()) - exclude)
-        stats_all = len(messages)
+        # The index keeps these counts up to date, so we only need to do
+        # set arithmetic when summing up subtags.
+        stats_all, stats_new, visible, visible_new = (
+            cfg.index.get_tag_stats(tid))
+        if exclude is not None:
+            stats_all, stats_new = visible, visible_new
         info['name'] = _(info['name'])
         info['stats'] = {
             'all': stats_all,
-            'new': len(messages & unread),
+            'new': stats_new,
             'not': len(cfg.index.INDEX) - stats_all
         }
         if subtags:
+            messages = cfg.index.TAGS.get(tid, Bitmap()) - (exclude or [])
             for subtag in subtags:
-                messages |= cfg.index.TAGS.get(subtag._key, set())
+                messages |= cfg.index.TAGS.get(subtag._key, Bitmap())
             info['stats'].update({
                 'sum_all': len(messages),
                 'sum_new': len(messages & unread),
@@ -370,6 +375,9 @@ class Tag(TagCommand):
             'ignored': []
         }
 
+        # All the changes are collected first and then made in one go
+        edits, tagged, untagged = [], [], []
+        conv_ids, record = None, False
         for op in ops:
             tag = self.session.config.get_tag(op[1:])
             if tag:
@@ -385,41 +393,49 @@ class Tag(TagCommand):
                     conversation = conversations
                 if conversation:
                     rv['conversations'] = True
+                    if conv_ids is None:
+                        conv_ids = idx.conversation_idxs(msg_ids)
 
                 ignored = False
                 tag_id = tag._key
                 tag_cfg = tag
                 tag = tag.copy()
                 tag["tid"] = tag_id
+                targets = conv_ids if conversation else msg_ids
                 if op[0] == '-':
                     if force or tag_cfg['flag_allow_del']:
-                        removed = idx.remove_tag(self.session, tag_id,
-                                                 msg_idxs=msg_ids,
-                                                 conversation=conversation)
-                        rv['untagged'].append(
-                            (tag, sorted([b36(i) for i in removed])))
+                        edits.append((targets, [], [tag_id]))
+                        untagged.append(tag)
                     else:
                         rv['ignored'].append((op, tag))
                         ignored = True
                 else:
                     if force or tag_cfg['flag_allow_add']:
-                        added = idx.add_tag(self.session, tag_id,
-                                            msg_idxs=msg_ids,
-                                            conversation=conversation)
-                        rv['tagged'].append(
-                            (tag, sorted([b36(i) for i in added])))
+                        edits.append((targets, [tag_id], []))
+                        tagged.append(tag)
                     else:
                         rv['ignored'].append((op, tag))
                         ignored = True
 
                 # Record behavior
                 if len(msg_ids) < 15 and not ignored:
-                    for t in self.session.config.get_tags(type='tagged',
-                                                          default=[]):
-                        idx.add_tag(self.session, t._key, msg_idxs=msg_ids)
+                    record = True
             else:
                 self.session.ui.warning('Unknown tag: %s' % op)
 
+        if record:
+            record_tags = self.session.config.get_tags(type='tagged',
+                                                       default=[])
+            edits.append((msg_ids, [t._key for t in record_tags], []))
+        if edits:
+            added, removed = idx.edit_tags(self.session, edits)
+            rv['untagged'] = [
+                (tag, sorted([b36(i) for i in removed.get(tag['tid'], [])]))
+                for tag in untagged]
+            rv['tagged'] = [
+                (tag, sorted([b36(i) for i in added.get(tag['tid'], [])]))
+                for tag in tagged]
+
 
         if rv['ignored'] and (len(rv['tagged']) == len(rv['untagged']) == 0):
             self.event.private_data['ignored'] = rv['ignored']
@@ -457,17 +473,19 @@ class Tag(TagCommand):
             'tagged': [],
             'untagged': []
         }
-        for tid, msg_mids in event.private_data['undo']['tagged']:
-            removed = idx.remove_tag(undo.session, tid,
-                                     msg_idxs=[int(i, 36) for i in msg_mids],
-                                     conversation=False)
-            rv['untagged'].append((tid, sorted([b36(i) for i in removed])))
-
-        for tid, msg_mids in event.private_data['undo']['untagged']:
-            added = idx.add_tag(undo.session, tid,
-                                msg_idxs=[int(i, 36) for i in msg_mids],
-                                conversation=False)
-            rv['tagged'].append((tid, sorted([b36(i) for i in added])))
+        tagged = event.private_data['undo']['tagged']
+        untagged = event.private_data['undo']['untagged']
+        edits = ([([int(i, 36) for i in msg_mids], [], [tid])
+                  for tid, msg_mids in tagged] +
+                 [([int(i, 36) for i in msg_mids], [tid], [])
+                  for tid, msg_mids in untagged])
+        added, removed = idx.edit_tags(undo.session, edits)
+        for tid, msg_mids in tagged:
+            rv['untagged'].append((tid, sorted([b36(i) for i in
+                                                removed.get(tid, [])])))
+        for tid, msg_mids in untagged:
+            rv['tagged'].append((tid, sorted([b36(i) for i in
+                                              added.get(tid, [])])))
         return undo._success(_('Undid tagging operation'), rv)
 
     def command(self, **kwargs):
@@ -654,13 +672,13 @@ class ListTags(TagCommand):
         wanted.extend([t.lower() for t in self.data.get('only', [])])
         unwanted.extend([t.lower() for t in self.data.get('not', [])])
 
-        unread_messages = set()
+        unread_messages = Bitmap()
         for tag in self.session.config.get_tags(type='unread', default=[]):
-            unread_messages |= idx.TAGS.get(tag._key, set())
+            unread_messages |= idx.TAGS.get(tag._key, Bitmap())
 
-        excluded_messages = set()
+        excluded_messages = Bitmap()
         for tag in self.session.config.get_tags(flag_hides=True, default=[]):
-            excluded_messages |= idx.TAGS.get(tag._key, set())
+            excluded_messages |= idx.TAGS.get(tag._key, Bitmap())
 
         mode = search.get('mode', 'default')
         if 'mode' in search:
@@ -1,12 +1,20 @@
+import base64
+import heapq
+import mmap
 import os
 import sys
 import random
+import struct
 import threading
 import traceback
 import time
+from array import array
+from collections import OrderedDict
 
 import mailpile.util
 from mailpile.crypto.streamer import EncryptingStreamer
+from mailpile.index.bitmap import Bitmap
+from mailpile.index.bloom import BloomFilter
 from mailpile.i18n import gettext as _
 from mailpile.i18n import ngettext as _n
 from mailpile.util import *
@@ -19,9 +27,27 @@ GLOBAL_OPTIMIZE_LOCK = PListLock()
 
 GLOBAL_GPL_LOCK = PListRLock()
 GLOBAL_GPL = None
+GLOBAL_GPL_JOURNAL_BYTES = 0
 
+GLOBAL_CHECKPOINT_LOCK = PListLock()
+
+GLOBAL_SEGMENTS_LOCK = PListRLock()
+GLOBAL_SEGMENTS = None
+
+# Container sig -> BloomFilter of the sigs in that container. This is only
+# consulted when GLOBAL_FILTERS_STATE['complete'] is set.
+GLOBAL_FILTERS_LOCK = PListRLock()
+GLOBAL_FILTERS = None
+GLOBAL_FILTERS_STATE = {'complete': False, 'dirty': False}
+
+# Container sig -> (hit counts of the sigs with at least COUNT_MIN_HITS
+# hits, typical hit count of the others). Saved along with the filters.
+GLOBAL_FILTER_COUNTS = {}
+
+# The PLC_CACHE maps sigs to [timestamp, container, estimated bytes,
+# changes when measured], least recently used first.
 PLC_CACHE_LOCK = PListLock()
-PLC_CACHE = {}
+PLC_CACHE = OrderedDict()
 
 TIMERS = {
     'render': 0,
@@ -31,19 +57,156 @@ TIMERS = {
     'load_count': 0,
 }
 
+PLC_CACHE_STATS = {
+    'hits': 0,
+    'misses': 0,
+    'evictions': 0,
+    'bytes': 0,
+}
 
-def PLC_CACHE_FlushAndClean(session, min_changes=0, keep=5, runtime=None):
-    def save(plc):
-        job_name = _('Save PLC %s') % plc.sig
-        session.ui.mark(job_name)
-        session.config.save_worker.do(session, job_name, plc.save)
-        play_nice_with_threads()
+# Posting lists are kept in memory as sorted arrays of message index
+# positions and written to disk as delta-encoded varints. The packed data
+# is base64 encoded and prefixed with this marker, so the line-oriented
+# (and possibly encrypted) container files can still be streamed and so
+# we can tell new lines apart from the legacy tab-separated b36 format.
+HIT_TYPECODE = 'I'
+PACKED_MARKER = '~'
+
+
+def encode_hits(hits):
+    """
+    Delta-encode a sorted sequence of integers as varints.
+
+    >>> encode_hits([1, 2, 130, 100000])
+    '\\x01\\x01\\x80\\x01\\x9e\\x8c\\x06'
+    """
+    out = bytearray()
+    last = 0
+    for hit in hits:
+        delta, last = hit - last, hit
+        while delta > 0x7f:
+            out.append((delta & 0x7f) | 0x80)
+            delta >>= 7
+        out.append(delta)
+    return str(out)
+
+
+def decode_hits(data):
+    """
+    Decode delta-encoded varints into a sorted array of integers.
+
+    >>> list(decode_hits(encode_hits([0, 5, 130, 100000])))
+    [0L, 5L, 130L, 100000L]
+    """
+    hits = array(HIT_TYPECODE)
+    last = delta = shift = 0
+    for byte in bytearray(data):
+        delta |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            last += delta
+            hits.append(last)
+            delta = shift = 0
+    return hits
+
+
+def pack_hits(hits):
+    """
+    Render a sorted sequence of hits in the on-disk format.
+
+    >>> pack_hits([1, 2, 3])
+    '~AQEB'
+    >>> list(unpack_hits(['~AQEB'])), list(unpack_hits(['1', 'A', 'bogus!']))
+    ([1L, 2L, 3L], [1L, 10L])
+    """
+    return PACKED_MARKER + base64.b64encode(encode_hits(hits))
+
+
+def unpack_hits(fields):
+    """
+    Parse the hits from a container line (minus the sig) into a sorted
+    array, accepting both the packed and legacy b36 formats.
+    """
+    if len(fields) == 1 and fields[0][:1] == PACKED_MARKER:
+        try:
+            return decode_hits(base64.b64decode(fields[0][1:]))
+        except TypeError:
+            return array(HIT_TYPECODE)
+    return sorted_hits(_b36_hits(fields))
 
-    def remove(ts, plc):
-        with PLC_CACHE_LOCK:
-            if plc.sig in PLC_CACHE and ts == PLC_CACHE[plc.sig][0]:
-               del PLC_CACHE[plc.sig]
 
+def sorted_hits(hits):
+    """Convert an iterable of integer hits into a sorted array."""
+    if isinstance(hits, array):
+        return hits
+    return array(HIT_TYPECODE, sorted(hits))
+
+
+def _b36_hits(values):
+    hits = set()
+    for value in values:
+        try:
+            hits.add(int(value, 36))
+        except ValueError:
+            pass
+    return hits
+
+
+def _hit_set(values):
+    values = set(values)
+    for value in values:
+        if isinstance(value, (str, unicode)):
+            return _b36_hits(values)
+        break
+    return values
+
+
+def _PLC_CACHE_Save(session, plc):
+    job_name = _('Save PLC %s') % plc.sig
+    session.ui.mark(job_name)
+    session.config.save_worker.do(session, job_name, plc.save)
+    play_nice_with_threads()
+
+
+def _PLC_CACHE_Remove(ts, plc):
+    with PLC_CACHE_LOCK:
+        if plc.sig in PLC_CACHE and ts == PLC_CACHE[plc.sig][0]:
+            PLC_CACHE_STATS['bytes'] -= PLC_CACHE[plc.sig][2]
+            PLC_CACHE_STATS['evictions'] += 1
+            del PLC_CACHE[plc.sig]
+
+
+def PLC_CACHE_Evict(session):
+    """
+    Evict least recently used containers until the cache fits within
+    sys.postinglist_cache_mb. Dirty containers are saved first.
+    """
+    budget = session.config.sys.postinglist_cache_mb * 1024 * 1024
+    with PLC_CACHE_LOCK:
+        excess = PLC_CACHE_STATS['bytes'] - budget
+        victims = []
+        # Never evict the most recently used container, our caller is
+        # probably about to use it.
+        for ts, plc, size, measured in PLC_CACHE.values()[:-1]:
+            if excess <= 0:
+                break
+            victims.append((ts, plc))
+            excess -= size
+
+    for ts, plc in victims:
+        if plc.changes:
+            _PLC_CACHE_Save(session, plc)
+        _PLC_CACHE_Remove(ts, plc)
+
+
+def _deleted_set(config):
+    # Compacting posting lists drops messages which have been deleted.
+    idx = config.index
+    return idx.DELETED if (idx is not None) else set()
+
+
+def PLC_CACHE_FlushAndClean(session, min_changes=0, keep=5, runtime=None):
     startt = int(time.time())
     expire = startt - max(30, 300 - len(PLC_CACHE))
     savets = startt - 15
@@ -52,23 +215,25 @@ def PLC_CACHE_FlushAndClean(session, min_changes=0, keep=5, runtime=None):
         return (runtime and startt + runtime < time.time())
 
     with PLC_CACHE_LOCK:
-        plc_cache = sorted(PLC_CACHE.values())
+        plc_cache = [(ts, plc) for ts, plc, s, m in PLC_CACHE.values()]
 
     for ts, plc in plc_cache[:-keep]:
         if plc.changes:
-            save(plc)
-        remove(ts, plc)
+            _PLC_CACHE_Save(session, plc)
+        _PLC_CACHE_Remove(ts, plc)
         if time_up():
             return
 
     for ts, plc in plc_cache[-keep:]:
         if (plc.changes > min_changes) or (plc.changes and ts < savets):
-            save(plc)
+            _PLC_CACHE_Save(session, plc)
         if ts < expire:
-            remove(ts, plc)
+            _PLC_CACHE_Remove(ts, plc)
         if time_up():
             return
 
+    PostingListFilters.Save(session)
+
 
 class PostingListContainer(object):
     """A container for posting lists mapping search terms to message IDs."""
@@ -81,11 +246,24 @@ class PostingListContainer(object):
         fn, sig = cls._GetFilenameAndSig(session.config, sig)
         found = plc = None
         with PLC_CACHE_LOCK:
-            if sig in PLC_CACHE:
-                found = PLC_CACHE[sig][0] = int(time.time())
+            entry = PLC_CACHE.pop(sig, None)
+            if entry is not None:
+                found = entry[0] = int(time.time())
+                PLC_CACHE_STATS['hits'] += 1
             else:
-                PLC_CACHE[sig] = [int(time.time()), cls(session, sig)]
-            plc = PLC_CACHE[sig][1]
+                entry = [int(time.time()), cls(session, sig), 0, None]
+                PLC_CACHE_STATS['misses'] += 1
+            # Re-inserting moves the container to the end of the LRU order
+            PLC_CACHE[sig] = entry
+            plc = entry[1]
+            if entry[3] != plc.changes:
+                size = plc.memory_size()
+                PLC_CACHE_STATS['bytes'] += size - entry[2]
+                entry[2:4] = [size, plc.changes]
+            over_budget = (PLC_CACHE_STATS['bytes'] >
+                           session.config.sys.postinglist_cache_mb << 20)
+        if over_budget:
+            PLC_CACHE_Evict(session)
         if uncached_cb and not found:
             uncached_cb()
         return plc
@@ -100,28 +278,73 @@ class PostingListContainer(object):
         self.words = {sig: set()}
 
         self.changes = 0
+        self.legacy = False
         self._load()
 
     def get(self, sig, default=None):
-        return self.words.get(sig, default)
+        with self.lock:
+            values = self.words.get(sig)
+            if values is None:
+                return default
+            if not isinstance(values, array):
+                values = self.words[sig] = sorted_hits(values)
+            return values
 
     def add(self, *args, **kwargs):
         with self.lock:
             return self._unlocked_add(*args, **kwargs)
 
+    def count(self, sig):
+        with self.lock:
+            return len(self.words.get(sig, ()))
+
+    @classmethod
+    def Estimate(cls, session, sig):
+        """
+        Estimate how many hits a sig has, without loading its container.
+        The count is exact if the container is cached, otherwise it comes
+        from the counts saved with the filters. Failing that, it is an
+        upper bound derived from the size of the container file.
+        """
+        count = PostingListFilters.Count(session, sig)
+        if count == 0:
+            return 0
+        fn, csig = cls._GetFilenameAndSig(session.config, sig)
+        with PLC_CACHE_LOCK:
+            entry = PLC_CACHE.get(csig)
+        if entry is not None:
+            return entry[1].count(sig)
+        if count is not None:
+            return count
+        try:
+            # Packed hits take at least one base64 encoded byte each
+            return (os.path.getsize(fn) * 3) // 4
+        except (IOError, OSError):
+            return 0
+
+    def memory_size(self):
+        """Estimate how many bytes of RAM this container is using."""
+        with self.lock:
+            total = sys.getsizeof(self.words)
+            for sig, values in self.words.iteritems():
+                total += sys.getsizeof(sig) + sys.getsizeof(values)
+                if not isinstance(values, array):
+                    total += len(values) * sys.getsizeof(0)
+            return total
+
     def remove(self, *args, **kwargs):
         with self.lock:
             self.changed = True
             return self._unlocked_remove(*args, **kwargs)
 
     def _deleted_set(self):
-        # FIXME!
-        return set()
+        return _deleted_set(self.config)
 
     def save(self, split=True):
         if not self.changes:
             return
 
+        PostingListFilters.Invalidate(self.session)
         if split and len(self.words) > 1:
             with self.lock:
                 for plc in self._splits():
@@ -132,12 +355,7 @@ class PostingListContainer(object):
         encryption_key = self.config.master_key
         outfile = self._SaveFile(self.config, self.sig)
         with self.lock:
-            # Optimizing for fast loads, so deletion only happens on save.
-            del_set = self._deleted_set()
-            output = '\n'.join('\t'.join(l) for l
-                               in ([sig] + [str(v) for v in (values-del_set)]
-                                   for sig, values in self.words.iteritems())
-                               if len(l) > 1)
+            output = self._unlocked_render()
             t.append(time.time())
 
             if not output:
@@ -160,12 +378,30 @@ class PostingListContainer(object):
 
             t.append(time.time())
             self.changes = 0
+            self.legacy = False
+            PostingListFilters.Saved(self.session, self.sig,
+                                     dict((k, len(v))
+                                          for k, v in self.words.iteritems()
+                                          if len(v)))
 
         if len(t) == 3:
             TIMERS['render'] += t[1] - t[0]
             TIMERS['save'] += t[2] - t[1]
             TIMERS['save_count'] += 1
 
+    def _unlocked_render(self):
+        # Optimizing for fast loads, so deletion only happens on save.
+        del_set = self._deleted_set()
+        lines = []
+        for sig in sorted(self.words.keys()):
+            values = self.words[sig]
+            if del_set:
+                values = [v for v in values if v not in del_set]
+            values = self.words[sig] = sorted_hits(values)
+            if values:
+                lines.append('%s\t%s' % (sig, pack_hits(values)))
+        return '\n'.join(lines)
+
     def _splits(self):
         splits = [self]
         if len(self.sig) < self.MAX_HASH_LEN:
@@ -230,24 +466,65 @@ class PostingListContainer(object):
         for line in lines:
             words = line.strip().split('\t')
             if len(words) > 1:
-                self._unlocked_add(words[0], words[1:])
+                if words[1][:1] != PACKED_MARKER:
+                    self.legacy = True
+                hits = unpack_hits(words[1:])
+                if self.words.get(words[0]):
+                    self._unlocked_add(words[0], hits)
+                else:
+                    self.words[words[0]] = hits
+
+    def _unlocked_values(self, sig):
+        # Sorted arrays are compact but immutable; modifications happen
+        # on a set, which gets compacted again on the next get or save.
+        values = self.words.get(sig)
+        if isinstance(values, array):
+            values = self.words[sig] = set(values)
+        return values
 
     def _unlocked_add(self, sig, values):
-        wset = set(values)
+        wset = _hit_set(values)
         self.changes += len(wset)
+        PostingListFilters.Added(self.session, self.sig, sig)
         if sig in self.words:
-            self.words[sig] |= wset
+            self._unlocked_values(sig).update(wset)
         else:
             self.words[sig] = wset
 
     def _unlocked_remove(self, sig, values):
-        wset = set(values)
+        wset = _hit_set(values)
         self.changes += len(wset)
         if sig in self.words:
-            self.words[sig] -= wset
-            if not self.words[sig]:
+            values = self._unlocked_values(sig)
+            values -= wset
+            if not values:
                 del self.words[sig]
 
+    @classmethod
+    def Migrate(cls, session):
+        """Rewrite any legacy text containers in the packed format."""
+        search_dir = os.path.join(session.config.workdir, 'search')
+        count = 0
+        if not os.path.isdir(search_dir):
+            return count
+        for prefix in sorted(os.listdir(search_dir)):
+            prefix_dir = os.path.join(search_dir, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for sig in sorted(os.listdir(prefix_dir)):
+                if mailpile.util.QUITTING:
+                    return count
+                plc = cls.Load(session, sig)
+                if plc.sig == sig and plc.legacy:
+                    session.ui.mark(_('Migrating posting lists: %s') % sig)
+                    with plc.lock:
+                        plc.changes += 1
+                        plc.save(split=False)
+                    count += 1
+                    play_nice_with_threads()
+            PLC_CACHE_FlushAndClean(session)
+        return count
+
     @classmethod
     def _SaveFile(cls, config, sig):
         return os.path.join(config.postinglist_dir(sig), sig)
@@ -273,6 +550,210 @@ class PostingListContainer(object):
         return (None, None)
 
 
+class PostingListFilters(object):
+    """
+    Bloom filters recording which sigs each container holds, so searches
+    for absent terms can skip loading (and decrypting) containers.
+
+    The filters for all containers are kept in one small file which is
+    loaded on first use and stays in memory. Along with each filter, the
+    file records the hit counts of the container's common sigs and a
+    typical count for the rest, so queries can be planned without loading
+    containers either. Adding to a container adds to its filter right
+    away. Saving a container rebuilds its filter and counts, so removals
+    and splits are reflected too. The file on disk is deleted before any
+    container is written and is saved again afterwards. A crash can
+    therefore never leave us with filters that are missing terms; we just
+    rebuild them.
+    """
+    COUNT_MIN_HITS = 64
+
+    @classmethod
+    def _SaveFile(cls, config):
+        return os.path.join(config.workdir, 'kw-filters.dat')
+
+    @classmethod
+    def _Load(cls, session):
+        global GLOBAL_FILTERS
+        with GLOBAL_FILTERS_LOCK:
+            if GLOBAL_FILTERS is not None:
+                return
+            GLOBAL_FILTERS = {}
+            GLOBAL_FILTER_COUNTS.clear()
+            filters, counts = {}, {}
+
+            def parse(lines):
+                for line in lines:
+                    words = line.strip().split('\t')
+                    if len(words) < 3:
+                        # Written before we kept counts, rebuild it all
+                        raise ValueError('Missing hit counts')
+                    filters[words[0]] = BloomFilter.Parse(words[1])
+                    typical = int(words[2])
+                    if typical:
+                        common = {}
+                        for pair in words[3:] and words[3].split(','):
+                            sig, count = pair.split(':')
+                            common[sig] = int(count)
+                        counts[words[0]] = (common, typical)
+
+            try:
+                with open(cls._SaveFile(session.config), 'rb') as fd:
+                    decrypt_and_parse_lines(fd, parse, session.config)
+                GLOBAL_FILTERS.update(filters)
+                GLOBAL_FILTER_COUNTS.update(counts)
+                GLOBAL_FILTERS_STATE['complete'] = True
+            except (ValueError, TypeError, IOError, OSError):
+                pass
+
+    @classmethod
+    def _Container(cls, sig):
+        # Mimic PostingListContainer._GetFilenameAndSig, without looking
+        # at the disk.
+        for i in range(min(len(sig), PostingListContainer.MAX_HASH_LEN),
+                       0, -1):
+            if sig[:i] in GLOBAL_FILTERS:
+                return sig[:i]
+        return None
+
+    @classmethod
+    def MaybeContains(cls, session, sig):
+        """
+        Return False if no container holds this sig, True if one might.
+        """
+        cls._Load(session)
+        with GLOBAL_FILTERS_LOCK:
+            if not GLOBAL_FILTERS_STATE['complete']:
+                return True
+            csig = cls._Container(sig)
+            return (csig is not None) and (sig in GLOBAL_FILTERS[csig])
+
+    @classmethod
+    def Count(cls, session, sig):
+        """
+        Return how many hits the containers hold for this sig, as of when
+        they were last saved: exact for common sigs, typical for the rest.
+        Returns 0 if no container holds the sig and None if we don't know.
+        """
+        cls._Load(session)
+        with GLOBAL_FILTERS_LOCK:
+            if not GLOBAL_FILTERS_STATE['complete']:
+                return None
+            csig = cls._Container(sig)
+            if (csig is None) or (sig not in GLOBAL_FILTERS[csig]):
+                return 0
+            if csig not in GLOBAL_FILTER_COUNTS:
+                return None
+            common, typical = GLOBAL_FILTER_COUNTS[csig]
+            return common.get(sig, typical)
+
+    @classmethod
+    def Added(cls, session, csig, sig):
+        cls._Load(session)
+        with GLOBAL_FILTERS_LOCK:
+            bf = GLOBAL_FILTERS.get(csig)
+            if bf is None:
+                bf = GLOBAL_FILTERS[csig] = BloomFilter()
+            bf.add(sig)
+
+    @classmethod
+    def Invalidate(cls, session):
+        """Called before writing a container: the saved filters are stale."""
+        cls._Load(session)
+        with GLOBAL_FILTERS_LOCK:
+            if not GLOBAL_FILTERS_STATE['dirty']:
+                GLOBAL_FILTERS_STATE['dirty'] = True
+                safe_remove(cls._SaveFile(session.config))
+
+    @classmethod
+    def Saved(cls, session, csig, counts):
+        """Record the sigs a container holds, given their hit counts."""
+        with GLOBAL_FILTERS_LOCK:
+            if counts:
+                GLOBAL_FILTERS[csig] = BloomFilter.Build(counts.keys())
+                common = dict((sig, count)
+                              for sig, count in counts.iteritems()
+                              if count >= cls.COUNT_MIN_HITS)
+                rare = [c for c in counts.itervalues()
+                        if c < cls.COUNT_MIN_HITS]
+                typical = max(1, sum(rare) // len(rare)) if rare else 1
+                GLOBAL_FILTER_COUNTS[csig] = (common, typical)
+            elif csig in GLOBAL_FILTERS:
+                del GLOBAL_FILTERS[csig]
+                GLOBAL_FILTER_COUNTS.pop(csig, None)
+
+    @classmethod
+    def Save(cls, session):
+        """Write the filters to disk, if they are complete and changed."""
+        config = session.config
+        with GLOBAL_FILTERS_LOCK:
+            if not (GLOBAL_FILTERS_STATE['complete'] and
+                    GLOBAL_FILTERS_STATE['dirty']):
+                return
+
+            def line(csig):
+                # A typical count of 0 means the counts are unknown
+                common, typical = GLOBAL_FILTER_COUNTS.get(csig, ({}, 0))
+                return '%s\t%s\t%d\t%s\n' % (
+                    csig, GLOBAL_FILTERS[csig].dumps(), typical,
+                    ','.join('%s:%d' % (sig, common[sig])
+                             for sig in sorted(common.keys())))
+            output = ''.join(line(csig)
+                             for csig in sorted(GLOBAL_FILTERS.keys()))
+            output = output.encode('utf-8')
+            outfile = cls._SaveFile(config)
+            encryption_key = config.master_key
+            if config.prefs.encrypt_index and encryption_key:
+                with EncryptingStreamer(encryption_key,
+                                        delimited=False,
+                                        dir=config.tempfile_dir(),
+                                        header_data={'subject': outfile},
+                                        name='PLF') as fd:
+                    fd.write(output)
+                    fd.save(outfile)
+            else:
+                with open(outfile + '.tmp', 'wb') as fd:
+                    fd.write(output)
+                if os.path.exists(outfile):
+                    os.remove(outfile)
+                os.rename(outfile + '.tmp', outfile)
+            GLOBAL_FILTERS_STATE['dirty'] = False
+
+    @classmethod
+    def Rebuild(cls, session):
+        """Build the filters for all containers, if they are incomplete."""
+        cls._Load(session)
+        if GLOBAL_FILTERS_STATE['complete']:
+            return 0
+        search_dir = os.path.join(session.config.workdir, 'search')
+        count = 0
+        if os.path.isdir(search_dir):
+            for prefix in sorted(os.listdir(search_dir)):
+                prefix_dir = os.path.join(search_dir, prefix)
+                if not os.path.isdir(prefix_dir):
+                    continue
+                for sig in sorted(os.listdir(prefix_dir)):
+                    if mailpile.util.QUITTING:
+                        return count
+                    if (count % 97) == 0:
+                        session.ui.mark(_('Building search filters: %s')
+                                        % sig)
+                    plc = PostingListContainer.Load(session, sig)
+                    with plc.lock:
+                        cls.Saved(session, plc.sig,
+                                  dict((k, len(v))
+                                       for k, v in plc.words.iteritems()
+                                       if len(v)))
+                    count += 1
+                    play_nice_with_threads()
+                PLC_CACHE_FlushAndClean(session, min_changes=100000)
+        with GLOBAL_FILTERS_LOCK:
+            GLOBAL_FILTERS_STATE['complete'] = True
+            GLOBAL_FILTERS_STATE['dirty'] = True
+        cls.Save(session)
+        return count
+
+
 class NewPostingList(object):
     """A posting list is a map of search terms to message IDs."""
 
@@ -294,17 +775,32 @@ class NewPostingList(object):
         if word:
             self.word = word
             self.sig = self._WordSig(word, self.config)
-            self.plc = PostingListContainer.Load(self.session, self.sig)
+            if PostingListFilters.MaybeContains(session, self.sig):
+                self.plc = PostingListContainer.Load(self.session, self.sig)
+            else:
+                self.plc = None
 
     def hits(self):
-        return self.plc.get(self.sig) or set()
+        if self.plc is None:
+            return array(HIT_TYPECODE)
+        return self.plc.get(self.sig, array(HIT_TYPECODE))
+
+    @classmethod
+    def Estimate(cls, session, word):
+        return PostingListContainer.Estimate(
+            session, cls._WordSig(word, session.config))
+
+    def _plc(self):
+        if self.plc is None:
+            self.plc = PostingListContainer.Load(self.session, self.sig)
+        return self.plc
 
     def append(self, *eids):
-        self.plc.add(self.sig, eids)
+        self._plc().add(self.sig, eids)
         return self
 
     def remove(self, eids):
-        self.plc.remove(self.sig, eids)
+        self._plc().remove(self.sig, eids)
         return self
 
     @classmethod
@@ -315,6 +811,373 @@ class NewPostingList(object):
                                   config.master_key))
 
 
+class PostingListSegment(object):
+    """
+    An immutable, sorted file of posting lists.
+
+    New keywords accumulate in the global posting list (the journal and
+    its in-memory copy), which is periodically flushed to a new tier-0
+    segment in a single sequential write. Once TIER_FANOUT segments
+    exist in a tier, they are merged into one segment in the next tier,
+    and segments which reach MAX_TIER are folded into the posting list
+    containers. Segments are never modified after they are written, and
+    searches take the union of the results from all of them, so a crash
+    between writing a segment and removing its sources is harmless.
+
+    File layout: MAGIC, the packed hits of each term, a table of
+    fixed-width (sig, offset, length) entries sorted by sig and finally a
+    trailer giving the tier, entry count and table offset. Unencrypted
+    segments are mmapped and terms are found by binary search, without
+    reading the rest of the file. Encrypted segments are decrypted into
+    memory on load.
+    """
+    MAGIC = 'MPSEG01\n'
+    SIG_LEN = PostingListContainer.MAX_HASH_LEN
+    ENTRY = struct.Struct('>%dsQI' % SIG_LEN)
+    TRAILER = struct.Struct('>IIQ')
+    SUFFIX = '.seg'
+    STAGED_SUFFIX = '.new'
+
+    TIER_FANOUT = 4
+    MAX_TIER = 3
+
+    _COUNTER = [0]
+
+    @classmethod
+    def _Key(cls, sig):
+        if isinstance(sig, unicode):
+            sig = sig.encode('utf-8')
+        return sig[:cls.SIG_LEN].ljust(cls.SIG_LEN, '\0')
+
+    @classmethod
+    def _SegmentDir(cls, config):
+        d = os.path.join(config.workdir, 'segments')
+        if not os.path.exists(d):
+            os.mkdir(d)
+        return d
+
+    @classmethod
+    def Segments(cls, session):
+        """Return a list of all the current segments."""
+        global GLOBAL_SEGMENTS
+        with GLOBAL_SEGMENTS_LOCK:
+            if GLOBAL_SEGMENTS is None:
+                GLOBAL_SEGMENTS = []
+                segdir = cls._SegmentDir(session.config)
+                for fn in sorted(os.listdir(segdir)):
+                    path = os.path.join(segdir, fn)
+                    if fn.endswith(cls.SUFFIX):
+                        try:
+                            GLOBAL_SEGMENTS.append(cls(session, path))
+                        except (ValueError, IOError, OSError):
+                            session.ui.warning('load(%s) %s'
+                                               % (fn, sys.exc_info()))
+                    else:
+                        # Left-overs from an interrupted write
+                        safe_remove(path)
+            return GLOBAL_SEGMENTS[:]
+
+    @classmethod
+    def Write(cls, session, tier, items, staged=False):
+        """
+        Write a new segment, given an iterable of (sig, hits) pairs in
+        sig order, and return it (or None if there was nothing to write).
+        The data is streamed to disk and only the table is kept in memory.
+
+        Staged segments are not searched until they are installed, and
+        are discarded on startup if that never happens.
+        """
+        # Load existing segments first, so ours is not taken for a leftover
+        cls.Segments(session)
+
+        config = session.config
+        cls._COUNTER[0] += 1
+        fn = '%d-%x-%x%s' % (tier, int(time.time() * 1000),
+                             cls._COUNTER[0] % 0x10000, cls.SUFFIX)
+        if staged:
+            fn += cls.STAGED_SUFFIX
+        path = os.path.join(cls._SegmentDir(config), fn)
+
+        encryption_key = config.master_key
+        encrypt = config.prefs.encrypt_index and encryption_key
+        if encrypt:
+            fd = EncryptingStreamer(encryption_key,
+                                    delimited=False,
+                                    dir=config.tempfile_dir(),
+                                    header_data={'subject': fn},
+                                    name='SEG/%s' % fn)
+        else:
+            fd = open(path + '.tmp', 'wb')
+
+        t0 = time.time()
+        with fd:
+            table, offset = [], len(cls.MAGIC)
+            fd.write(cls.MAGIC)
+            for sig, hits in items:
+                data = encode_hits(hits)
+                if data:
+                    fd.write(data)
+                    table.append(cls.ENTRY.pack(cls._Key(sig),
+                                                offset, len(data)))
+                    offset += len(data)
+            if table:
+                fd.write(''.join(table))
+                fd.write(cls.TRAILER.pack(tier, len(table), offset))
+            if encrypt:
+                fd.save(path if table else None)
+        if not encrypt:
+            if table:
+                os.rename(path + '.tmp', path)
+            else:
+                safe_remove(path + '.tmp')
+        if not table:
+            return None
+
+        TIMERS['save'] += time.time() - t0
+        TIMERS['save_count'] += 1
+        return cls(session, path)
+
+    @classmethod
+    def Flush(cls, session):
+        """
+        Write the global posting list out as a new tier-0 segment and
+        truncate the journal. Returns the number of terms flushed.
+        """
+        with GLOBAL_CHECKPOINT_LOCK:
+            return cls._Flush(session)
+
+    @classmethod
+    def _Flush(cls, session):
+        # Load existing segments first, so the new one is not loaded twice
+        cls.Segments(session)
+
+        global GLOBAL_GPL, GLOBAL_GPL_JOURNAL_BYTES
+        with GLOBAL_GPL_LOCK:
+            if not GLOBAL_GPL:
+                return 0
+            flushed = dict((sig, set(ids))
+                           for sig, ids in GLOBAL_GPL.iteritems() if ids)
+
+        session.ui.mark(_('Writing %d keywords to a new search segment')
+                        % len(flushed))
+        segment = cls.Write(session, 0, ((sig, sorted_hits(_b36_hits(ids)))
+                                         for sig, ids
+                                         in sorted(flushed.iteritems())))
+
+        # Holding the posting lock keeps appends from writing to the
+        # journal while it is being rewritten.
+        with GLOBAL_POSTING_LOCK, GLOBAL_GPL_LOCK:
+            if segment is not None:
+                cls._Replace([], segment)
+            for sig, ids in flushed.iteritems():
+                remaining = GLOBAL_GPL.get(sig)
+                if remaining is not None:
+                    remaining -= ids
+                    if not remaining:
+                        del GLOBAL_GPL[sig]
+            # Only the entries appended while we were writing the segment
+            # remain, so this is cheap and replay on startup is too.
+            GLOBAL_GPL_JOURNAL_BYTES = GlobalPostingList(session, '').save()
+        return len(flushed)
+
+    @classmethod
+    def Install(cls, session, staged):
+        """
+        Replace the entire search index (containers, filters, journal and
+        segments) with a list of staged segments, as written when the
+        index is rebuilt from scratch.
+        """
+        global GLOBAL_GPL, GLOBAL_GPL_JOURNAL_BYTES, GLOBAL_FILTERS
+        old = cls.Segments(session)
+        with GLOBAL_OPTIMIZE_LOCK, GLOBAL_CHECKPOINT_LOCK, \
+                GLOBAL_POSTING_LOCK, GLOBAL_GPL_LOCK:
+            for segment in staged:
+                filename = segment.filename[:-len(cls.STAGED_SUFFIX)]
+                os.rename(segment.filename, filename)
+                segment.filename = filename
+
+            with PLC_CACHE_LOCK:
+                PLC_CACHE.clear()
+                PLC_CACHE_STATS['bytes'] = 0
+            search_dir = os.path.join(session.config.workdir, 'search')
+            if os.path.isdir(search_dir):
+                for prefix in os.listdir(search_dir):
+                    prefix_dir = os.path.join(search_dir, prefix)
+                    if os.path.isdir(prefix_dir):
+                        for fn in os.listdir(prefix_dir):
+                            safe_remove(os.path.join(prefix_dir, fn))
+
+            # There are no containers left, so the filters are complete.
+            with GLOBAL_FILTERS_LOCK:
+                safe_remove(PostingListFilters._SaveFile(session.config))
+                GLOBAL_FILTERS = {}
+                GLOBAL_FILTER_COUNTS.clear()
+                GLOBAL_FILTERS_STATE['complete'] = True
+                GLOBAL_FILTERS_STATE['dirty'] = True
+
+            GLOBAL_GPL = {}
+            GLOBAL_GPL_JOURNAL_BYTES = GlobalPostingList(session, '').save()
+
+            cls._Replace(old, None)
+            for segment in staged:
+                cls._Replace([], segment)
+        PostingListFilters.Save(session)
+
+    @classmethod
+    def Merge(cls, session, force=False, runtime=0):
+        """
+        Merge full tiers into the next one up, folding the top tier into
+        the posting list containers. If forced, all segments are merged
+        and folded. Returns the number of segments merged.
+        """
+        starttime = time.time()
+        count = 0
+        for tier in range(0, cls.MAX_TIER + 1):
+            segments = [s for s in cls.Segments(session) if s.tier == tier]
+            while segments and (force or len(segments) >= cls.TIER_FANOUT):
+                if mailpile.util.QUITTING:
+                    return count
+                if runtime and starttime + runtime < time.time():
+                    return count
+                batch = segments[:cls.TIER_FANOUT]
+                segments = segments[cls.TIER_FANOUT:]
+                if tier < cls.MAX_TIER and not force:
+                    session.ui.mark(_('Merging %d search segments (tier %d)')
+                                    % (len(batch), tier))
+                    merged = cls.Write(session, tier + 1,
+                                       cls._MergedItems(
+                                           batch,
+                                           _deleted_set(session.config)))
+                    cls._Replace(batch, merged)
+                else:
+                    cls._Fold(session, batch)
+                count += len(batch)
+                play_nice_with_threads()
+        return count
+
+    @classmethod
+    def _MergedItems(cls, segments, deleted=None):
+        def merged(hits):
+            hits = set().union(*hits)
+            if deleted:
+                hits = [h for h in hits if h not in deleted]
+            return sorted_hits(hits)
+
+        last_sig, last_hits = None, []
+        for sig, hits in heapq.merge(*[s.iteritems() for s in segments]):
+            if sig != last_sig:
+                if last_hits:
+                    yield last_sig, merged(last_hits)
+                last_sig, last_hits = sig, []
+            last_hits.append(hits)
+        if last_hits:
+            yield last_sig, merged(last_hits)
+
+    @classmethod
+    def _Fold(cls, session, segments):
+        session.ui.mark(_('Folding %d search segments into posting lists')
+                        % len(segments))
+        for count, (sig, hits) in enumerate(cls._MergedItems(segments)):
+            if (count % 7) == 0:
+                PLC_CACHE_FlushAndClean(session, min_changes=100000)
+            PostingList.Append(session, sig, hits, sig=sig)
+        PLC_CACHE_FlushAndClean(session)
+        cls._Replace(segments, None)
+
+    @classmethod
+    def _Replace(cls, old, new):
+        global GLOBAL_SEGMENTS
+        with GLOBAL_SEGMENTS_LOCK:
+            segments = [s for s in GLOBAL_SEGMENTS if s not in old]
+            if new is not None:
+                segments.append(new)
+            GLOBAL_SEGMENTS = segments
+        # Searches may still be reading the old segments, so we leave
+        # unmapping them to the garbage collector.
+        for segment in old:
+            safe_remove(segment.filename)
+
+    def __init__(self, session, filename):
+        self.config = session.config
+        self.filename = filename
+        self.tier = int(os.path.basename(filename).split('-')[0])
+        self.data = None
+        self._load()
+
+    def _load(self):
+        t0 = time.time()
+        with open(self.filename, 'rb') as fd:
+            if fd.read(len(self.MAGIC)) == self.MAGIC:
+                try:
+                    self.data = mmap.mmap(fd.fileno(), 0,
+                                          access=mmap.ACCESS_READ)
+                except (ValueError, EnvironmentError):
+                    fd.seek(0)
+                    self.data = fd.read()
+            else:
+                from mailpile.crypto.streamer import DecryptingStreamer
+                fd.seek(0)
+                name = os.path.basename(self.filename)
+                with DecryptingStreamer(fd, mep_key=self.config.master_key,
+                                        name='SEG/%s' % name) as streamer:
+                    self.data = streamer.read()
+                    streamer.verify(_raise=IOError)
+
+        data = self.data
+        if (len(data) < len(self.MAGIC) + self.TRAILER.size or
+                data[:len(self.MAGIC)] != self.MAGIC):
+            raise ValueError('Invalid segment: %s' % self.filename)
+        tier, self.count, self.table = self.TRAILER.unpack(
+            data[-self.TRAILER.size:])
+        if (self.table + self.count * self.ENTRY.size !=
+                len(data) - self.TRAILER.size):
+            raise ValueError('Corrupt segment: %s' % self.filename)
+        TIMERS['load'] += time.time() - t0
+        TIMERS['load_count'] += 1
+
+    def _entry(self, i):
+        pos = self.table + i * self.ENTRY.size
+        sig, offset, length = self.ENTRY.unpack(
+            self.data[pos:pos + self.ENTRY.size])
+        return sig.rstrip('\0'), offset, length
+
+    def _find(self, sig):
+        """Find the (offset, length) of a sig's hits by binary search."""
+        data, size, table = self.data, self.ENTRY.size, self.table
+        key = self._Key(sig)
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos = table + mid * size
+            if data[pos:pos + self.SIG_LEN] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count:
+            pos = table + lo * size
+            esig, offset, length = self.ENTRY.unpack(data[pos:pos + size])
+            if esig == key:
+                return offset, length
+        return None
+
+    def get(self, sig, default=None):
+        found = self._find(sig)
+        if found is None:
+            return default
+        offset, length = found
+        return decode_hits(self.data[offset:offset + length])
+
+    def estimate(self, sig):
+        """Return an upper bound on the number of hits, without decoding."""
+        found = self._find(sig)
+        return found[1] if found else 0
+
+    def iteritems(self):
+        for i in xrange(0, self.count):
+            sig, offset, length = self._entry(i)
+            yield sig, decode_hits(self.data[offset:offset + length])
+
+
 ##############################################################################
 
 class OldPostingList(object):
@@ -558,6 +1421,10 @@ class OldPostingList(object):
     def hits(self):
         return self.WORDS[self.sig]
 
+    @classmethod
+    def Estimate(cls, session, word):
+        return len(cls(session, word).hits())
+
     def append(self, eid):
         with self.lock:
             if self.sig not in self.WORDS:
@@ -580,46 +1447,20 @@ class GlobalPostingList(OldPostingList):
     @classmethod
     def _Optimize(cls, session, idx,
                   force=False, lazy=False, quick=False, ratio=1.0, runtime=0):
+        # Note: the ratio is ignored now that the whole global posting list
+        # is written out as a single segment; it is kept for compatibility.
         starttime = time.time()
         count = 0
-        global GLOBAL_GPL
         if (GLOBAL_GPL and (not lazy or len(GLOBAL_GPL) > 5*1024)):
-            # Processing keys in order is more efficient, as it lets things
-            # accumulate in the PLC_CACHE.
-            keys = sorted(GLOBAL_GPL.keys())
-            if ratio:
-                keyn = int(len(keys) * ratio)
-                start = random.randint(0, len(keys))
-                # This lets the selection wrap around to the beginning,
-                # so we don't have a bias against writing out the first
-                # keys compared with the others.
-                keys += keys
-                keys = keys[start:start+keyn]
-
-            pls = GlobalPostingList(session, '')
-            for sig in keys:
-                if (count % 7) == 0:
-                    PLC_CACHE_FlushAndClean(session, min_changes=100000)
-                if (count % 97) == 0:
-                    session.ui.mark(('Updating search index... %d%% (%s)'
-                                     ) % (count * 100 / len(keys), sig))
-
-                # If we're doing a full optimize later, we disable the
-                # compaction here. Otherwise it follows the normal
-                # rules (compacts as necessary).
-                pls._migrate(sig, compact=quick)
-                count += 1
-                if mailpile.util.QUITTING:
-                    break
-                if runtime and starttime + (0.80 * runtime) < time.time():
-                    break
-            PLC_CACHE_FlushAndClean(session)
-            pls.save()
+            count = PostingListSegment.Flush(session)
 
         if quick or mailpile.util.QUITTING:
             return count
-        else:
-            return OldPostingList._Optimize(session, idx, force=force)
+        PostingListFilters.Rebuild(session)
+        if runtime:
+            runtime = max(1, starttime + runtime - time.time())
+        PostingListSegment.Merge(session, force=force, runtime=runtime)
+        return count
 
     @classmethod
     def SaveFile(cls, session, prefix):
@@ -633,19 +1474,91 @@ class GlobalPostingList(OldPostingList):
         except (IOError, OSError):
             return (None, 'kw-journal.dat')
 
+    @classmethod
+    def Append(cls, session, *args, **kwargs):
+        cls.Lock(GLOBAL_POSTING_LOCK, cls._Append, session, *args, **kwargs)
+        cls._MaybeCheckpoint(session)
+
+    @classmethod
+    def AppendMany(cls, session, *args, **kwargs):
+        cls.Lock(GLOBAL_POSTING_LOCK, cls._AppendMany,
+                 session, *args, **kwargs)
+        cls._MaybeCheckpoint(session)
+
+    @classmethod
+    def _MaybeCheckpoint(cls, session):
+        """
+        Keep the journal (and the memory used by the global posting list)
+        bounded, by checkpointing it to a search segment once it grows
+        past sys.postinglist_journal_kb. This normally happens on the save
+        worker, but if that falls behind we checkpoint right away.
+
+        This must not be called with GLOBAL_POSTING_LOCK held.
+        """
+        limit = 1024 * session.config.sys.postinglist_journal_kb
+        if GLOBAL_GPL_JOURNAL_BYTES > 2 * limit:
+            PostingListSegment.Flush(session)
+        elif GLOBAL_GPL_JOURNAL_BYTES > limit:
+            session.config.save_worker.add_unique_task(
+                session, 'Checkpoint keyword journal',
+                lambda: PostingListSegment.Flush(session))
+
     @classmethod
     def _Append(cls, session, word, mail_ids, compact=True):
-        super(GlobalPostingList, cls)._Append(session, word, mail_ids,
-                                              compact=compact)
+        return cls._AppendMany(session, {word: mail_ids}, compact=compact)
+
+    @classmethod
+    def _AppendMany(cls, session, words, compact=True):
+        """
+        Record many keywords at once, given a dict mapping each keyword to
+        a list of message IDs. The keywords are hashed and grouped by
+        signature, written to the journal in a single write and merged
+        into the global posting list under a single lock acquisition.
+
+        The compact argument is ignored; checkpoints keep the journal small.
+        """
+        config = session.config
+        sigs = {}
+        for word, mail_ids in words.iteritems():
+            try:
+                sig = cls.WordSig(word, config)
+            except UnicodeDecodeError:
+                # FIXME: we just ignore garbage
+                continue
+            if sig in sigs:
+                sigs[sig] |= set(mail_ids)
+            else:
+                sigs[sig] = set(mail_ids)
+        if not sigs:
+            return
+
+        output = ''.join('%s\t%s\n' % (sig, '\t'.join(sorted(sigs[sig])))
+                         for sig in sorted(sigs.keys()))
+        fd = None
+        while fd is None:
+            fd, fn = cls.GetFile(session, '', mode='a')
+            try:
+                if fd:
+                    with fd:
+                        fd.write(output)
+                else:
+                    raise IOError('Failed to open %s' % fn)
+            except IOError:
+                print ('RETRY: APPEND_MANY(%d sigs) %s'
+                       % (len(sigs), sys.exc_info()))
+                time.sleep(0.2)
+                fd = None
+
         with GLOBAL_GPL_LOCK:
-            global GLOBAL_GPL
-            sig = cls.WordSig(word, session.config)
+            global GLOBAL_GPL, GLOBAL_GPL_JOURNAL_BYTES
             if GLOBAL_GPL is None:
                 GLOBAL_GPL = {}
-            if sig not in GLOBAL_GPL:
-                GLOBAL_GPL[sig] = set()
-            for mail_id in mail_ids:
-                GLOBAL_GPL[sig].add(mail_id)
+            for sig, mail_ids in sigs.iteritems():
+                if sig in GLOBAL_GPL:
+                    GLOBAL_GPL[sig] |= mail_ids
+                else:
+                    GLOBAL_GPL[sig] = mail_ids
+            GLOBAL_GPL_JOURNAL_BYTES += len(output)
 
     def __init__(self, *args, **kwargs):
         with GLOBAL_GPL_LOCK:
@@ -661,28 +1574,42 @@ class GlobalPostingList(OldPostingList):
     def load(self):
         with self.lock:
             self.filename = 'kw-journal.dat'
-            global GLOBAL_GPL
-            if GLOBAL_GPL:
+            global GLOBAL_GPL, GLOBAL_GPL_JOURNAL_BYTES
+            if GLOBAL_GPL is not None:
                 self.WORDS = GLOBAL_GPL
             else:
                 OldPostingList.load(self)
                 GLOBAL_GPL = self.WORDS
-
-    def _migrate(self, sig=None, compact=True):
-        with self.lock:
-            sig = sig or self.sig
-            if sig in self.WORDS and len(self.WORDS[sig]) > 0:
-                PostingList.Append(self.session, sig, self.WORDS[sig],
-                                   sig=sig, compact=compact)
-                del self.WORDS[sig]
+                GLOBAL_GPL_JOURNAL_BYTES = self.size
 
     def remove(self, eids):
+        # Segments are immutable, so this only affects the containers and
+        # the journal; run a forced optimize first to fold segments in.
         PostingList(self.session, self.word).remove(eids).save()
         return OldPostingList.remove(self, eids)
 
     def hits(self):
-        return (self.WORDS.get(self.sig, set())
-                | PostingList(self.session, self.word).hits())
+        hits = PostingList(self.session, self.word).hits()
+        if NEW_POSTING_LIST:
+            hits = Bitmap(hits)
+        else:
+            hits = Bitmap(_b36_hits(hits))
+        with self.lock:
+            hits.update(_b36_hits(self.WORDS.get(self.sig, [])))
+            segments = PostingListSegment.Segments(self.session)
+        for segment in segments:
+            hits.update(segment.get(self.sig, []))
+        return hits
+
+    def estimate(self):
+        """Cheaply estimate the number of hits, for query planning."""
+        count = PostingList.Estimate(self.session, self.word)
+        with self.lock:
+            count += len(self.WORDS.get(self.sig, []))
+            segments = PostingListSegment.Segments(self.session)
+        for segment in segments:
+            count += segment.estimate(self.sig)
+        return count
 
 
 if NEW_POSTING_LIST:
@@ -1,5 +1,6 @@
 import cStringIO
 import email
+import heapq
 import lxml.html
 import random
 import re
@@ -7,6 +8,9 @@ import rfc822
 import time
 import threading
 import traceback
+from array import array
+from itertools import count as icount, imap, islice, izip
+from operator import lt, ne
 from urllib import quote, unquote
 
 import mailpile.util
@@ -17,7 +21,12 @@ from mailpile.eventlog import GetThreadEvent
 from mailpile.i18n import gettext as _
 from mailpile.i18n import ngettext as _n
 from mailpile.index.base import BaseIndex
+from mailpile.index.bitmap import Bitmap
+from mailpile.index.columns import MessageColumns
+from mailpile.index.digestmap import DigestMap
 from mailpile.index.search import SearchResultSet, CachedSearchResultSet
+from mailpile.index.snapshot import MetadataSnapshot
+from mailpile.index.threads import ThreadSummaries
 from mailpile.plugins import PluginManager
 from mailpile.mailutils import FormatMbxId, MBX_ID_LEN, NoSuchMailboxError
 from mailpile.mailutils import AddressHeaderParser, GetTextPayload
@@ -38,8 +47,10 @@ _plugins = PluginManager()
 class MailIndex(BaseIndex):
     """This is a lazily parsing object representing a mailpile index."""
 
-    MAX_INCREMENTAL_SAVES = 25
-    MAX_CACHE_ENTRIES = 2500
+    SNAPSHOT_MARKER = '# Snapshot:'
+    RECORD_MARKER = '# Record:'
+    SAVE_BLOCK_LINES = 10000
+    KEYWORD_BATCH_SIZE = 100
     CAPABILITIES = set([
         BaseIndex.CAN_SEARCH,
         BaseIndex.CAN_SORT,
@@ -50,34 +61,35 @@ class MailIndex(BaseIndex):
     def __init__(self, config):
         BaseIndex.__init__(self, config)
         self.interrupt = None
-        self.INDEX = []
+        self.INDEX = MessageColumns()
         self.INDEX_SORT = {}
-        self.INDEX_THR = []
-        self.PTRS = {}
+        self.PTRS = DigestMap()
         self.TAGS = {}
-        self.MSGIDS = {}
+        self.TAG_STATS = None
+        self._tag_stats_classes = None
+        self.MSGIDS = DigestMap()
+        self.SUBJECTS = None
+        self.DELETED = Bitmap()
         self.MODIFIED = set()
         self.EMAILS_SAVED = 0
         self._scanned = {}
-        self._saved_changes = 0
+        self._log_bytes = 0
         self._lock = SearchRLock()
         self._save_lock = SearchRLock()
+        self._checkpoint_lock = SearchLock()
+        self._kw_lock = SearchLock()
+        self._kw_batch = None
+        self._kw_batch_count = 0
+        self._kw_batchers = 0
+        self._subjects_lock = SearchLock()
         self._prepare_sorting()
+        self.CACHE.resize(config.sys.msg_cache_entries)
 
     @classmethod
     def l2m(self, line):
         return line.decode('utf-8').split(u'\t')
 
-    # A translation table for message parts stored in the index, consists of
-    # a mapping from unicode ordinals to either another unicode ordinal or
-    # None, to remove a character. By default it removes the ASCII control
-    # characters and replaces tabs and newlines with spaces.
-    NORM_TABLE = dict([(i, None) for i in range(0, 0x20)], **{
-        ord(u'\t'): ord(u' '),
-        ord(u'\r'): ord(u' '),
-        ord(u'\n'): ord(u' '),
-        0x7F: None
-    })
+    NORM_TABLE = MessageColumns.NORM_TABLE
 
     @classmethod
     def m2l(self, message):
@@ -87,74 +99,111 @@ class MailIndex(BaseIndex):
         return (u'\t'.join(parts)).encode('utf-8')
 
     def load(self, session=None):
-        self.INDEX = []
-        self.CACHE = {}
-        self.PTRS = {}
-        self.MSGIDS = {}
+        self.INDEX = MessageColumns()
+        self._prepare_sorting()
+        self.DELETED = Bitmap()
+        self.CACHE.clear()
+        self.PTRS = DigestMap()
+        self.MSGIDS = DigestMap()
+        self.SUBJECTS = None
+        self.TAG_STATS = None
         self.EMAILS = []
         self.EMAIL_IDS = {}
+        self.EMAIL_GRAMS = None
         CachedSearchResultSet.DropCaches()
         bogus_lines = []
+        records = []
+        pending = []
+        snapshot = []
 
         def process_lines(lines):
             for line in lines:
-                line = line.strip()
-                if line[:1] in ('#', ''):
-                    pass
-                elif line[:1] == '@':
-                    try:
-                        pos, email = line[1:].split('\t', 1)
-                        pos = int(pos, 36)
-                        while len(self.EMAILS) < pos + 1:
-                            self.EMAILS.append('')
-                        unquoted_email = unquote(email).decode('utf-8')
-                        self.EMAILS[pos] = unquoted_email
-                        self.EMAIL_IDS[unquoted_email.split()[0].lower()] = pos
-                    except (ValueError, IndexError, TypeError):
-                        bogus_lines.append(line)
-                else:
-                    bogus = False
-                    words = line.split('\t')
+                if line.startswith(self.RECORD_MARKER):
+                    # Changes are only applied once we have seen all of
+                    # them; torn or corrupt records are discarded.
+                    records.append(line)
+                    if line.split()[-1] == self._checksum(pending):
+                        for pline in pending:
+                            process_line(pline.strip())
+                    elif session:
+                        session.ui.error(_('Discarded corrupt changes in '
+                                           'metadata index'))
+                    pending[:] = []
+                elif line.startswith(self.SNAPSHOT_MARKER):
+                    generation = line[len(self.SNAPSHOT_MARKER):].strip()
+                    if not self._load_snapshot(session, generation):
+                        # We crashed after writing a new snapshot, but
+                        # before writing the index which refers to it.
+                        # The snapshot is newer than anything here, but
+                        # replaying the whole log still brings it up to
+                        # date, as each change records the full state of
+                        # a message.
+                        if session:
+                            session.ui.warning(_('Metadata snapshot is '
+                                                 'newer than the index, '
+                                                 'replaying changes'))
+                    snapshot.append(generation)
+                elif line[:1] not in ('#', ''):
+                    pending.append(line)
+
+        def process_line(line):
+            if line[:1] in ('#', ''):
+                pass
+            elif line[:1] == '@':
+                try:
+                    pos, email = line[1:].split('\t', 1)
+                    pos = int(pos, 36)
+                    while len(self.EMAILS) < pos + 1:
+                        self.EMAILS.append('')
+                    unquoted_email = unquote(email).decode('utf-8')
+                    self.EMAILS[pos] = unquoted_email
+                    self.EMAIL_IDS[unquoted_email.split()[0].lower()] = pos
+                except (ValueError, IndexError, TypeError):
+                    bogus_lines.append(line)
+            else:
+                bogus = False
+                words = line.split('\t')
 
-                    # Migration: converting old metadata into new!
-                    if len(words) != self.MSG_FIELDS_V2:
+                # Migration: converting old metadata into new!
+                if len(words) != self.MSG_FIELDS_V2:
 
-                        # V1 -> V2 adds MSG_CC and MSG_KB
-                        if len(words) == self.MSG_FIELDS_V1:
-                            words[self.MSG_CC:self.MSG_CC] = ['']
-                            words[self.MSG_KB:self.MSG_KB] = ['0']
+                    # V1 -> V2 adds MSG_CC and MSG_KB
+                    if len(words) == self.MSG_FIELDS_V1:
+                        words[self.MSG_CC:self.MSG_CC] = ['']
+                        words[self.MSG_KB:self.MSG_KB] = ['0']
 
-                        # Add V2 -> V3 here, etc. etc.
+                    # Add V2 -> V3 here, etc. etc.
 
-                        if len(words) == self.MSG_FIELDS_V2:
-                            line = '\t'.join(words)
-                        else:
-                            bogus = True
+                    if len(words) == self.MSG_FIELDS_V2:
+                        line = '\t'.join(words)
+                    else:
+                        bogus = True
 
-                    if not bogus:
-                        try:
-                            pos = int(words[self.MSG_MID], 36)
-                            self.set_msg_at_idx_pos(pos, words,
-                                                    original_line=line)
-                            if session and len(self.INDEX) % 107 == 100:
-                                session.ui.mark(
-                                    _('Loading metadata index...') +
-                                    ' %s' % len(self.INDEX))
-                        except ValueError:
-                            bogus = True
-
-                    if bogus:
-                        bogus_lines.append(line)
-                        if len(bogus_lines) > max(0.02 * len(self.INDEX), 50):
-                            raise Exception(_('Your metadata index is '
-                                              'either too old, too new '
-                                              'or corrupt!'))
-                        elif session and 1 == len(bogus_lines) % 100:
-                            session.ui.error(_('Corrupt data in metadata '
-                                               'index! Trying to cope...'))
+                if not bogus:
+                    try:
+                        pos = int(words[self.MSG_MID], 36)
+                        self.set_msg_at_idx_pos(pos, words,
+                                                original_line=line)
+                        if session and len(self.INDEX) % 107 == 100:
+                            session.ui.mark(
+                                _('Loading metadata index...') +
+                                ' %s' % len(self.INDEX))
+                    except ValueError:
+                        bogus = True
+
+                if bogus:
+                    bogus_lines.append(line)
+                    if len(bogus_lines) > max(0.02 * len(self.INDEX), 50):
+                        raise Exception(_('Your metadata index is '
+                                          'either too old, too new '
+                                          'or corrupt!'))
+                    elif session and 1 == len(bogus_lines) % 100:
+                        session.ui.error(_('Corrupt data in metadata '
+                                           'index! Trying to cope...'))
 
         if session:
             session.ui.mark(_('Loading metadata index...'))
+        size = log_start = 0
         try:
             import mailpile.mail_source
             with self._save_lock, self._lock:
@@ -169,9 +218,37 @@ class MailIndex(BaseIndex):
                                              % offset)
                     # FIXME: Differentiate between partial index and no index?
                     gpgi = GnuPG(self.config, event=GetThreadEvent())
-                    decrypt_and_parse_lines(fd, process_lines, self.config,
-                        newlines=True, decode=False, gpgi=gpgi,
-                        _raise=False, error_cb=warn)
+                    size = os.fstat(fd.fileno()).st_size
+                    # Blocks are decrypted in parallel, but applied in order.
+                    start = 0
+                    for offset, data in decrypt_blocks(
+                            split_encrypted_blocks(fd), self.config,
+                            gpgi=gpgi, _raise=False, error_cb=warn):
+                        process_lines(data.splitlines())
+                        if snapshot and not log_start:
+                            # The log of changes starts after the marker.
+                            if len(data) == offset - start:
+                                marker = data.index(self.SNAPSHOT_MARKER)
+                                log_start = (start + 1 +
+                                             data.index('\n', marker))
+                            else:
+                                log_start = offset
+                        start = offset
+                        if session:
+                            session.ui.mark(
+                                _('Loading metadata index...') +
+                                ' %d%%' % (100 * offset // max(1, size)))
+
+                    if pending and records:
+                        # We crashed while logging changes.
+                        if session:
+                            session.ui.warning(_('Discarded incomplete '
+                                                 'changes in metadata index'))
+                    else:
+                        # Index files from before changes were logged in
+                        # records have no checksums, just take them as is.
+                        for line in pending:
+                            process_line(line.strip())
         except IOError:
             if session:
                 session.ui.warning(_('Metadata index not found: %s'
@@ -189,22 +266,160 @@ class MailIndex(BaseIndex):
                 session.ui.warning(_('Recovered! Wrote bad metadata to: %s'
                                      ) % bogus_file)
 
+        self._log_bytes = max(0, size - log_start)
         if session:
             session.ui.mark(_n('Loaded metadata, %d message',
                                'Loaded metadata, %d messages',
                                len(self.INDEX)
                                ) % len(self.INDEX))
         self.EMAILS_SAVED = len(self.EMAILS)
+        self.EMAIL_GRAMS = None
+
+    def _snapshot_file(self):
+        return '%s.bin' % self.config.mailindex_file()
+
+    def _load_snapshot(self, session, generation):
+        """
+        Load the metadata from a binary snapshot. Returns False if the
+        snapshot is not the one the index file refers to.
+        """
+        if session:
+            session.ui.mark(_('Loading metadata snapshot...'))
+        try:
+            snapshot = MetadataSnapshot(self.config, self._snapshot_file())
+            self.INDEX = snapshot.columns()
+            emails = snapshot.emails()
+            deleted = snapshot.deleted()
+            msgids = snapshot.digest_map('msgids')
+            ptrs = snapshot.digest_map('ptrs')
+        except (ValueError, IOError, OSError), e:
+            raise Exception(_('Failed to load metadata snapshot: %s') % e)
+
+        self.EMAILS = emails
+        self.EMAIL_IDS = dict((e.split()[0].lower(), eid)
+                              for eid, e in enumerate(emails) if e)
+        self.EMAIL_GRAMS = None
+        self.SUBJECTS = None
+        self.DELETED = Bitmap(deleted)
+
+        # The derived indexes are rebuilt from the columns, without
+        # decoding any of the strings other than the message pointers
+        # (and not even those, if the snapshot has the maps).
+        if msgids is not None and ptrs is not None:
+            self.MSGIDS, self.PTRS = msgids, ptrs
+        else:
+            self.update_ptrs_and_msgids(session)
+        tagsets = {}
+        msg_ids, tags = self.INDEX.msg_ids, self.INDEX.tags
+        for pos in xrange(0, len(msg_ids)):
+            if msg_ids[pos] is not None:
+                if tags[pos] in tagsets:
+                    tagsets[tags[pos]].append(pos)
+                else:
+                    tagsets[tags[pos]] = [pos]
+        tag_positions = {}
+        for positions in tagsets.itervalues():
+            for tid in self.INDEX.tag_list(positions[0]):
+                if tid not in tag_positions:
+                    tag_positions[tid] = []
+                tag_positions[tid].extend(positions)
+        self.TAGS = dict((tid, Bitmap(positions))
+                         for tid, positions in tag_positions.iteritems())
+        self.TAG_STATS = None
+        for order, sorter in self.SORT_ORDERS.iteritems():
+            self.INDEX_SORT[order] = array('l', (
+                sorter(self, pos) for pos in xrange(0, len(msg_ids))))
+        self._rebuild_thread_summaries()
+
+        return (snapshot.generation == generation)
+
+    def _can_snapshot(self):
+        # Snapshots are encrypted with the master key, if we have one. We
+        # do not write them at all for the legacy GnuPG-encrypted index.
+        gpgr = self.config.prefs.gpg_recipient
+        return (self.config.master_key or
+                gpgr in (None, '', '!CREATE', '!PASSWORD'))
 
     def update_msg_tags(self, msg_idx_pos, msg_info):
         tags = set(self.get_tags(msg_info=msg_info))
         with self._lock:
-            for tid in (set(self.TAGS.keys()) - tags):
-                self.TAGS[tid] -= set([msg_idx_pos])
-            for tid in tags:
+            old_tags = set(tid for tid, msg_idxs in self.TAGS.iteritems()
+                           if msg_idx_pos in msg_idxs)
+            for tid in (old_tags - tags):
+                self.TAGS[tid].discard(msg_idx_pos)
+            for tid in (tags - old_tags):
                 if tid not in self.TAGS:
-                    self.TAGS[tid] = set()
+                    self.TAGS[tid] = Bitmap()
                 self.TAGS[tid].add(msg_idx_pos)
+            self._update_tag_stats(old_tags, tags)
+
+    def _tag_classes(self):
+        return (frozenset(t._key for t in
+                          self.config.get_tags(type='unread', default=[])),
+                frozenset(t._key for t in
+                          self.config.get_tags(flag_hides=True, default=[])))
+
+    def _count_tags(self, tags, delta):
+        unread_tids, hidden_tids = self._tag_stats_classes
+        unread = bool(unread_tids & tags)
+        visible = not (hidden_tids & tags)
+        for tid in tags:
+            counts = self.TAG_STATS.get(tid)
+            if counts is None:
+                counts = self.TAG_STATS[tid] = [0, 0, 0, 0]
+            counts[0] += delta
+            if unread:
+                counts[1] += delta
+            if visible:
+                counts[2] += delta
+                if unread:
+                    counts[3] += delta
+
+    def _update_tag_stats(self, old_tags, new_tags):
+        # Call with the lock held, whenever TAGS changes
+        if self.TAG_STATS is not None and old_tags != new_tags:
+            self._count_tags(old_tags, -1)
+            self._count_tags(new_tags, 1)
+
+    def get_tag_stats(self, tag_id):
+        """
+        Count the messages with a tag, returning a tuple of how many there
+        are, how many are unread, and the same two numbers again leaving
+        out messages with tags which hide them. The counts are kept up to
+        date as messages get tagged and untagged.
+        """
+        classes = self._tag_classes()
+        with self._lock:
+            if (self.TAG_STATS is None or
+                    classes != self._tag_stats_classes):
+                # First use, or the unread or hiding tags have changed
+                unread, hidden = Bitmap(), Bitmap()
+                for tid in classes[0]:
+                    unread |= self.TAGS.get(tid, Bitmap())
+                for tid in classes[1]:
+                    hidden |= self.TAGS.get(tid, Bitmap())
+                self.TAG_STATS = {}
+                for tid, msg_idxs in self.TAGS.iteritems():
+                    visible = msg_idxs - hidden
+                    self.TAG_STATS[tid] = [len(msg_idxs),
+                                           len(msg_idxs & unread),
+                                           len(visible),
+                                           len(visible & unread)]
+                self._tag_stats_classes = classes
+            return tuple(self.TAG_STATS.get(tag_id, (0, 0, 0, 0)))
+
+    def update_msg_deleted(self, msg_idx_pos, msg_info):
+        # The bitmap is replaced rather than modified, so searches can use
+        # it without locking.
+        deleted = (msg_info[self.MSG_BODY] == self.MSG_BODY_DELETED)
+        with self._lock:
+            if deleted != (msg_idx_pos in self.DELETED):
+                bm = self.DELETED.copy()
+                if deleted:
+                    bm.add(msg_idx_pos)
+                else:
+                    bm.discard(msg_idx_pos)
+                self.DELETED = bm
 
     def _maybe_encrypt(self, data):
         gpgr = self.config.prefs.gpg_recipient
@@ -227,112 +442,265 @@ class MailIndex(BaseIndex):
 
         return data
 
+    def _checksum(self, lines):
+        return sha1b64('\n'.join(lines)).strip()
+
+    def _record(self, lines, header=''):
+        """
+        Frame lines of the index as a record, which load() only applies
+        if it is complete and its checksum matches.
+        """
+        return self._maybe_encrypt(
+            header +
+            ''.join('%s\n' % line for line in lines) +
+            '%s %s\n' % (self.RECORD_MARKER, self._checksum(lines)))
+
+    def _maybe_fsync(self, fd, *policies):
+        if self.config.sys.index_fsync in policies:
+            fd.flush()
+            os.fsync(fd.fileno())
+
     def save_changes(self, session=None):
-        self._save_lock.acquire()
-        try:
-            # In a locked section, check what needs to be done!
-            with self._lock:
-                mods, self.MODIFIED = self.MODIFIED, set()
-                old_emails_saved, total = self.EMAILS_SAVED, len(self.EMAILS)
+        with self._save_lock:
+            self._log_changes(session=session)
+        self._maybe_checkpoint(session)
 
-            if old_emails_saved == total and not mods:
-                # Nothing to do...
-                return
+    def _log_changes(self, session=None):
+        # In a locked section, check what needs to be done!
+        with self._lock:
+            mods, self.MODIFIED = self.MODIFIED, set()
+            old_emails_saved, total = self.EMAILS_SAVED, len(self.EMAILS)
 
-            if self._saved_changes >= self.MAX_INCREMENTAL_SAVES:
-                # Too much to do!
-                return self.save(session=session)
+        if old_emails_saved == total and not mods:
+            # Nothing to do...
+            return
 
+        try:
             if session:
                 session.ui.mark(_("Saving metadata index changes..."))
 
             # In a locked section we just prepare our data
             with self._lock:
-                emails = []
+                lines = []
                 for eid in range(old_emails_saved, total):
                     quoted_email = quote(self.EMAILS[eid].encode('utf-8'))
-                    emails.append('@%s\t%s\n' % (b36(eid), quoted_email))
+                    lines.append('@%s\t%s' % (b36(eid), quoted_email))
+                lines.extend(self.INDEX.line(pos) for pos in mods)
                 self.EMAILS_SAVED = total
 
             # Unlocked, try to write this out
-
-            data = self._maybe_encrypt(
-                ''.join(emails + [self.INDEX[pos] + '\n' for pos in mods]))
+            data = self._record(lines)
             with open(self.config.mailindex_file(), 'a') as fd:
                 fd.write(data)
-                self._saved_changes += 1
+                self._maybe_fsync(fd, 'always')
+            self._log_bytes += len(data)
 
             if session:
                 session.ui.mark(_("Saved metadata index changes"))
         except:
             # Failed, roll back...
-            self.MODIFIED |= mods
-            self.EMAILS_SAVED = old_emails_saved
+            with self._lock:
+                self.MODIFIED |= mods
+                self.EMAILS_SAVED = old_emails_saved
             raise
-        finally:
-            self._save_lock.release()
 
-    def save(self, session=None):
-        try:
-            self._save_lock.acquire()
-            with self._lock:
-                old_mods, self.MODIFIED = self.MODIFIED, set()
-                old_emails_saved = self.EMAILS_SAVED
+    def _maybe_checkpoint(self, session):
+        """
+        Keep the log of changes bounded, by checkpointing the index once
+        the log grows past sys.index_log_kb. This normally happens on the
+        save worker, but if that falls behind we checkpoint right away.
+
+        This must not be called with the save lock held.
+        """
+        limit = 1024 * self.config.sys.index_log_kb
+        if self._log_bytes > 2 * limit:
+            self.save(session=session)
+        elif self._log_bytes > limit:
+            self.config.save_worker.add_unique_task(
+                session, 'Save index', lambda: self.save(session=session))
 
+    def save(self, session=None):
+        """
+        Checkpoint the metadata index, replacing the log of changes with
+        a fresh copy of the whole thing.
+        """
+        with self._checkpoint_lock:
             if session:
                 session.ui.mark(_("Saving metadata index..."))
+            if self._can_snapshot():
+                self._save_snapshot(session)
+            else:
+                self._save_text(session)
+            if session:
+                session.ui.mark(_("Saved metadata index"))
 
-            idxfile = self.config.mailindex_file()
-            newfile = '%s.new' % idxfile
-
-            data = [
-                '# This is the mailpile.py index file.\n',
-                '# We have %d messages!\n' % len(self.INDEX)
-            ]
-            self.EMAILS_SAVED = email_counter = len(self.EMAILS)
-            for eid in range(0, email_counter):
-                quoted_email = quote(self.EMAILS[eid].encode('utf-8'))
-                data.append('@%s\t%s\n' % (b36(eid), quoted_email))
-            index_counter = len(self.INDEX)
-            for i in range(0, index_counter):
-                data.append(self.INDEX[i] + '\n')
-
-            data = self._maybe_encrypt(''.join(data))
-            with open(newfile, 'w') as fd:
-                fd.write(data)
+    def _header(self, count):
+        return ('# This is the mailpile.py index file.\n'
+                '# We have %d messages!\n' % count)
+
+    def _save_snapshot(self, session):
+        # The bulk of the data goes in a binary snapshot, and the index
+        # file just refers to it, followed by a log of later changes.
+        # Other threads may keep changing (and saving) the index while the
+        # snapshot is being written; only collecting the data blocks them.
+        idxfile = self.config.mailindex_file()
+        newfile = '%s.new' % idxfile
+        snapfile = self._snapshot_file()
+        generation = '%x.%x' % (time.time() * 1000,
+                                random.randint(0, 0xffffffff))
+
+        with self._save_lock:
+            # Log pending changes first, so everything logged before
+            # log_offset is in the snapshot and nothing after it is lost.
+            self._log_changes(session=session)
+            with self._lock:
+                collected = MetadataSnapshot.Collect(
+                    self.INDEX, self.EMAILS, self.DELETED,
+                    digest_maps={'msgids': self.MSGIDS, 'ptrs': self.PTRS})
+            try:
+                log_offset = os.path.getsize(idxfile)
+            except OSError:
+                log_offset = 0
 
-            # Keep the last 5 index files around... just in case.
+        MetadataSnapshot.WriteCollected(
+            self.config, snapfile + '.new', generation, collected,
+            fsync=(self.config.sys.index_fsync != 'never'))
+
+        with self._save_lock:
+            # Changes logged while we were busy are carried over as is.
+            try:
+                with open(idxfile, 'rb') as fd:
+                    fd.seek(log_offset)
+                    log = fd.read()
+            except IOError:
+                log = ''
+            with open(newfile, 'wb') as fd:
+                fd.write(self._maybe_encrypt(
+                    self._header(collected[0]) +
+                    '%s %s\n' % (self.SNAPSHOT_MARKER, generation)))
+                fd.write(log)
+                self._maybe_fsync(fd, 'always', 'checkpoint')
+
+            # Keep the last 5 index files around... just in case. The
+            # snapshot goes first: if we crash in between, load() notices
+            # that the index file refers to an older one.
+            backup_file(snapfile, backups=5, min_age_delta=10)
+            os.rename(snapfile + '.new', snapfile)
             backup_file(idxfile, backups=5, min_age_delta=10)
             os.rename(newfile, idxfile)
+            self._log_bytes = len(log)
 
-            self._saved_changes = 0
-            if session:
-                session.ui.mark(_("Saved metadata index"))
-        except:
-            # Failed, roll back...
+    def _save_text(self, session):
+        # The legacy GnuPG-encrypted index is rewritten as text, as a
+        # series of records which can be decrypted in parallel on load.
+        with self._save_lock:
             with self._lock:
-                self.MODIFIED |= old_mods
-                self.EMAILS_SAVED = old_emails_saved
-            raise
-        finally:
-            self._save_lock.release()
+                old_mods, self.MODIFIED = self.MODIFIED, set()
+                old_emails_saved = self.EMAILS_SAVED
+            try:
+                idxfile = self.config.mailindex_file()
+                newfile = '%s.new' % idxfile
+
+                lines = []
+                self.EMAILS_SAVED = email_counter = len(self.EMAILS)
+                for eid in range(0, email_counter):
+                    quoted_email = quote(self.EMAILS[eid].encode('utf-8'))
+                    lines.append('@%s\t%s' % (b36(eid), quoted_email))
+                index_counter = len(self.INDEX)
+                for i in range(0, index_counter):
+                    lines.append(self.INDEX.line(i))
+
+                with open(newfile, 'w') as fd:
+                    header = self._header(index_counter)
+                    for i in range(0, max(1, len(lines)),
+                                   self.SAVE_BLOCK_LINES):
+                        fd.write(self._record(
+                            lines[i:i + self.SAVE_BLOCK_LINES],
+                            header=header))
+                        header = ''
+                    self._maybe_fsync(fd, 'always', 'checkpoint')
+
+                # Keep the last 5 index files around... just in case.
+                backup_file(idxfile, backups=5, min_age_delta=10)
+                os.rename(newfile, idxfile)
+                self._log_bytes = 0
+            except:
+                # Failed, roll back...
+                with self._lock:
+                    self.MODIFIED |= old_mods
+                    self.EMAILS_SAVED = old_emails_saved
+                raise
 
     def update_ptrs_and_msgids(self, session):
+        """
+        Rebuild the MSGIDS and PTRS maps from scratch. This is only needed
+        if they were not loaded with the index, or if they are broken;
+        otherwise set_msg_at_idx_pos keeps them up to date.
+        """
         session.ui.mark(_('Updating high level indexes'))
+        new_msgids, new_ptrs = DigestMap(), DigestMap()
         with self._lock:
-            for offset in range(0, len(self.INDEX)):
-                message = self.l2m(self.INDEX[offset])
-                if len(message) == self.MSG_FIELDS_V2:
-                    self.MSGIDS[message[self.MSG_ID]] = offset
-                    for msg_ptr in message[self.MSG_PTRS].split(','):
-                        self.PTRS[msg_ptr] = offset
-                else:
-                    session.ui.warning(_('Bogus line: %s') % line)
+            msg_ids, ptrs = self.INDEX.msg_ids, self.INDEX.ptr_list()
+            for offset in xrange(0, len(self.INDEX)):
+                msg_id = msg_ids[offset]
+                if msg_id is not None:
+                    new_msgids[msg_id] = offset
+                    for msg_ptr in ptrs[offset].split(','):
+                        if msg_ptr:
+                            new_ptrs[msg_ptr] = offset
+            self.MSGIDS, self.PTRS = new_msgids, new_ptrs
+
+    def check_ptrs_and_msgids(self, session, repair=False):
+        """
+        Check the MSGIDS and PTRS maps against the index, returning a dict
+        counting the problems found. If repair is set and there were any
+        problems, the maps are rebuilt.
+        """
+        problems = {}
+        def problem(kind):
+            problems[kind] = problems.get(kind, 0) + 1
+
+        session.ui.mark(_('Checking high level indexes'))
+        with self._lock:
+            msg_ids, ptrs = self.INDEX.msg_ids, self.INDEX.ptr_list()
+            seen_msg_ids, seen_ptrs = set(), set()
+            for offset in xrange(0, len(self.INDEX)):
+                msg_id = msg_ids[offset]
+                if msg_id is None:
+                    continue
+                seen_msg_ids.add(msg_id)
+                pos = self.MSGIDS.get(msg_id)
+                if pos is None:
+                    problem('msgids_missing')
+                elif pos != offset and (pos >= len(msg_ids) or
+                                        msg_ids[pos] != msg_id):
+                    problem('msgids_wrong')
+                for msg_ptr in ptrs[offset].split(','):
+                    if not msg_ptr:
+                        continue
+                    seen_ptrs.add(msg_ptr)
+                    pos = self.PTRS.get(msg_ptr)
+                    if pos is None:
+                        problem('ptrs_missing')
+                    elif pos != offset and (pos >= len(ptrs) or
+                                            msg_ptr not in
+                                            ptrs[pos].split(',')):
+                        problem('ptrs_wrong')
+
+            # The maps cannot list their keys, but if they have more
+            # entries than the index has keys, some of them are stale.
+            if len(self.MSGIDS) > len(seen_msg_ids):
+                problems['msgids_stale'] = (len(self.MSGIDS) -
+                                            len(seen_msg_ids))
+            if len(self.PTRS) > len(seen_ptrs):
+                problems['ptrs_stale'] = len(self.PTRS) - len(seen_ptrs)
+
+            if problems and repair:
+                self.update_ptrs_and_msgids(session)
+        return problems
 
     def _remove_location(self, session, msg_ptr):
         msg_idx_pos = self.PTRS[msg_ptr]
-        del self.PTRS[msg_ptr]
-
         msg_info = self.get_msg_at_idx_pos(msg_idx_pos)
         msg_ptrs = [p for p in msg_info[self.MSG_PTRS].split(',')
                     if p != msg_ptr]
@@ -349,7 +717,6 @@ class MailIndex(BaseIndex):
 
         # New location! Some other process will prune obsolete pointers.
         if msg_ptr:
-            self.PTRS[msg_ptr] = msg_idx_pos
             msg_ptrs.append(msg_ptr)
 
         msg_info[self.MSG_PTRS] = ','.join(list(set(msg_ptrs)))
@@ -424,9 +791,6 @@ class MailIndex(BaseIndex):
                                 ) % (mailbox_idx, mailbox_fn, e),
                           error=True)
 
-        if len(self.PTRS.keys()) == 0:
-            self.update_ptrs_and_msgids(session)
-
         existing_ptrs = set()
         messages = sorted(mbox.keys())
         messages_md5 = md5_hex(str(messages))
@@ -463,62 +827,77 @@ class MailIndex(BaseIndex):
         not_done_yet = 'NOT DONE YET'
         if reverse:
             messages.reverse()
-        for ui in range(0, len(messages)):
-            play_nice_with_threads(weak=True)
-            if mailpile.util.QUITTING or self.interrupt:
-                self.interrupt = None
-                return finito(-1, _('Rescan interrupted: %s'
-                                    ) % self.interrupt)
-            if stop_after and added >= stop_after:
-                messages_md5 = not_done_yet
-                break
-            elif deadline and time.time() > start_time + deadline:
-                messages_md5 = not_done_yet
-                break
-            elif mbox_version != mbox.last_updated():
-                messages_md5 = not_done_yet
-                break
-
-            i = messages[ui]
-            msg_ptr = mbox.get_msg_ptr(mailbox_idx, i)
-            if msg_ptr in self.PTRS:
-                if (ui % 317) == 0:
+        # Batch up keyword updates, so the search index gets written
+        # to in bulk instead of once per keyword per message.
+        self.begin_keyword_batch()
+        try:
+            for ui in range(0, len(messages)):
+                play_nice_with_threads(weak=True)
+                if mailpile.util.QUITTING or self.interrupt:
+                    self.interrupt = None
+                    return finito(-1, _('Rescan interrupted: %s'
+                                        ) % self.interrupt)
+                if stop_after and added >= stop_after:
+                    messages_md5 = not_done_yet
+                    break
+                elif deadline and time.time() > start_time + deadline:
+                    messages_md5 = not_done_yet
+                    break
+                elif mbox_version != mbox.last_updated():
+                    messages_md5 = not_done_yet
+                    break
+
+                i = messages[ui]
+                msg_ptr = mbox.get_msg_ptr(mailbox_idx, i)
+                msg_idx_pos = self.PTRS.get(msg_ptr)
+                if msg_idx_pos is not None:
+                    if (ui % 317) == 0:
+                        session.ui.mark(parse_status(ui))
+                    elif (ui % 129) == 0 and not deadline:
+                        play_nice_with_threads()
+                    if not lazy:
+                        msg_info = self.get_msg_at_idx_pos(msg_idx_pos)
+                        msg_body = msg_info[self.MSG_BODY]
+                    if lazy or (msg_body not in self.MSG_BODY_UNSCANNED):
+                        continue
+                else:
                     session.ui.mark(parse_status(ui))
-                elif (ui % 129) == 0 and not deadline:
-                    play_nice_with_threads()
-                if not lazy:
-                    msg_info = self.get_msg_at_idx_pos(self.PTRS[msg_ptr])
-                    msg_body = msg_info[self.MSG_BODY]
-                if lazy or (msg_body not in self.MSG_BODY_UNSCANNED):
-                    continue
-            else:
-                session.ui.mark(parse_status(ui))
 
-            # Message new or modified, let's parse it.
-            try:
-                last_date, a, u = self.scan_one_message(session,
-                                                        mailbox_idx, mbox, i,
-                                                        wait=True,
-                                                        msg_ptr=msg_ptr,
-                                                        last_date=last_date,
-                                                        process_new=process_new,
-                                                        apply_tags=apply_tags,
-                                                        stop_after=stop_after,
-                                                        editable=editable,
-                                                        event=event,
-                                                        progress=progress,
-                                                        lazy=lazy)
-            except TypeError:
-                a = u = 0
-
-            added += a
-            updated += u
+                # Message new or modified, let's parse it.
+                try:
+                    last_date, a, u = self.scan_one_message(
+                        session, mailbox_idx, mbox, i,
+                        wait=True,
+                        msg_ptr=msg_ptr,
+                        last_date=last_date,
+                        process_new=process_new,
+                        apply_tags=apply_tags,
+                        stop_after=stop_after,
+                        editable=editable,
+                        event=event,
+                        progress=progress,
+                        lazy=lazy)
+                except TypeError:
+                    a = u = 0
+
+                added += a
+                updated += u
+        finally:
+            self.end_keyword_batch(session)
 
         if not lazy:
             with self._lock:
-                for msg_ptr in self.PTRS.keys():
-                    if (msg_ptr[:MBX_ID_LEN] == mailbox_idx and
-                            msg_ptr not in existing_ptrs):
+                # The PTRS map cannot list its keys, so we look for stale
+                # pointers in the index itself.
+                mbx_id, stale_ptrs = str(mailbox_idx), set()
+                for ptrs in self.INDEX.ptrs:
+                    if mbx_id in ptrs:
+                        stale_ptrs |= set(
+                            p for p in ptrs.decode('utf-8').split(',')
+                            if (p[:MBX_ID_LEN] == mailbox_idx and
+                                p not in existing_ptrs))
+                for msg_ptr in stale_ptrs:
+                    if msg_ptr in self.PTRS:
                         self._remove_location(session, msg_ptr)
                         updated += 1
         progress.update({
@@ -595,16 +974,16 @@ class MailIndex(BaseIndex):
 
         msg_snippet = msg_info = None
         msg_id = self.get_msg_id(msg, msg_ptr)
-        if msg_id in self.MSGIDS:
+        msg_idx_pos = self.MSGIDS.get(msg_id)
+        if msg_idx_pos is not None:
             with self._lock:
-                msg_info = self._update_location(session,
-                                                 self.MSGIDS[msg_id],
+                msg_info = self._update_location(session, msg_idx_pos,
                                                  msg_ptr)
                 msg_snippet = msg_info[self.MSG_BODY]
                 updated += 1
 
         rescan_body = (not lazy) and msg_snippet in self.MSG_BODY_UNSCANNED
-        if rescan_body or msg_id not in self.MSGIDS:
+        if rescan_body or msg_idx_pos is None:
             lazy_body = self.MSG_BODY_LAZY if lazy else None
             msg_info = self._index_incoming_message(
                 session, msg_id, msg_ptr, msg_bytes,
@@ -655,24 +1034,32 @@ class MailIndex(BaseIndex):
         return msg_to, msg_cc, msg_subj
 
     # FIXME: Finish merging this function with the one below it...
-    def _extract_info_and_index(self, session, mailbox_idx,
-                                msg_mid, msg_id,
-                                msg_size, msg, msg_metadata_kws,
-                                default_date,
-                                **index_kwargs):
-
+    def _extract_info_and_index(self, *args, **kwargs):
+        return self._extract_info_and_keywords(*args, **kwargs)[:6]
+
+    def _extract_info_and_keywords(self, session, mailbox_idx,
+                                   msg_mid, msg_id,
+                                   msg_size, msg, msg_metadata_kws,
+                                   default_date,
+                                   index=True, **index_kwargs):
         msg_ts = self._extract_date_ts(session, msg_mid, msg_id, msg,
                                        default_date)
 
         msg_to, msg_cc, msg_subj = self._extract_header_info(msg)
 
+        # If we are not indexing, the caller takes care of the keywords.
+        if index:
+            indexer = self.index_message
+            index_kwargs['compact'] = False
+        else:
+            indexer = self.message_keywords
+
         filters = _plugins.get_filter_hooks([self.filter_keywords])
-        kw, bi = self.index_message(session, msg_mid, msg_id,
-                                    msg, msg_metadata_kws, msg_size, msg_ts,
-                                    mailbox=mailbox_idx,
-                                    compact=False,
-                                    filter_hooks=filters,
-                                    **index_kwargs)
+        kw, bi = indexer(session, msg_mid, msg_id,
+                         msg, msg_metadata_kws, msg_size, msg_ts,
+                         mailbox=mailbox_idx,
+                         filter_hooks=filters,
+                         **index_kwargs)
 
         snippet_max = session.config.sys.snippet_max
         self.truncate_body_snippet(bi, max(0, snippet_max - len(msg_subj)))
@@ -681,7 +1068,7 @@ class MailIndex(BaseIndex):
         tags = [k.split(':')[0] for k in kw
                 if k.endswith(':in') or k.endswith(':tag')]
 
-        return (msg_ts, msg_to, msg_cc, msg_subj, msg_body, tags)
+        return (msg_ts, msg_to, msg_cc, msg_subj, msg_body, tags, kw)
 
     def _index_incoming_message(self, session,
                                 msg_id, msg_ptr, msg_size,
@@ -730,6 +1117,7 @@ class MailIndex(BaseIndex):
                                msg_body=msg_body,
                                msg_size=msg_size,
                                msg_tags=tags)
+            self._record_sender(msg_info[self.MSG_FROM], tags)
             self.set_msg_at_idx_pos(msg_idx_pos, msg_info)
 
         self.set_conversation_ids(msg_info[self.MSG_MID], msg)
@@ -862,77 +1250,47 @@ class MailIndex(BaseIndex):
             except (KeyError, ValueError, IndexError):
                 pass
 
-        root = None
-        replies = []
+        # Conversations are made of all the messages whose thread ID is
+        # that of the root, so merging just moves messages to our root.
         if msg_thr_mid:
-            root = self.get_msg_at_idx_pos(int(msg_thr_mid, 36))
-            replies = [r for r in root[self.MSG_REPLIES][:-1].split(',') if r]
-            reparent = []
             conversations.add(msg_mid)
+            reparent = set()
             for t_mid in (c for c in conversations if c != msg_thr_mid):
-                t_msg_info = self.get_msg_at_idx_pos(int(t_mid, 36))
-                reparent.extend(t_msg_info[self.MSG_REPLIES][:-1].split(','))
-                reparent.append(t_mid)
-            for m_mid in set([r for r in reparent if r]):
-                m_msg_idx = int(m_mid, 36)
+                t_msg_idx = int(t_mid, 36)
+                reparent.add(t_msg_idx)
+                reparent.update(self.INDEX.thread_members(t_msg_idx))
+            for m_msg_idx in reparent:
                 m_msg_info = self.get_msg_at_idx_pos(m_msg_idx)
                 otp = m_msg_info[self.MSG_THREAD_MID].split('/')
-                otp[0] = msg_thr_mid
-                m_msg_info[self.MSG_THREAD_MID] = '/'.join(otp)
-                m_msg_info[self.MSG_REPLIES] = ''
-                self.set_msg_at_idx_pos(m_msg_idx, m_msg_info)
-                replies.append(m_mid)
-
-        # FIXME: If nothing was found, do a subject-based search of recent
-        #        messages, for subject-based grouping.
-
-        # OK, finally we add ourselves and our references the conversation, yay!
-        if msg_thr_mid and root:
-            replies.append(msg_mid)
-            for ref_idx_pos in (r for r in ref_idxs if r is not None):
-                ref_mid = b36(ref_idx_pos)
-                replies.append(ref_mid)
-            root[self.MSG_REPLIES] = ','.join(sorted(list(set(replies)))) + ','
-            self.set_msg_at_idx_pos(int(msg_thr_mid, 36), root)
+                if otp[0] != msg_thr_mid:
+                    otp[0] = msg_thr_mid
+                    m_msg_info[self.MSG_THREAD_MID] = '/'.join(otp)
+                    self.set_msg_at_idx_pos(m_msg_idx, m_msg_info)
 
         msg_idx_pos = int(msg_mid, 36)
         msg_info = self.get_msg_at_idx_pos(msg_idx_pos)
-        msg_replies = msg_info[self.MSG_REPLIES][:-1].split(',')
-
-        if subject_threading and not (msg_thr_mid or refs or msg_replies):
-            # Can we do plain GMail style subject-based threading?
-            subj = msg_info[self.MSG_SUBJECT].lower()
-            subj = subj.replace('re: ', '')  # FIXME: i18n?
-            date = long(msg_info[self.MSG_DATE], 36)
-            if subj.strip() != '':
-                # FIXME: Is this too aggressive? Make configurable?
-                for midx in reversed(range(max(0, msg_idx_pos - 150),
-                                           msg_idx_pos)):
-                    try:
-                        m_info = self.get_msg_at_idx_pos(midx)
-                        m_date = long(m_info[self.MSG_DATE], 36)
-                        m_subj = m_info[self.MSG_SUBJECT]
-                        if ((m_date < date) and  # FIXME: i18n?
-                                (m_subj.lower().replace('re: ', '') == subj)):
-                            msg_thr_mid = m_info[self.MSG_THREAD_MID]
-                            msg_thr_mid = msg_thr_mid.split('/')[0]
-                            parent = self.get_msg_at_idx_pos(int(msg_thr_mid,
-                                                                 36))
-                            replies = parent[self.MSG_REPLIES][:-1].split(',')
-                            if len(replies) < 100:
-                                if msg_mid not in replies:
-                                    replies.append(msg_mid)
-                                parent[self.MSG_REPLIES] = (','.join(replies)
-                                                            + ',')
-                                self.set_msg_at_idx_pos(int(msg_thr_mid, 36),
-                                                        parent)
-                                break
-                            else:
-                                msg_thr_mid = None
-                        if date - m_date > 5 * 24 * 3600:
-                            break
-                    except (KeyError, ValueError, IndexError):
-                        pass
+        msg_replies = self.INDEX.reply_list(msg_idx_pos)
+        subj = self._thread_subject(msg_info[self.MSG_SUBJECT])
+        date = long(msg_info[self.MSG_DATE], 36)
+
+        if subject_threading and subj and not (msg_thr_mid or refs or
+                                               msg_replies):
+            # Can we do subject-based threading? As in JWZ's algorithm,
+            # only messages which look like replies (Re: ...) are joined
+            # to an older message with the same subject. The newest one
+            # at most a few days older than ours is as good a guess as any.
+            try:
+                is_reply = self.THREAD_SUBJECT_PREFIX.match(
+                    msg_info[self.MSG_SUBJECT].strip())
+                midx = (self._older_subject_match(msg_idx_pos, subj, date)
+                        if is_reply else None)
+                if midx is not None:
+                    m_info = self.get_msg_at_idx_pos(midx)
+                    msg_thr_mid = m_info[self.MSG_THREAD_MID].split('/')[0]
+            except (KeyError, ValueError, IndexError):
+                msg_thr_mid = None
+        if subj:
+            self._index_thread_subject(msg_idx_pos, subj, date)
 
         if not msg_thr_mid:
             # OK, we are our own conversation root.
@@ -945,6 +1303,89 @@ class MailIndex(BaseIndex):
 
         self.set_msg_at_idx_pos(msg_idx_pos, msg_info)
 
+    def _older_subject_match(self, msg_idx, subj, date):
+        # Walk the messages with our subject, newest first, until we find
+        # one older than us. Walks are bounded, as the chains are only
+        # kept roughly in date order.
+        window = self.SUBJECT_THREADING_DAYS * 24 * 3600
+        dates, best = self.INDEX.dates, None
+        subjects = self._subject_index()
+        with self._subjects_lock:
+            midx = subjects.get(subj, -1)
+            prev, steps = self._subject_prev, 0
+            while 0 <= midx < len(prev) and steps < 100:
+                m_date = dates[midx]
+                if m_date < date - window:
+                    break
+                if (midx != msg_idx and m_date < date and
+                        self.INDEX.exists(midx) and
+                        self._thread_subject(self.get_msg_at_idx_pos(midx
+                                             )[self.MSG_SUBJECT]) == subj):
+                    best = midx
+                    break
+                midx = prev[midx]
+                steps += 1
+        if best is None:
+            return None
+
+        # Conversations are not grown past 100 messages this way
+        if len(self.INDEX.thread_members(self.INDEX.threads[best])) > 100:
+            return None
+        return best
+
+    def _thread_subject(self, subject):
+        return self.THREAD_SUBJECT_PREFIX.sub('', subject.lower()).strip()
+
+    def _subject_index(self):
+        # Maps each normalized subject to its most recent message, and
+        # _subject_prev links each message to the previous one with the
+        # same subject. These are built on first use and kept up to date
+        # by set_conversation_ids from then on; whoever replaces INDEX
+        # resets them.
+        with self._subjects_lock:
+            if self.SUBJECTS is None:
+                subjects, keys = DigestMap(), {}
+                dates, sids = self.INDEX.dates, self.INDEX.subjects
+                prev = array('l', [self.SUBJECT_UNLINKED]) * len(self.INDEX)
+                positions = [pos for pos in xrange(0, len(self.INDEX))
+                             if self.INDEX.exists(pos)]
+                positions.sort(key=dates.__getitem__)
+                for pos in positions:
+                    if sids[pos] not in keys:
+                        keys[sids[pos]] = self._thread_subject(
+                            self.INDEX.subject_table[sids[pos]
+                                                     ].decode('utf-8'))
+                    subj = keys[sids[pos]]
+                    if subj:
+                        prev[pos] = subjects.get(subj, -1)
+                        subjects[subj] = pos
+                self._subject_prev = prev
+                self.SUBJECTS = subjects
+            return self.SUBJECTS
+
+    def _index_thread_subject(self, msg_idx, subj, date):
+        with self._subjects_lock:
+            if self.SUBJECTS is None:
+                return
+            prev, dates = self._subject_prev, self.INDEX.dates
+            while len(prev) <= msg_idx:
+                prev.append(self.SUBJECT_UNLINKED)
+            if prev[msg_idx] != self.SUBJECT_UNLINKED:
+                return  # Already linked
+            latest = self.SUBJECTS.get(subj, -1)
+            if latest < 0 or dates[latest] <= date:
+                prev[msg_idx] = latest
+                self.SUBJECTS[subj] = msg_idx
+            else:
+                # Mail arriving out of order goes behind newer messages
+                steps = 0
+                while (prev[latest] >= 0 and dates[prev[latest]] > date and
+                        steps < 100):
+                    latest = prev[latest]
+                    steps += 1
+                prev[msg_idx] = prev[latest]
+                prev[latest] = msg_idx
+
     def unthread_message(self, msg_mid):
         msg_idx_pos = int(msg_mid, 36)
         msg_info = self.get_msg_at_idx_pos(msg_idx_pos)
@@ -952,32 +1393,21 @@ class MailIndex(BaseIndex):
 
         if par_idx_pos == msg_idx_pos:
             # Message is head of thread, chop head off!
-            thread = msg_info[self.MSG_REPLIES][:-1].split(',')
-            msg_info[self.MSG_REPLIES] = ''
-            if msg_mid in thread:
-                thread.remove(msg_mid)
+            thread = self.INDEX.reply_list(msg_idx_pos)
             # We can just pick any message to be the new "head" of
             # the thread, the actual ordering happens elsewhere.
-            if thread and thread[0]:
-                head_mid = thread[0]
-                head_idx_pos = int(head_mid, 36)
-                head_info = self.get_msg_at_idx_pos(head_idx_pos)
-                head_info[self.MSG_REPLIES] = ','.join(thread) + ','
-                self.set_msg_at_idx_pos(head_idx_pos, head_info)
-                for msg_mid in thread:
-                    kid_idx_pos = int(thread[0], 36)
-                    kid_info = self.get_msg_at_idx_pos(head_idx_pos)
-                    kid_info[self.MSG_THREAD_MID] = head_mid
-                    kid.set_msg_at_idx_pos(head_idx_pos, head_info)
-        else:
-            # Message is a reply, remove it from thread
-            par_info = self.get_msg_at_idx_pos(par_idx_pos)
-            thread = par_info[self.MSG_REPLIES][:-1].split(',')
-            if msg_mid in thread:
-                thread.remove(msg_mid)
-                par_info[self.MSG_REPLIES] = ','.join(thread) + ','
-                self.set_msg_at_idx_pos(par_idx_pos, par_info)
-
+            if thread:
+                head_mid = b36(thread[0])
+                for kid_idx_pos in thread:
+                    kid_info = self.get_msg_at_idx_pos(kid_idx_pos)
+                    otp = kid_info[self.MSG_THREAD_MID].split('/')
+                    otp[0] = head_mid
+                    if otp[1:] == [head_mid]:
+                        otp[1:] = []
+                    kid_info[self.MSG_THREAD_MID] = '/'.join(otp)
+                    self.set_msg_at_idx_pos(kid_idx_pos, kid_info)
+
+        # A reply leaves the thread as soon as its thread ID changes.
         msg_info[self.MSG_THREAD_MID] = msg_mid
         self.set_msg_at_idx_pos(msg_idx_pos, msg_info)
 
@@ -1003,20 +1433,28 @@ class MailIndex(BaseIndex):
                 '',                                  # No replies for now
                 msg_mid]                             # Conversation ID
 
-            if msg_from:
-                ahp = AddressHeaderParser(msg_from)
-                if ahp:
-                    fn = ahp[0].fn
-                    email = ahp[0].address
-                else:
-                    email, fn = ExtractEmailAndName(msg_from)
-            else:
-                email = fn = None
-            if email and fn:
-                self.update_email(email, name=fn)
+            self._record_sender(msg_from, tags)
             self.set_msg_at_idx_pos(msg_idx_pos, msg_info)
             return msg_idx_pos, msg_info
 
+    def _record_sender(self, msg_from, tags):
+        # Senders are recorded even without a name, so address searches
+        # can find everyone we have heard from; except for the senders of
+        # mail which is hidden (spam, trash), who are not worth offering.
+        if not msg_from:
+            return
+        hidden = set(t._key for t in self.config.get_tags(flag_hides=True))
+        if hidden & set(tags):
+            return
+        ahp = AddressHeaderParser(msg_from)
+        if ahp:
+            fn = ahp[0].fn
+            email = ahp[0].address
+        else:
+            email, fn = ExtractEmailAndName(msg_from)
+        if email:
+            self.update_email(email, name=fn, change_name=bool(fn))
+
     def add_new_ghost(self, msg_id):
         return self.add_new_msg(
             '',  # msg_ptr
@@ -1061,14 +1499,17 @@ class MailIndex(BaseIndex):
             msg_idxs = [int(mid, 36) for mid in msg_mids]
         if not msg_idxs:
             return
+        edits = []
         for fid, trms, tags, c, t in session.config.get_filters(
                 filter_on=filter_on):
             for t in tags.split():
                 tag_id = t[1:].split(':')[0]
                 if t[0] == '-':
-                    self.remove_tag(session, tag_id, msg_idxs=set(msg_idxs))
+                    edits.append((msg_idxs, [], [tag_id]))
                 else:
-                    self.add_tag(session, tag_id, msg_idxs=set(msg_idxs))
+                    edits.append((msg_idxs, [tag_id], []))
+        if edits:
+            self.edit_tags(session, edits)
 
     def _list_header_keywords(self, hdr, val_lower, body_info):
         """Extracts IDs and such from <...> in list-headers."""
@@ -1307,8 +1748,23 @@ class MailIndex(BaseIndex):
 
     def index_message(self, session, msg_mid, msg_id,
                       msg, msg_metadata_kws, msg_size, msg_ts,
-                      mailbox=None, compact=True, filter_hooks=None,
-                      process_new=None, apply_tags=None, incoming=False):
+                      mailbox=None, compact=True, **kwargs):
+        keywords, snippet = self.message_keywords(session, msg_mid, msg_id,
+                                                  msg, msg_metadata_kws,
+                                                  msg_size, msg_ts,
+                                                  mailbox=mailbox, **kwargs)
+
+        self._append_keywords(session, msg_mid,
+                              self.searchable_keywords(keywords),
+                              compact=compact)
+
+        self.config.command_cache.mark_dirty(set([u'mail:all']) | keywords)
+        return keywords, snippet
+
+    def message_keywords(self, session, msg_mid, msg_id,
+                         msg, msg_metadata_kws, msg_size, msg_ts,
+                         mailbox=None, filter_hooks=None,
+                         process_new=None, apply_tags=None, incoming=False):
         keywords, snippet = self.read_message(session,
                                               msg_mid, msg_id, msg,
                                               msg_size, msg_ts,
@@ -1341,26 +1797,58 @@ class MailIndex(BaseIndex):
         if 'keywords' in self.config.sys.debug:
             print 'KEYWORDS: %s' % keywords
 
-        for word in keywords:
-            if (word.startswith('__') or
-                    # Tags are now handled outside the posting lists
-                    word.endswith(':tag') or word.endswith(':in')):
-                continue
-            try:
-                GlobalPostingList.Append(session, word, [msg_mid],
-                                         compact=compact)
-            except UnicodeDecodeError:
-                # FIXME: we just ignore garbage
-                pass
-
-        self.config.command_cache.mark_dirty(set([u'mail:all']) | keywords)
         return keywords, snippet
 
+    @classmethod
+    def searchable_keywords(cls, keywords):
+        return [word for word in keywords
+                if not (word.startswith('__') or
+                        # Tags are now handled outside the posting lists
+                        word.endswith(':tag') or word.endswith(':in'))]
+
+    def _append_keywords(self, session, msg_mid, keywords, compact=True):
+        with self._kw_lock:
+            batch = self._kw_batch
+            if batch is not None:
+                for word in keywords:
+                    if word in batch:
+                        batch[word].append(msg_mid)
+                    else:
+                        batch[word] = [msg_mid]
+                self._kw_batch_count += 1
+                if self._kw_batch_count < self.KEYWORD_BATCH_SIZE:
+                    return
+                self._kw_batch, self._kw_batch_count = {}, 0
+                compact = False
+            else:
+                batch = dict((word, [msg_mid]) for word in keywords)
+        GlobalPostingList.AppendMany(session, batch, compact=compact)
+
+    def begin_keyword_batch(self):
+        """
+        Start buffering keywords from index_message, so they get written
+        to the search index in bulk. Every call must be matched by a call
+        to end_keyword_batch, which flushes the buffer. Until then, newly
+        indexed messages may not show up in keyword searches.
+        """
+        with self._kw_lock:
+            self._kw_batchers += 1
+            if self._kw_batch is None:
+                self._kw_batch, self._kw_batch_count = {}, 0
+
+    def end_keyword_batch(self, session):
+        with self._kw_lock:
+            self._kw_batchers -= 1
+            batch = self._kw_batch
+            if self._kw_batchers > 0:
+                self._kw_batch, self._kw_batch_count = {}, 0
+            else:
+                self._kw_batch = None
+        if batch:
+            GlobalPostingList.AppendMany(session, batch, compact=False)
+
     def get_msg_at_idx_pos_uncached(self, msg_idx):
-        rv = self.l2m(self.INDEX[msg_idx])
-        if len(rv) != self.MSG_FIELDS_V2:
-            raise ValueError()
-        return rv
+        return self.INDEX.get(msg_idx)
 
     def delete_msg_at_idx_pos(self, session, msg_idx, keep_msgid=False):
         info = self.get_msg_at_idx_pos(msg_idx)
@@ -1381,6 +1869,9 @@ class MailIndex(BaseIndex):
 
         # FIXME: Remove from threads? This may break threading. :(
 
+        # Clearing the pointers (and maybe the message ID) here means
+        # set_msg_at_idx_pos drops them from the PTRS and MSGIDS maps.
+
         if not keep_msgid:
             # If we don't keep the msgid, the message may reappear later
             # if it wasn't deleted from all source mailboxes. The caller
@@ -1394,42 +1885,81 @@ class MailIndex(BaseIndex):
         for tag in self.get_tags(msg_info=info):
             self.remove_tag(session, tag, msg_idxs=[msg_idx])
 
-        # Record that these messages were deleted
-        GlobalPostingList.Append(session, 'deleted:is', [b36(msg_idx)])
-
-    def update_msg_sorting(self, msg_idx, msg_info):
+    def update_msg_sorting(self, msg_idx, msg_info=None):
         for order, sorter in self.SORT_ORDERS.iteritems():
-            self.INDEX_SORT[order][msg_idx] = sorter(self, msg_info)
+            self.INDEX_SORT[order][msg_idx] = sorter(self, msg_idx)
+        self._update_thread_summary(msg_idx)
+
+    def _thread_members(self, thread):
+        return self.INDEX.thread_members(thread)
+
+    def _update_thread_summary(self, msg_idx):
+        if self.INDEX.exists(msg_idx):
+            self.THREADS.update(msg_idx,
+                                self.INDEX.threads[msg_idx],
+                                self.INDEX.dates[msg_idx],
+                                self._is_fresh(msg_idx))
+        else:
+            self.THREADS.update(msg_idx, -1, 0, False)
+
+    def _ptrs_at_idx_pos(self, msg_idx):
+        if not self.INDEX.exists(msg_idx):
+            return set()
+        return set(p for p in self.INDEX.ptrs[msg_idx].decode('utf-8'
+                                                               ).split(',')
+                   if p)
+
+    def _update_ptrs_and_msgid(self, msg_idx, old_msg_id, old_ptrs):
+        # Entries are only removed if they still refer to this message;
+        # if a pointer is shared, another message may have claimed it.
+        msg_id = self.INDEX.msg_ids[msg_idx]
+        ptrs = self._ptrs_at_idx_pos(msg_idx)
+        if old_msg_id not in (None, msg_id):
+            if self.MSGIDS.get(old_msg_id) == msg_idx:
+                del self.MSGIDS[old_msg_id]
+        for msg_ptr in (old_ptrs - ptrs):
+            if self.PTRS.get(msg_ptr) == msg_idx:
+                del self.PTRS[msg_ptr]
+        if msg_id is not None:
+            self.MSGIDS[msg_id] = msg_idx
+        for msg_ptr in ptrs:
+            self.PTRS[msg_ptr] = msg_idx
 
     def set_msg_at_idx_pos(self, msg_idx, msg_info, original_line=None):
         with self._lock:
-            while len(self.INDEX) <= msg_idx:
-                self.INDEX.append('')
-                self.INDEX_THR.append(-1)
-                for order in self.INDEX_SORT:
-                    self.INDEX_SORT[order].append(0)
-
-        msg_thr_mid = msg_info[self.MSG_THREAD_MID].split('/')[0]
-        self.INDEX[msg_idx] = original_line or self.m2l(msg_info)
-        self.INDEX_THR[msg_idx] = int(msg_thr_mid, 36)
-        self.MSGIDS[msg_info[self.MSG_ID]] = msg_idx
-        for msg_ptr in msg_info[self.MSG_PTRS].split(','):
-            self.PTRS[msg_ptr] = msg_idx
+            if original_line:
+                msg_info = self.l2m(original_line)
+            old_msg_id = (self.INDEX.msg_ids[msg_idx]
+                          if self.INDEX.exists(msg_idx) else None)
+            old_thread = (self.INDEX.threads[msg_idx]
+                          if self.INDEX.exists(msg_idx) else None)
+            old_ptrs = self._ptrs_at_idx_pos(msg_idx)
+            self.INDEX.set(msg_idx, msg_info, normalized=bool(original_line))
+            self._update_ptrs_and_msgid(msg_idx, old_msg_id, old_ptrs)
+            if old_thread != self.INDEX.threads[msg_idx]:
+                # The replies of both conversation roots have changed
+                for thread in (old_thread, self.INDEX.threads[msg_idx]):
+                    if thread is not None:
+                        self.CACHE.discard(thread)
+            for order in self.INDEX_SORT:
+                sort_keys = self.INDEX_SORT[order]
+                while len(sort_keys) <= msg_idx:
+                    sort_keys.append(0)
+
+        msg_thr_mid = self.INDEX.threads[msg_idx]
         self.update_msg_sorting(msg_idx, msg_info)
         self.update_msg_tags(msg_idx, msg_info)
+        self.update_msg_deleted(msg_idx, msg_info)
 
         if not original_line:
             dirty_tags = [u'%s:in' % self.config.tags[t].slug for t in
                           self.get_tags(msg_info=msg_info)]
             self.config.command_cache.mark_dirty(
                 [u'mail:all', u'%s:msg' % msg_idx,
-                 u'%s:thread' % int(msg_thr_mid, 36)] + dirty_tags)
+                 u'%s:thread' % msg_thr_mid] + dirty_tags)
             CachedSearchResultSet.DropCaches(msg_idxs=[msg_idx])
             self.MODIFIED.add(msg_idx)
-            try:
-                del self.CACHE[msg_idx]
-            except KeyError:
-                pass
+            self.CACHE.discard(msg_idx)
 
     def get_conversation(self, msg_info=None, msg_idx=None, ghosts=False):
         if not msg_info:
@@ -1457,19 +1987,121 @@ class MailIndex(BaseIndex):
             return [msg_info]
 
     def get_replies(self, msg_info=None, msg_idx=None):
-        if not msg_info:
-            msg_info = self.get_msg_at_idx_pos(msg_idx)
-        return [self.get_msg_at_idx_pos(int(r, 36)) for r
-                in set(msg_info[self.MSG_REPLIES].split(',')) if r]
+        try:
+            if msg_info:
+                msg_idx = int(msg_info[self.MSG_MID], 36)
+        except ValueError:
+            return []
+        if not self.INDEX.exists(msg_idx):
+            return []
+        return [self.get_msg_at_idx_pos(r)
+                for r in self.INDEX.reply_list(msg_idx)]
 
     def get_tags(self, msg_info=None, msg_idx=None):
-        if not msg_info:
-            msg_info = self.get_msg_at_idx_pos(msg_idx)
-        taglist = [r for r in msg_info[self.MSG_TAGS].split(',') if r]
+        if msg_info:
+            taglist = [r for r in msg_info[self.MSG_TAGS].split(',') if r]
+        elif 0 <= msg_idx < len(self.INDEX):
+            taglist = self.INDEX.tag_list(msg_idx)
+        else:
+            taglist = []
         if not 'tags' in self.config:
             return taglist
         return [r for r in taglist if r in self.config.tags]
 
+    def conversation_idxs(self, msg_idxs):
+        """Expand a set of messages to include their whole conversations."""
+        conv_idxs = set()
+        threads = set()
+        for msg_idx in msg_idxs:
+            if self.INDEX.exists(msg_idx):
+                thread = self.INDEX.threads[msg_idx]
+                if thread not in threads:
+                    threads.add(thread)
+                    conv_idxs.update(self.INDEX.thread_members(thread))
+                    if self.INDEX.exists(thread):
+                        conv_idxs.add(thread)
+                conv_idxs.add(msg_idx)
+        return conv_idxs
+
+    def edit_tags(self, session, edits):
+        """
+        Add and remove tags on many messages in one pass. Each edit is a
+        tuple of (msg_idxs, tag IDs to add, tag IDs to remove), removals
+        happening first, and edits are applied in order. Each message is
+        rewritten at most once and the caches are invalidated once, no
+        matter how many edits touch it.
+
+        Returns two dicts, mapping tag IDs to the sets of messages they
+        were added to and removed from.
+        """
+        CachedSearchResultSet.DropCaches()
+        known_tags = session.config.tags
+        added, removed, edited_tags = {}, {}, set()
+        original, current = {}, {}
+        for msg_idxs, add_tags, remove_tags in edits:
+            add_tags, remove_tags = set(add_tags), set(remove_tags)
+            edited_tags |= add_tags | remove_tags
+            for msg_idx in msg_idxs:
+                tags = current.get(msg_idx)
+                if tags is None:
+                    if not self.INDEX.exists(msg_idx):
+                        continue
+                    original[msg_idx] = frozenset(
+                        [r for r in self.INDEX.tag_list(msg_idx)
+                         if r in known_tags])
+                    tags = current[msg_idx] = set(original[msg_idx])
+                for tag_id in (remove_tags & tags):
+                    removed.setdefault(tag_id, set()).add(msg_idx)
+                tags -= remove_tags
+                for tag_id in (add_tags - tags):
+                    added.setdefault(tag_id, set()).add(msg_idx)
+                tags |= add_tags
+
+        changed = [msg_idx for msg_idx, tags in current.iteritems()
+                   if tags != original[msg_idx]]
+        threads = set()
+        for msg_idx in changed:
+            self.INDEX.set_tags(msg_idx, current[msg_idx])
+            self.MODIFIED.add(msg_idx)
+            self.update_msg_sorting(msg_idx)
+            self.CACHE.discard(msg_idx)
+            threads.add(self.INDEX.threads[msg_idx])
+
+        with self._lock:
+            gained, lost = {}, {}
+            for msg_idx in changed:
+                old_tags, new_tags = original[msg_idx], current[msg_idx]
+                for tag_id in (new_tags - old_tags):
+                    gained.setdefault(tag_id, []).append(msg_idx)
+                for tag_id in (old_tags - new_tags):
+                    lost.setdefault(tag_id, []).append(msg_idx)
+                self._update_tag_stats(old_tags, new_tags)
+            for tag_id, msg_idxs in lost.iteritems():
+                if tag_id in self.TAGS:
+                    self.TAGS[tag_id] -= msg_idxs
+            for tag_id, msg_idxs in gained.iteritems():
+                if tag_id in self.TAGS:
+                    self.TAGS[tag_id] |= msg_idxs
+                else:
+                    self.TAGS[tag_id] = Bitmap(msg_idxs)
+
+        # Record that these messages were touched in some way
+        if current:
+            GlobalPostingList.Append(session,
+                                     '%x:u' % (time.time() // (24 * 3600)),
+                                     [b36(e) for e in current])
+
+        try:
+            self.config.command_cache.mark_dirty(
+                [u'mail:all'] +
+                [u'%s:in' % known_tags[t].slug for t in edited_tags
+                 if t in known_tags] +
+                [u'%s:msg' % e_idx for e_idx in changed] +
+                [u'%s:thread' % thr_idx for thr_idx in threads])
+        except:
+            pass
+        return added, removed
+
     def add_tag(self, session, tag_id,
                 msg_info=None, msg_idxs=None,
                 conversation=False, allow_message_id_clearing=False):
@@ -1480,78 +2112,40 @@ class MailIndex(BaseIndex):
         if not msg_idxs:
             return set()
 
-        CachedSearchResultSet.DropCaches()
-
         if conversation:
             session.ui.mark(_n('Tagging %d conversation (%s)',
                            'Tagging %d conversations (%s)',
                            len(msg_idxs)
                            ) % (len(msg_idxs), tag_id))
-            for msg_idx in list(msg_idxs):
-                for reply in self.get_conversation(msg_idx=msg_idx,
-                                                   ghosts=True):
-                    if reply[self.MSG_MID]:
-                        msg_idxs.add(int(reply[self.MSG_MID], 36))
+            msg_idxs = self.conversation_idxs(msg_idxs)
         else:
             session.ui.mark(_n('Tagging %d message (%s)',
                            'Tagging %d messages (%s)',
                            len(msg_idxs)
                            ) % (len(msg_idxs), tag_id))
 
-        clear_message_id = False
         if allow_message_id_clearing:
             if session.config.tags[tag_id].type == 'trash':
-                 clear_message_id = True
+                self._clear_message_ids(msg_idxs)
 
-        eids = set()
-        added = set()
-        threads = set()
+        added, removed = self.edit_tags(session, [(msg_idxs, [tag_id], [])])
+        return added.get(tag_id, set())
+
+    def _clear_message_ids(self, msg_idxs):
         for msg_idx in msg_idxs:
-            if msg_idx >= 0 and msg_idx < len(self.INDEX):
-                modified = False
+            if self.INDEX.exists(msg_idx):
                 msg_info = self.get_msg_at_idx_pos(msg_idx)
-                tags = set([r for r in msg_info[self.MSG_TAGS].split(',')
-                            if r and r in session.config.tags])
-                if tag_id not in tags:
-                    tags.add(tag_id)
-                    msg_info[self.MSG_TAGS] = ','.join(list(tags))
-                    added.add(msg_idx)
-                    threads.add(msg_info[self.MSG_THREAD_MID].split('/')[0])
-                    modified = True
-                if clear_message_id:
-                    old_msgid = msg_info[self.MSG_ID]
-                    if old_msgid in self.MSGIDS:
-                        del self.MSGIDS[old_msgid]
-                    msg_info[self.MSG_ID] = self._encode_msg_id('%s' % msg_idx)
-                    self.MSGIDS[msg_info[self.MSG_ID]] = msg_idx
-                    modified = True
-                if modified:
-                    self.INDEX[msg_idx] = self.m2l(msg_info)
-                    self.MODIFIED.add(msg_idx)
-                    self.update_msg_sorting(msg_idx, msg_info)
-                    if msg_idx in self.CACHE:
-                        del self.CACHE[msg_idx]
-                eids.add(msg_idx)
-
-        with self._lock:
-            if tag_id in self.TAGS:
-                self.TAGS[tag_id] |= eids
-            elif eids:
-                self.TAGS[tag_id] = eids
-
-        # Record that these messages were touched in some way
-        GlobalPostingList.Append(session,
-                                 '%x:u' % (time.time() // (24 * 3600)),
-                                 [b36(e) for e in eids])
-
-        try:
-            self.config.command_cache.mark_dirty(
-                [u'mail:all', u'%s:in' % self.config.tags[tag_id].slug] +
-                [u'%s:msg' % e_idx for e_idx in added] +
-                [u'%s:thread' % int(mid, 36) for mid in threads])
-        except:
-            pass
-        return added
+                msg_info[self.MSG_TAGS] = ','.join(
+                    self.INDEX.tag_list(msg_idx))
+                old_msgid = msg_info[self.MSG_ID]
+                if self.MSGIDS.get(old_msgid) == msg_idx:
+                    del self.MSGIDS[old_msgid]
+                msg_info[self.MSG_ID] = self._encode_msg_id('%s' % msg_idx)
+                self.MSGIDS[msg_info[self.MSG_ID]] = msg_idx
+                self.INDEX.set(msg_idx, msg_info)
+                self.MODIFIED.add(msg_idx)
+                self.update_msg_sorting(msg_idx)
+                self.CACHE.discard(msg_idx)
 
     def remove_tag(self, session, tag_id,
                    msg_info=None, msg_idxs=None, conversation=False):
@@ -1562,73 +2156,119 @@ class MailIndex(BaseIndex):
         if not msg_idxs:
             return set()
 
-        session.ui.mark(_n('Untagging conversation (%s)',
-                           'Untagging conversations (%s)',
-                           len(msg_idxs)
-                           ) % (tag_id, ))
-        CachedSearchResultSet.DropCaches()
-        for msg_idx in list(msg_idxs):
-            if conversation:
-                for reply in self.get_conversation(msg_idx=msg_idx,
-                                                   ghosts=True):
-                    if reply[self.MSG_MID]:
-                        msg_idxs.add(int(reply[self.MSG_MID], 36))
+        if conversation:
+            session.ui.mark(_n('Untagging conversation (%s)',
+                               'Untagging conversations (%s)',
+                               len(msg_idxs)
+                               ) % (tag_id, ))
+            msg_idxs = self.conversation_idxs(msg_idxs)
 
         session.ui.mark(_n('Untagging %d message (%s)',
                            'Untagging %d messages (%s)',
                            len(msg_idxs)
                            ) % (len(msg_idxs), tag_id))
-        eids = set()
-        removed = set()
-        threads = set()
-        for msg_idx in msg_idxs:
-            if msg_idx >= 0 and msg_idx < len(self.INDEX):
-                msg_info = self.get_msg_at_idx_pos(msg_idx)
-                tags = set([r for r in msg_info[self.MSG_TAGS].split(',')
-                            if r and r in session.config.tags])
-                if tag_id in tags:
-                    tags.remove(tag_id)
-                    msg_info[self.MSG_TAGS] = ','.join(list(tags))
-                    self.INDEX[msg_idx] = self.m2l(msg_info)
-                    self.MODIFIED.add(msg_idx)
-                    self.update_msg_sorting(msg_idx, msg_info)
-                    if msg_idx in self.CACHE:
-                        del self.CACHE[msg_idx]
-                    removed.add(msg_idx)
-                    threads.add(msg_info[self.MSG_THREAD_MID].split('/')[0])
-                eids.add(msg_idx)
-        with self._lock:
-            if tag_id in self.TAGS:
-                self.TAGS[tag_id] -= eids
-
-        # Record that these messages were touched in some way
-        GlobalPostingList.Append(session,
-                                 '%x:u' % (time.time() // (24 * 3600)),
-                                 [b36(e) for e in eids])
-
-        try:
-            self.config.command_cache.mark_dirty(
-                [u'%s:in' % self.config.tags[tag_id].slug] +
-                [u'%s:msg' % e_idx for e_idx in removed] +
-                [u'%s:thread' % int(mid, 36) for mid in threads])
-        except:
-            pass
-        return removed
+        added, removed = self.edit_tags(session, [(msg_idxs, [], [tag_id])])
+        return removed.get(tag_id, set())
 
     def search_tag(self, session, term, hits, recursion=0):
         t = term.split(':', 1)
         tag_id, tag = t[1], self.config.get_tag(t[1])
-        results = []
+        results = Bitmap()
         if tag:
             tag_id = tag._key
             for subtag in self.config.get_tags(parent=tag_id):
-                results.extend(hits('%s:in' % subtag._key))
+                results.update(hits('%s:in' % subtag._key))
             if tag.magic_terms and recursion < 5:
-                results.extend(self.search(session, [tag.magic_terms],
+                results.update(self.search(session, [tag.magic_terms],
                                            recursion=recursion+1).as_set())
-        results.extend(hits('%s:in' % tag_id))
+        results.update(hits('%s:in' % tag_id))
         return results, tag
 
+    def _search_term(self, session, term, hits, recursion):
+        rt = Bitmap()
+        if ':' in term:
+            if term.startswith('in:'):
+                rt.update(self.search_tag(session, term, hits,
+                                          recursion=recursion)[0])
+            elif term.startswith('mid:'):
+                msg_idxs = [int(t, 36) for t in
+                            term[4:].replace('=', '').split(',')]
+                rt.update([i for i in msg_idxs if 0 <= i < len(self.INDEX)])
+            elif term.startswith('body:'):
+                rt.update(hits(term[5:]))
+            elif term == 'all:mail':
+                rt.update(Bitmap.Range(0, len(self.INDEX)))
+            elif term == 'is:deleted':
+                rt.update(self.DELETED)
+            elif term in ('to:me', 'cc:me', 'from:me'):
+                vcards = self.config.vcards
+                emails = []
+                for vc in vcards.find_vcards([], kinds=['profile']):
+                    emails += [vcl.value for vcl in vc.get_all('email')]
+                for email in set(emails):
+                    if email:
+                        rt.update(hits('%s:%s' % (email,
+                                                  term.split(':')[0])))
+            elif term == 'is:encrypted':
+                for status in EncryptionInfo.STATUSES:
+                    if status in CryptoInfo.STATUSES:
+                        continue
+                    rt.update(self.search_tag(
+                        session, 'in:mp_enc-%s' % status, hits,
+                        recursion=recursion)[0])
+            elif term == 'is:signed':
+                for status in SignatureInfo.STATUSES:
+                    if status in CryptoInfo.STATUSES:
+                        continue
+                    rt.update(self.search_tag(
+                        session, 'in:mp_sig-%s' % status, hits,
+                        recursion=recursion)[0])
+            else:
+                t = term.split(':', 1)
+                fnc = _plugins.get_search_term(t[0])
+                if fnc:
+                    rt.update(fnc(self.config, self, term, hits))
+                else:
+                    rt.update(hits('%s:%s' % (t[1], t[0])))
+        else:
+            rt.update(hits(term))
+        return rt
+
+    def _estimate_term(self, session, term, keywords=None):
+        """
+        Cheaply estimate how many results a search term will have, without
+        loading all of its hits. Terms we cannot estimate are assumed to
+        match everything, so they get evaluated last.
+        """
+        if keywords is not None:
+            return len(keywords.get(term, []))
+        if term.startswith('in:'):
+            tag = self.config.get_tag(term.split(':', 1)[1])
+            if not tag:
+                return 0
+            if tag.magic_terms:
+                return len(self.INDEX)
+            return sum(self.get_tag_stats(t)[0]
+                       for t in [tag._key] + [st._key for st in
+                                              self.config.get_tags(
+                                                  parent=tag._key)])
+        elif term.startswith('mid:'):
+            return term.count(',') + 1
+        elif term.startswith('body:'):
+            return GlobalPostingList(session, term[5:]).estimate()
+        elif term == 'is:deleted':
+            return len(self.DELETED)
+        elif ':' in term:
+            t = term.split(':', 1)
+            if (term in ('all:mail', 'to:me', 'cc:me', 'from:me',
+                         'is:encrypted', 'is:signed') or
+                    _plugins.get_search_term(t[0])):
+                return len(self.INDEX)
+            return GlobalPostingList(session, '%s:%s' % (t[1], t[0])
+                                     ).estimate()
+        else:
+            return GlobalPostingList(session, term).estimate()
+
     def search(self, session, searchterms,
                keywords=None, order=None, recursion=0, context=None):
         # Stash the raw search terms
@@ -1646,14 +2286,7 @@ class MailIndex(BaseIndex):
                     return self.TAGS.get(term.rsplit(':', 1)[0], [])
                 else:
                     session.ui.mark(_('Searching for %s') % term)
-                    gpl_hits = GlobalPostingList(session, term).hits()
-                    try:
-                        return [int(h, 36) for h in gpl_hits]
-                    except ValueError:
-                        b36re = re.compile('^[a-zA-Z0-9]{1,8}$')
-                        print 'FIXME! BAD HITS: %s => %s' % (term, [
-                            h for h in gpl_hits if not b36re.match(h)])
-                        return [int(h, 36) for h in gpl_hits if b36re.match(h)]
+                    return GlobalPostingList(session, term).hits()
 
         # Replace some GMail-compatible terms with what we really use
         if 'tags' in self.config:
@@ -1672,15 +2305,13 @@ class MailIndex(BaseIndex):
         if searchterms and searchterms[0] and searchterms[0][0] == '-':
             searchterms[:0] = ['all:mail']
 
-        if context:
-            r = [(None, set(context))]
-        else:
-            r = []
-
+        # Parse the terms and note whether we are explicitly searching for
+        # things which would otherwise be hidden from the results.
         searched_invisible = False
         searched_mailbox = False
         searched_deleted = False
 
+        plan = []
         for term in searchterms:
             if term in STOPLIST:
                 if session:
@@ -1692,97 +2323,86 @@ class MailIndex(BaseIndex):
                 term = term[1:]
             else:
                 op = None
-
-            r.append((op, []))
-            rt = r[-1][1]
             term = term.lower()
 
-            if ':' in term:
-                if term.startswith('in:'):
-                    results, tag = self.search_tag(session, term, hits,
-                                                   recursion=recursion)
-                    rt.extend(results)
-                    if tag:
-                        if tag.flag_hides:
-                            searched_invisible = True
-                        if tag.type == 'mailbox':
-                            searched_mailbox = True
-
-                elif term.startswith('mid:'):
-                    rt.extend([int(t, 36) for t in
-                               term[4:].replace('=', '').split(',')])
-                elif term.startswith('body:'):
-                    rt.extend(hits(term[5:]))
-                elif term == 'all:mail':
-                    rt.extend(range(0, len(self.INDEX)))
-                elif term in ('to:me', 'cc:me', 'from:me'):
-                    vcards = self.config.vcards
-                    emails = []
-                    for vc in vcards.find_vcards([], kinds=['profile']):
-                        emails += [vcl.value for vcl in vc.get_all('email')]
-                    for email in set(emails):
-                        if email:
-                            rt.extend(hits('%s:%s' % (email,
-                                                      term.split(':')[0])))
-                elif term == 'is:encrypted':
-                    for status in EncryptionInfo.STATUSES:
-                        if status in CryptoInfo.STATUSES:
-                            continue
-                        rt.extend(self.search_tag(
-                            session, 'in:mp_enc-%s' % status, hits,
-                            recursion=recursion)[0])
-                elif term == 'is:signed':
-                    for status in SignatureInfo.STATUSES:
-                        if status in CryptoInfo.STATUSES:
-                            continue
-                        rt.extend(self.search_tag(
-                            session, 'in:mp_sig-%s' % status, hits,
-                            recursion=recursion)[0])
+            if term.startswith('in:'):
+                tag = self.config.get_tag(term.split(':', 1)[1])
+                if tag:
+                    if tag.flag_hides:
+                        searched_invisible = True
+                    if tag.type == 'mailbox':
+                        searched_mailbox = True
+            elif term == 'is:deleted':
+                searched_deleted = True
+
+            # Without a context, the first term is where we start from.
+            if not plan and not context:
+                op = None
+            plan.append((op, term))
+
+        # Terms are combined from left to right, but between two '+' terms
+        # the intersections and differences can happen in any order. So
+        # we intersect the cheapest terms first, stop as soon as nothing
+        # is left and apply the negative terms last.
+        def apply_run(results, ands, nots):
+            ands.sort(key=lambda t: self._estimate_term(session, t, keywords))
+            for term in ands:
+                if results is not None and not results:
+                    return results
+                rt = self._search_term(session, term, hits, recursion)
+                if results is None:
+                    results = rt
                 else:
-                    if term == 'is:deleted':
-                        searched_deleted = True
-                    t = term.split(':', 1)
-                    fnc = _plugins.get_search_term(t[0])
-                    if fnc:
-                        rt.extend(fnc(self.config, self, term, hits))
-                    else:
-                        rt.extend(hits('%s:%s' % (t[1], t[0])))
+                    results &= rt
+            for term in nots:
+                if not results:
+                    break
+                results -= self._search_term(session, term, hits, recursion)
+            return results
+
+        results = Bitmap(context) if context else None
+        ands, nots = [], []
+        for op, term in plan:
+            if op == '+':
+                results = apply_run(results, ands, nots) or Bitmap()
+                results |= self._search_term(session, term, hits, recursion)
+                ands, nots = [], []
+            elif op == '-':
+                nots.append(term)
             else:
-                rt.extend(hits(term))
-
-        if r:
-            results = set(r[0][1])
-            for (op, rt) in r[1:]:
-                if op == '+':
-                    results |= set(rt)
-                elif op == '-':
-                    results -= set(rt)
-                else:
-                    results &= set(rt)
+                ands.append(term)
+        results = apply_run(results, ands, nots)
+
+        if results is None:
+            results = Bitmap()
+        elif keywords is None:
             # Sometimes the scan gets aborted...
-            if keywords is None:
-                results -= set([len(self.INDEX)])
-        else:
-            results = set()
+            results.discard(len(self.INDEX))
+
+        # Deleted messages are dropped from the results, unless we were
+        # looking for them.
+        order = order or (session and session.order) or 'flat-index'
+        if (results and (keywords is None) and
+                (not searched_deleted) and
+                (not session or 'all' not in order)):
+            results -= self.DELETED
 
         # Unless we are searching for invisible things, remove them from
         # results by default.
         exclude = []
-        order = order or (session and session.order) or 'flat-index'
         if (results and (keywords is None) and
                 (not searched_invisible) and
                 (not searched_mailbox) and
-                (not searched_deleted) and
                 ('tags' in self.config) and
                 (not session or 'all' not in order)):
             invisible = self.config.get_tags(flag_hides=True)
-            exclude_terms = (['is:deleted'] +
-                             ['in:%s' % i._key for i in invisible])
+            exclude_terms = ['in:%s' % i._key for i in invisible]
             if len(exclude_terms) > 1:
                 exclude_terms = ([exclude_terms[0]] +
                                  ['+%s' % e for e in exclude_terms[1:]])
             # Recursing to pull the excluded terms from cache as well
-            exclude = self.search(session, exclude_terms).as_set()
+            if exclude_terms:
+                exclude = self.search(session, exclude_terms).as_set()
 
         # Decide if this is cached or not
         if keywords is None:
@@ -1803,39 +2423,282 @@ class MailIndex(BaseIndex):
                                ) % (len(srs.excluded()), ))
         return srs
 
-    def _freshness_sorter(self, msg_info):
-        ts = long(msg_info[self.MSG_DATE], 36)
-        for tid in self.get_tags(msg_info=msg_info):
+    def _rebuild_thread_summaries(self):
+        # Messages are unread if the freshness sort boosted them.
+        msg_ids = self.INDEX.msg_ids
+        self.THREADS.rebuild(
+            [self.INDEX.threads[pos] if (msg_ids[pos] is not None) else -1
+             for pos in xrange(0, len(msg_ids))],
+            self.INDEX.dates,
+            imap(ne, self.INDEX_SORT['freshness'], self.INDEX.dates))
+
+    def _refresh_freshness(self):
+        # The freshness keys and thread summaries depend on which tags
+        # mark mail as unread; if that changes, they are recalculated.
+        fresh_tags = [tag._key for tag in
+                      self.config.get_tags(type='unread')]
+        if set(fresh_tags) == set(self._sort_freshness_tags):
+            return
+        with self._lock:
+            self._sort_freshness_tags = fresh_tags
+            freshness = self.INDEX_SORT['freshness']
+            for pos in xrange(0, len(freshness)):
+                freshness[pos] = self._freshness_sorter(pos)
+            self._rebuild_thread_summaries()
+
+    def _is_fresh(self, msg_idx):
+        for tid in self.INDEX.tag_list(msg_idx):
             if tid in self._sort_freshness_tags:
-                return ts + self.FRESHNESS_SORT_BOOST
+                return True
+        return False
+
+    def _freshness_sorter(self, msg_idx):
+        ts = self.INDEX.dates[msg_idx]
+        if self._is_fresh(msg_idx):
+            return ts + self.FRESHNESS_SORT_BOOST
         return ts
 
+    def _string_rank(self, order, table, sid, sort_key):
+        # Senders and subjects are interned, so each distinct string only
+        # gets ranked once; messages share the rank of their string.
+        ranks = self._sort_string_ranks[order]
+        while len(ranks) <= sid:
+            ranks.append(-1)
+        rank = ranks[sid]
+        if rank < 0:
+            rank = ranks[sid] = string_to_rank(
+                sort_key(table[sid].decode('utf-8')))
+        return rank
+
+    def _from_sorter(self, msg_idx):
+        if not self.INDEX.exists(msg_idx):
+            return 0
+        def sort_key(frm):
+            email, fn = ExtractEmailAndName(frm)
+            return fn or email or frm
+        return self._string_rank('from', self.INDEX.senders,
+                                 self.INDEX.froms[msg_idx], sort_key)
+
+    def _subject_sorter(self, msg_idx):
+        if not self.INDEX.exists(msg_idx):
+            return 0
+        def sort_key(subject):
+            return self.SUBJECT_PREFIX.sub('', subject)
+        return self._string_rank('subject', self.INDEX.subject_table,
+                                 self.INDEX.subjects[msg_idx], sort_key)
+
     FRESHNESS_SORT_BOOST = (5 * 24 * 3600)
+    SUBJECT_THREADING_DAYS = 5
+    SUBJECT_UNLINKED = -2
+    THREAD_SUBJECT_PREFIX = re.compile(r'^((re|aw|sv)\s*:\s*)+', re.I)
+    SUBJECT_PREFIX = re.compile(r'^((re|fwd?|aw|sv)\s*:\s*)+', re.I)
+
+    # Sort orders with a rank per message, kept in arrays in INDEX_SORT
     SORT_ORDERS = {
         'freshness': _freshness_sorter,
-        'date': lambda s, mi: long(mi[s.MSG_DATE], 36),
-# FIXME: The following are disabled for now for being memory hogs
-#       'from': lambda s, mi: s.mi[s.MSG_FROM]),
-#       'subject': lambda s, mi: s.mi[s.MSG_SUBJECT]),
+        'from': _from_sorter,
+        'subject': _subject_sorter,
+    }
+
+    # Sort orders which use a metadata column as-is
+    SORT_COLUMNS = {
+        'date': 'dates',
+        'size': 'kbs',
     }
 
     def _prepare_sorting(self):
         self._sort_freshness_tags = [tag._key for tag in
                                      self.config.get_tags(type='unread')]
+        self._sort_string_ranks = {}
         self.INDEX_SORT = {}
         for order, sorter in self.SORT_ORDERS.iteritems():
-            self.INDEX_SORT[order] = []
+            self._sort_string_ranks[order] = array('l')
+            self.INDEX_SORT[order] = array('l')
+        self.THREADS = ThreadSummaries(self._thread_members)
+
+    def _sort_keys(self):
+        sort_keys = dict(self.INDEX_SORT)
+        for order, column in self.SORT_COLUMNS.iteritems():
+            sort_keys[order] = getattr(self.INDEX, column)
+        return sort_keys
+
+    def _collapse_keys(self, how):
+        # The thread summaries know the newest (and newest unread) message
+        # of each conversation, which is what comes first when sorting
+        # newest first by date or freshness.
+        if 'flat' in how or not how.startswith('rev'):
+            return None
+        if how.endswith('date'):
+            return self.INDEX.dates
+        if how.endswith('freshness'):
+            return self.INDEX_SORT['freshness']
+        return None
+
+    def _collapse_threads(self, results, how):
+        # Collapse conversations using the thread summaries, so only one
+        # message per conversation needs sorting. The outcome is what the
+        # full sort would give for results in ascending order. Returns
+        # None if the summaries cannot be used, or are missing messages.
+        keys = self._collapse_keys(how)
+        if keys is None:
+            return None
+        summaries, freshness = self.THREADS, (keys is not self.INDEX.dates)
+        try:
+            if not all(imap(lt, results, islice(results, 1, None))):
+                results.sort()
+            in_results = set(results)
+            thread_ids = list(set(imap(self.INDEX.threads.__getitem__,
+                                       results)))
+            firsts = summaries.newest_messages(thread_ids)
+            if freshness:
+                counts = summaries.unread_counts(thread_ids)
+                for i in [i for i, c in enumerate(counts) if c]:
+                    unread = summaries.newest_unread(thread_ids[i])
+                    if unread == summaries.UNKNOWN or firsts[i] < 0:
+                        firsts[i] = summaries.UNKNOWN
+                    elif unread >= 0 and ((keys[unread], unread) >
+                                          (keys[firsts[i]], firsts[i])):
+                        firsts[i] = unread
+
+            def members(thread):
+                found = summaries.members(thread)
+                if found is None:
+                    raise ValueError('Thread summary is out of date')
+                found = [m for m in found if m in in_results]
+                if not found:
+                    raise ValueError('Thread summary is missing messages')
+                return found
+
+            # If a conversation's first message did not match the search,
+            # we look for the first one which did.
+            found = map(in_results.__contains__, firsts)
+            missing = [i for i, f in enumerate(found) if not f]
+            if len(missing) * 4 > len(firsts):
+                return None
+            for i in missing:
+                firsts[i] = max(members(thread_ids[i]),
+                                key=lambda m: (keys[m], m))
+
+            # As in the full sort: if the conversation itself is unread,
+            # the last of its messages stands in for it.
+            reps = {}
+            if freshness:
+                flags = summaries.unread_flags(thread_ids)
+                for i in [i for i, f in enumerate(flags) if f]:
+                    reps[firsts[i]] = min(members(thread_ids[i]),
+                                          key=lambda m: (keys[m], m))
+
+            # Newest first, and equal keys by descending position.
+            firsts.sort()
+            firsts.sort(key=keys.__getitem__)
+            firsts.reverse()
+        except (IndexError, ValueError):
+            return None
+        if reps:
+            return [reps.get(f, f) for f in firsts]
+        return firsts
+
+    def _sort_top(self, session, results, how, limit):
+        # Put just the first limit results in order, in O(N log limit)
+        # time; the rest follow in no particular order. When collapsing
+        # conversations, each of the first results is the message a full
+        # sort would have chosen (the first in sort order), but the others
+        # are represented by an arbitrary message.
+        # Freshness collapses differently, so that always gets a full sort;
+        # the orders the thread summaries can collapse are cheap anyway.
+        if 'flat' not in how and ('freshness' in how or
+                                  self._collapse_keys(how) is not None):
+            return False
+        keys = [k for o, k in self._sort_keys().iteritems()
+                if how.endswith(o)]
+        if not keys:
+            return False
+        keys = keys[0]
+
+        def first(n):
+            # Reversed orders are a stable sort followed by a reverse, so
+            # there the last of equal messages comes first.
+            if how.startswith('rev'):
+                return [r for k, p, r in heapq.nlargest(n, izip(
+                    imap(keys.__getitem__, results), icount(), results))]
+            return heapq.nsmallest(n, results, key=keys.__getitem__)
+
+        session.ui.mark(_n('Sorting top %d of %d message by %s...',
+                           'Sorting top %d of %d messages by %s...',
+                           len(results)
+                           ) % (limit, len(results), _(how)))
+        try:
+            if 'flat' in how:
+                top = first(limit)
+                in_top = set(top)
+                rest = [r for r in results if r not in in_top]
+            else:
+                threads, n = self.INDEX.threads, limit
+                while True:
+                    n *= 2
+                    top, in_top = [], set()
+                    for msg_idx in first(n):
+                        if threads[msg_idx] not in in_top:
+                            in_top.add(threads[msg_idx])
+                            top.append(msg_idx)
+                            if len(top) >= limit:
+                                break
+                    if len(top) >= limit or n >= len(results):
+                        break
+                rest = dict(izip(imap(threads.__getitem__, results),
+                                 results))
+                for thread in in_top:
+                    del rest[thread]
+                rest = rest.values()
+        except IndexError:
+            # Let the full sort report and recover from this
+            return False
+
+        results[:] = top + rest
+        session.ui.mark(_n('Sorted top %d of %d message by %s',
+                           'Sorted top %d of %d messages by %s',
+                           len(results)
+                           ) % (len(top), len(results), _(how)))
+        return True
+
+    def sort_top_results(self, session, results, how, limit):
+        """
+        Sort results like sort_results, but stop once the first limit
+        results are in order if that saves time, and return True if so.
+        Sorting the original results with sort_results gives the rest.
+        """
+        if (limit * 4 < len(results) and
+                self._sort_top(session, results, how or 'flat-unsorted',
+                               limit)):
+            return True
+        self.sort_results(session, results, how)
+        return False
 
     def sort_results(self, session, results, how):
         if not results:
             return
 
-        count = len(results)
         how = how or 'flat-unsorted'
+        count = len(results)
+        self._refresh_freshness()
         session.ui.mark(_n('Sorting %d message by %s...',
                            'Sorting %d messages by %s...',
                            count
                            ) % (count, _(how)))
+        collapsed = self._collapse_threads(results, how)
+        if collapsed is not None:
+            results[:] = collapsed
+            session.ui.mark(_n('Sorted %d message by %s',
+                               'Sorted %d messages by %s',
+                               count
+                               ) % (count, how) +
+                            ', ' +
+                            _n('%d conversation',
+                               '%d conversations',
+                               len(results)
+                               ) % (len(results), ))
+            return True
+
         try:
             if how.endswith('unsorted'):
                 pass
@@ -1846,11 +2709,11 @@ class MailIndex(BaseIndex):
                 results.sort(key=lambda k: sha1b64('%s%s' % (now, k)))
             else:
                 did_sort = False
-                for order in self.INDEX_SORT:
+                sort_keys = self._sort_keys()
+                for order in sort_keys:
                     if how.endswith(order):
                         try:
-                            results.sort(
-                                key=self.INDEX_SORT[order].__getitem__)
+                            results.sort(key=sort_keys[order].__getitem__)
                         except IndexError:
                             say = session.ui.error
                             if session.config.sys.debug:
@@ -1865,7 +2728,7 @@ class MailIndex(BaseIndex):
                             clean_results = [r for r in results
                                              if r >= 0 and r < len(self.INDEX)]
                             clean_results.sort(
-                                key=self.INDEX_SORT[order].__getitem__)
+                                key=sort_keys[order].__getitem__)
                             results[:] = clean_results
                         did_sort = True
                         break
@@ -1882,19 +2745,18 @@ class MailIndex(BaseIndex):
             results.reverse()
 
         if 'flat' not in how:
-            all_new = set()
+            all_new = Bitmap()
             if 'freshness' in how:
-                # FIXME: This calculation appears very cachable!
-                new_tags = session.config.get_tags(type='unread')
-                for tag in new_tags:
-                    all_new |= self.TAGS.get(tag._key, set([]))
+                # The same tags as the freshness keys and thread summaries
+                for tid in self._sort_freshness_tags:
+                    all_new |= self.TAGS.get(tid, Bitmap())
 
             # This filters away all but the first (or oldst unread) result in
             # each conversation.
             session.ui.mark(_('Collapsing conversations...'))
             seen, pi = {}, 0
             for ri in results:
-                ti = self.INDEX_THR[ri]
+                ti = self.INDEX.threads[ri]
                 if ti in seen:
                     if ti in all_new:
                         results[seen[ti]] = ri
@@ -56,7 +56,7 @@ class SearchHistory(object):
         bitmask, order = zlib.decompress(compressed_bitmask).rsplit(':', 1)
         return bitmask_to_intlist(bitmask), order
 
-    def add(self, terms, results, order):
+    def add(self, terms, results, order, is_sorted=True):
         now = int(time.time())
         data = {
             'terms': terms[:],
@@ -64,6 +64,8 @@ class SearchHistory(object):
             'order': order,
             't': now
         }
+        if not is_sorted:
+            data['unsorted'] = True
         with SEARCH_HISTORY_LOCK:
             fprint = md5_hex(str(terms), str(results), str(order))
             self.cache[fprint] = data
@@ -79,6 +81,9 @@ class SearchHistory(object):
                 session.config.index.sort_results(session, results, order)
                 search['results'] = results
                 search['order'] = order
+            elif search.pop('unsorted', False):
+                session.config.index.sort_results(session, search['results'],
+                                                  search['order'])
             return tuple(search[t] for t in ('terms', 'results', 'order'))
 
     def expire(self, ttl=None, compact=None):
@@ -99,6 +104,7 @@ class SearchHistory(object):
                 if 'c' in search:
                     del search['results']
                     del search['order']
+                    search.pop('unsorted', None)
                 # Note: do not set self.changed, as the actual data being
                 # cached is still the same - we just changed the format.
 
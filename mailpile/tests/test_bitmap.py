@@ -0,0 +1,60 @@
+import random
+import unittest
+
+from mailpile.index.bitmap import Bitmap
+
+
+class TestBitmap(unittest.TestCase):
+    def setUp(self):
+        self.a = set(random.sample(xrange(100000), 5000))
+        self.b = set(random.sample(xrange(100000), 5000))
+
+    def test_roundtrip(self):
+        self.assertEqual(list(Bitmap(self.a)), sorted(self.a))
+        self.assertEqual(len(Bitmap(self.a)), len(self.a))
+        self.assertEqual(list(Bitmap()), [])
+
+    def test_set_algebra(self):
+        ba, bb = Bitmap(self.a), Bitmap(self.b)
+        self.assertEqual(list(ba | bb), sorted(self.a | self.b))
+        self.assertEqual(list(ba & bb), sorted(self.a & self.b))
+        self.assertEqual(list(ba - bb), sorted(self.a - self.b))
+        self.assertEqual(list(ba.andnot(self.b)), sorted(self.a - self.b))
+        self.assertEqual((ba & bb).count(), len(self.a & self.b))
+
+    def test_mixed_with_sets(self):
+        ba = Bitmap(self.a)
+        self.assertEqual(list(self.b & ba), sorted(self.a & self.b))
+        self.assertEqual(list(self.b - ba), sorted(self.b - self.a))
+        self.assertEqual(ba, self.a)
+
+    def test_range(self):
+        for start, end in ((0, 0), (0, 1), (5, 4096), (4095, 4097),
+                           (1, 3 * Bitmap.CHUNK_BITS + 7)):
+            self.assertEqual(list(Bitmap.Range(start, end)),
+                             range(start, end))
+
+    def test_add_discard(self):
+        bm = Bitmap()
+        for v in (0, 4095, 4096, 99999):
+            bm.add(v)
+            self.assertTrue(v in bm)
+            bm.discard(v)
+            self.assertFalse(v in bm)
+        self.assertFalse(bm)
+        self.assertEqual(bm.chunks, {})
+
+    def test_bad_values(self):
+        self.assertRaises(ValueError, Bitmap, [-1, 3])
+        self.assertRaises(ValueError, Bitmap().add, -9)
+        self.assertFalse(-1 in Bitmap([0, 1]))
+
+    def test_sparse_values(self):
+        # Memory use depends on how many values there are, not how big
+        values = [7, 1 << 40, (1 << 40) + 5]
+        bm = Bitmap(values)
+        self.assertEqual(list(bm), values)
+        self.assertEqual(len(bm.chunks), 2)
+        bm.update(xrange(4090, 4100))
+        self.assertEqual(len(bm), 13)
+        self.assertEqual(list(Bitmap(reversed(values))), values)
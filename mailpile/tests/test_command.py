@@ -1,9 +1,12 @@
+import email
 import unittest
 import os
 from mock import patch
 
 import mailpile
 from mailpile.commands import Action as action
+from mailpile.index.rebuild import IndexRebuilder
+from mailpile.search import MailIndex
 from mailpile.tests import MailPileUnittest
 
 
@@ -17,10 +20,66 @@ class TestCommands(MailPileUnittest):
         res = self.mp.search("foo")
         self.assertLess(float(res.as_dict()["elapsed"]), 0.2)
 
+    def test_search_sort_by_sender(self):
+        def senders(order):
+            self.mp.order(order)
+            res = self.mp.search('all:mail').result
+            return [res['data']['metadata'][mid]['from']['fn']
+                    for mid in res['thread_ids']]
+        try:
+            by_sender = senders('flat-from')
+            self.assertTrue(by_sender[0].startswith('Brennan Novak'))
+            self.assertEqual(senders('rev-flat-from'), by_sender[::-1])
+        finally:
+            self.mp.order('rev-date')
+
+    def test_search_pages_partially_sorted(self):
+        # Small pages only get the first page sorted up front; paging
+        # on must still give the same order as sorting everything.
+        self.mp.set("prefs.num_results=2")
+        try:
+            self.mp.order('rev-flat-size')
+            res = self.mp.search('all:mail').result
+            pages = [res['thread_ids']]
+            while len(pages) < 7:
+                pages.append(self.mp.next().result['thread_ids'])
+            results = list(self.mp._config.index.search(
+                self.mp._session, ['all:mail']).as_set())
+            self.mp._config.index.sort_results(
+                self.mp._session, results, 'rev-flat-size')
+            self.assertEqual([int(m, 36) for p in pages for m in p],
+                             results)
+        finally:
+            self.mp.unset("prefs.num_results")
+            self.mp.order('rev-date')
+
     def test_optimize(self):
         res = self.mp.optimize()
         self.assertEqual(res.as_dict()["result"], True)
 
+    def test_index_check(self):
+        res = action(self.mp._session, "index/check", "")
+        self.assertEqual(res.as_dict()["status"], 'success')
+        self.assertEqual(res.as_dict()["result"], {})
+
+    def test_address_search(self):
+        res = action(self.mp._session, "search/address", "bre")
+        self.assertIn('hi@brennannovak.com',
+                      [a['address'] for a in res.result['addresses']])
+
+    def test_address_search_skips_hidden_senders(self):
+        idx = self.mp._config.index
+        inbox = self.mp._config.get_tags(slug='inbox')[0]
+        inbox.flag_hides = True
+        try:
+            idx._record_sender('Spammer <spammer@example.org>', [inbox._key])
+            idx._record_sender('Friend <friend@example.org>', [])
+        finally:
+            inbox.flag_hides = False
+        res = action(self.mp._session, "search/address", "example.org")
+        self.assertEqual([a['address'] for a in res.result['addresses']],
+                         ['friend@example.org'])
+
     def test_set(self):
         self.mp.set("prefs.num_results=1")
         results = self.mp.search("twitter")
@@ -121,6 +180,108 @@ class TestCommands(MailPileUnittest):
                          "Fw: About shrubberies")
 
 
+class TestThreading(MailPileUnittest):
+    def test_subject_threading(self):
+        idx = self.mp._config.index
+        # The two Twitter follower notices share a subject, but neither
+        # looks like a reply, so they are separate conversations.
+        older = list(idx.get_msg_at_idx_pos(0))
+        newer = list(idx.get_msg_at_idx_pos(3))
+        self.assertEqual(older[idx.MSG_SUBJECT], newer[idx.MSG_SUBJECT])
+        self.assertEqual(idx.INDEX.threads[3], 3)
+        no_headers = email.message_from_string('')
+        try:
+            # A reply joins the conversation of an older message...
+            reply = list(newer)
+            reply[idx.MSG_SUBJECT] = u'Re: ' + newer[idx.MSG_SUBJECT]
+            idx.set_msg_at_idx_pos(3, reply)
+            idx.set_conversation_ids(reply[idx.MSG_MID], no_headers)
+            self.assertEqual(idx.INDEX.threads[3], 0)
+            idx.set_msg_at_idx_pos(3, newer)
+            self.assertEqual(idx.INDEX.threads[3], 3)
+
+            # ... but never that of a newer one.
+            reply = list(older)
+            reply[idx.MSG_SUBJECT] = u'Re: ' + older[idx.MSG_SUBJECT]
+            idx.set_msg_at_idx_pos(0, reply)
+            idx.set_conversation_ids(reply[idx.MSG_MID], no_headers)
+            self.assertEqual(idx.INDEX.threads[0], 0)
+        finally:
+            idx.set_msg_at_idx_pos(0, older)
+            idx.set_msg_at_idx_pos(3, newer)
+
+    def _sort_both_ways(self, how):
+        idx = self.mp._config.index
+        collapsed = range(0, len(idx.INDEX))
+        idx.sort_results(self.mp._session, collapsed, how)
+        idx._collapse_threads = lambda results, how: None
+        try:
+            full = range(0, len(idx.INDEX))
+            idx.sort_results(self.mp._session, full, how)
+        finally:
+            del idx._collapse_threads
+        return collapsed, full
+
+    def test_collapse_freshness(self):
+        idx = self.mp._config.index
+        new_tag = self.mp._config.get_tags(slug='new')[0]
+        older = list(idx.get_msg_at_idx_pos(0))
+        newer = list(idx.get_msg_at_idx_pos(3))
+        try:
+            reply = list(newer)
+            reply[idx.MSG_SUBJECT] = u'Re: ' + newer[idx.MSG_SUBJECT]
+            idx.set_msg_at_idx_pos(3, reply)
+            idx.set_conversation_ids(reply[idx.MSG_MID],
+                                     email.message_from_string(''))
+            self.assertEqual(idx.INDEX.threads[3], 0)
+
+            # While both messages are unread, the oldest unread one
+            # stands in for the conversation; once no tag marks mail as
+            # unread, the newest one does, however the results collapse.
+            collapsed, full = self._sort_both_ways('rev-freshness')
+            self.assertEqual(collapsed, full)
+            self.assertTrue(0 in full and 3 not in full)
+            new_tag.type = 'tag'
+            collapsed, full = self._sort_both_ways('rev-freshness')
+            self.assertEqual(collapsed, full)
+            self.assertTrue(3 in full and 0 not in full)
+        finally:
+            new_tag.type = 'unread'
+            idx.set_msg_at_idx_pos(3, newer)
+            idx.sort_results(self.mp._session, [0], 'freshness')
+
+
+class TestRebuild(MailPileUnittest):
+    def _rebuild(self, old_idx, processes=1):
+        rebuilder = IndexRebuilder(self.mp._session, old_idx,
+                                   processes=processes)
+        rebuilder.BATCH_SIZE = 4
+        try:
+            return rebuilder.rebuild(self.mp._config.get_mailboxes())
+        finally:
+            rebuilder._discard()
+
+    def test_rebuild_dates_and_tags(self):
+        config = self.mp._config
+        idx = config.index
+        # Messages the old index knows keep their tags, the others are
+        # tagged as a rescan would; in both cases the dates of messages
+        # without a Date: header follow the message before them, also
+        # when the workers parse them out of order.
+        for old_idx, processes in ((idx, 1), (MailIndex(config), 1),
+                                   (MailIndex(config), 2)):
+            new_idx = self._rebuild(old_idx, processes=processes)
+            for pos in range(0, len(idx.INDEX)):
+                msg_info = idx.get_msg_at_idx_pos(pos)
+                new_info = new_idx.get_msg_at_idx_pos(
+                    new_idx.MSGIDS[msg_info[idx.MSG_ID]])
+                self.assertEqual(new_info[idx.MSG_DATE],
+                                 msg_info[idx.MSG_DATE])
+                self.assertEqual(
+                    sorted(new_info[idx.MSG_TAGS].split(',')),
+                    sorted(msg_info[idx.MSG_TAGS].split(',')))
+
+
 class TestCommandResult(MailPileUnittest):
     def test_command_result_as_dict(self):
         res = self.mp.help_splash()
@@ -153,6 +314,42 @@ class TestTagging(MailPileUnittest):
     def test_addtag(self):
         pass
 
+    def test_tag_stats(self):
+        idx, session = self.mp._config.index, self.mp._session
+        new = self.mp._config.get_tag('new')._key
+        inbox = self.mp._config.get_tag('inbox')._key
+        unread = set(idx.TAGS[new])
+        total = len(idx.TAGS[inbox])
+        idx.get_tag_stats(inbox)
+        try:
+            idx.remove_tag(session, new, msg_idxs=[0, 1, 2])
+            self.assertEqual(idx.get_tag_stats(inbox),
+                             (total, total - 3, total, total - 3))
+            self.assertEqual(idx.get_tag_stats(new)[0], len(idx.TAGS[new]))
+        finally:
+            idx.add_tag(session, new, msg_idxs=unread)
+        self.assertEqual(idx.get_tag_stats(inbox)[:2], (total, len(unread)))
+
+    def test_edit_tags(self):
+        idx, session = self.mp._config.index, self.mp._session
+        new = self.mp._config.get_tag('new')._key
+        inbox = self.mp._config.get_tag('inbox')._key
+        before = set(idx.TAGS[new]), set(idx.TAGS[inbox])
+        try:
+            added, removed = idx.edit_tags(session, [
+                ([0, 1, 2], [], [new, inbox]),
+                ([1, 2, 3], [inbox], [])])
+            self.assertEqual(removed, {new: set([0, 1, 2]),
+                                       inbox: set([0, 1, 2])})
+            self.assertEqual(added, {inbox: set([1, 2])})
+            self.assertEqual(idx.get_tags(msg_idx=1), [inbox])
+            self.assertFalse(set([0, 1, 2]) & set(idx.TAGS[new]))
+            self.assertTrue(0 not in idx.TAGS[inbox] and 1 in idx.TAGS[inbox])
+        finally:
+            idx.edit_tags(session, [(before[0], [new], []),
+                                    (before[1], [inbox], [])])
+        self.assertEqual(idx.get_tags(msg_idx=1), [inbox, new])
+
 
 class TestGPG(MailPileUnittest):
     def test_key_search(self):
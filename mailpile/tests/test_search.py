@@ -1,7 +1,9 @@
 import unittest
 from nose.tools import assert_equal, assert_less
 
-from mailpile.tests import get_shared_mailpile
+import mailpile.postinglist
+from mailpile.postinglist import PostingListFilters
+from mailpile.tests import get_shared_mailpile, MailPileUnittest
 
 
 def checkSearch(query, expected_count=1):
@@ -48,3 +50,36 @@ def test_generator():
 
     # Test that we do not crash when searching for a non-existant tag.
     yield checkSearch(['in:doesnotexist'], 0)
+
+    # Message IDs which are out of range match nothing
+    yield checkSearch(['mid:zzzzzzzz'], 0)
+    yield checkSearch(['mid:-9'], 0)
+    yield checkSearch(['mid:1,zzzzzzzz'], 1)
+
+
+class TestPostingListFilters(MailPileUnittest):
+    def _save_filters(self):
+        with mailpile.postinglist.GLOBAL_FILTERS_LOCK:
+            mailpile.postinglist.GLOBAL_FILTERS_STATE['dirty'] = True
+            PostingListFilters.Save(self.session)
+
+    def test_hit_counts(self):
+        PostingListFilters.Rebuild(self.session)
+        PostingListFilters.Saved(self.session, 'zzzztest', {
+            'zzzztestcommon': 500, 'zzzztestrare': 3, 'zzzztestrare2': 5})
+        try:
+            for reload in (False, True):
+                if reload:
+                    # The counts survive a round trip through the file
+                    self._save_filters()
+                    mailpile.postinglist.GLOBAL_FILTERS = None
+                # Common sigs are counted exactly, the rest get a typical
+                # count, and absent ones none at all.
+                count = lambda sig: PostingListFilters.Count(self.session,
+                                                             sig)
+                self.assertEqual(count('zzzztestcommon'), 500)
+                self.assertEqual(count('zzzztestrare'), 4)
+                self.assertEqual(count('zzzztestabsent'), 0)
+        finally:
+            PostingListFilters.Saved(self.session, 'zzzztest', {})
+            self._save_filters()
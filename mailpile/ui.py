@@ -734,6 +734,7 @@ class Session(object):
 
         self.order = None
         self.results = []
+        self.partial_sort = None
         self.searched = []
         self.search_index = None
         self.last_event_id = None
@@ -753,18 +754,45 @@ class Session(object):
         if search:
             self.order = session.order
             self.results = session.results[:]
+            self.partial_sort = None
+            if session.results_partially_sorted():
+                self.partial_sort = ((self.results, ) +
+                                     session.partial_sort[1:])
             self.searched = session.searched[:]
             self.search_index = session.search_index
             self.displayed = session.displayed
             self.context = session.context
         return self
 
+    def results_partially_sorted(self):
+        return (self.partial_sort is not None and
+                self.partial_sort[0] is self.results)
+
+    def finish_sorting(self, end=None):
+        """
+        Searches may only sort the first page of results. Finish sorting
+        them if anything past the first end results is needed.
+        """
+        if self.results_partially_sorted():
+            results, raw, limit = self.partial_sort
+            if end is None or end > limit:
+                idx = self.search_index or self.config.index
+                results[:] = raw
+                idx.sort_results(self, results, self.order)
+                self.partial_sort = None
+        return self.results
+
     def get_context(self, update=False):
         if update or not self.context:
             if self.searched and not self.search_index:
+                # History gets the unsorted results of a partial sort;
+                # they are sorted again when the search is loaded.
+                partial = self.results_partially_sorted()
+                results = self.partial_sort[1] if partial else self.results
                 sid = self.config.search_history.add(self.searched,
-                                                     self.results,
-                                                     self.order)
+                                                     results,
+                                                     self.order,
+                                                     is_sorted=not partial)
                 self.context = 'search:%s' % sid
         return self.context
 
@@ -753,6 +753,103 @@ def decrypt_and_parse_lines(fd, parser, config,
             _parser([line])
 
 
+def split_encrypted_blocks(fd, max_plaintext=1024 * 1024):
+    """
+    Split a file into self-contained encrypted blocks and runs of plain
+    text lines, yielding (end_offset, encrypted, data) tuples in order.
+
+    >>> blocks = split_encrypted_blocks(StringIO.StringIO(
+    ...     'hello\\n-----BEGIN PGP MESSAGE-----\\nabc\\n'
+    ...     '-----END PGP MESSAGE-----\\nworld\\n'))
+    >>> [(o, e, d.split()[-1]) for o, e, d in blocks]
+    [(6, False, 'hello'), (64, True, 'MESSAGE-----'), (70, False, 'world')]
+    """
+    import mailpile.crypto.streamer as cstrm
+    block, size, encrypted, offset = [], 0, False, 0
+    for line in fd:
+        if encrypted:
+            block.append(line)
+            offset += len(line)
+            # Cheap test first, this loop sees every line of base64
+            if (line[:1] == '-' and
+                    cstrm.DecryptingStreamer.EndEncrypted(line)):
+                yield (offset, True, ''.join(block))
+                block, encrypted = [], False
+        elif cstrm.DecryptingStreamer.StartEncrypted(line):
+            if block:
+                yield (offset, False, ''.join(block))
+            block, encrypted = [line], True
+            offset += len(line)
+        else:
+            block.append(line)
+            offset += len(line)
+            size += len(line)
+            if size >= max_plaintext:
+                yield (offset, False, ''.join(block))
+                block, size = [], 0
+    if block:
+        yield (offset, encrypted, ''.join(block))
+
+
+def decrypt_blocks(blocks, config, threads=None,
+                   passphrase=None, gpgi=None,
+                   _raise=IOError, error_cb=None):
+    """
+    Decrypt blocks from split_encrypted_blocks(), yielding (end_offset,
+    plaintext) tuples in the original order.
+
+    Each block is decrypted independently, by a pool of threads: the
+    ciphers, hashes and coprocesses doing the actual work all run
+    without holding the GIL. Only a few blocks are decrypted ahead of
+    the consumer, so memory use stays bounded.
+    """
+    import collections
+    import cStringIO
+    import multiprocessing
+    from multiprocessing.pool import ThreadPool
+    import mailpile.crypto.streamer as cstrm
+    symmetric_key = config and config.master_key or 'missing'
+
+    def decrypt(block):
+        offset, encrypted, data = block
+        if not encrypted:
+            return offset, data
+        # Passphrase readers keep state, so each block gets its own.
+        passphrase_reader = None
+        if data.startswith(cstrm.DecryptingStreamer.BEGIN_PGP):
+            passphrase_reader = (passphrase.get_reader()
+                                 if (passphrase is not None) else
+                                 (config.passphrases['DEFAULT'].get_reader()
+                                  if (config is not None) else None))
+        with cstrm.DecryptingStreamer(cStringIO.StringIO(data),
+                                      name='decrypt_blocks',
+                                      mep_key=symmetric_key,
+                                      gpg_pass=passphrase_reader,
+                                      gpgi=gpgi) as ds:
+            plaintext = ds.read()
+            if not ds.verify(_raise=_raise) and error_cb:
+                error_cb(offset)
+        return offset, plaintext
+
+    threads = max(1, threads or multiprocessing.cpu_count())
+    if threads < 2:
+        for block in blocks:
+            yield decrypt(block)
+        return
+
+    pool = ThreadPool(threads)
+    try:
+        pending = collections.deque()
+        for block in blocks:
+            pending.append(pool.apply_async(decrypt, (block, )))
+            if len(pending) >= 2 * threads:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+
+
 # This is a hack to deal with the fact that Windows sometimes won't
 # let us delete files right away because it thinks they are still open.
 # Any failed removal just gets queued up for later.